@@ -0,0 +1,79 @@
+"""Updates feeds the way the daemons do, against an in-memory SQLite
+database, for a number of rounds, and reports after each round how
+many objects the process and the storage backend hold, and the peak
+RSS.
+
+Every round, each feed contains a few new items. The numbers should
+stay flat, rather than growing with the number of rounds.
+"""
+
+import gc
+import logging
+import resource
+from optparse import OptionParser
+
+from storm import variables as stormvars
+
+from feedplatform.lib import provide_loop_daemon, store_enclosures
+from feedplatform.conf import config
+from feedplatform import db, addins, log
+
+
+def make_feed(round, num_items):
+    items = ''.join(['<item><guid>http://example.org/%d</guid>'
+                     '<enclosure url="http://example.org/%d.mp3" /></item>'
+                     % (i, i) for i in range(round, round+num_items)])
+    return u'<rss><channel>%s</channel></rss>' % items
+
+
+def create_tables():
+    types = {stormvars.IntVariable: 'INTEGER',
+             stormvars.UnicodeVariable: 'VARCHAR',
+             stormvars.DateTimeVariable: 'TIMESTAMP'}
+    for name, model in db.models.iteritems():
+        fields = ['%s %s%s' % (field._detect_attr_name(model),
+                               types[field._variable_class],
+                               field._primary and ' PRIMARY KEY' or '')
+                  for field in model._storm_columns]
+        db.store.execute('CREATE TABLE %s (%s)' % (name, ', '.join(fields)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-f', '--feeds', type='int', default=50,
+                      help='number of feeds')
+    parser.add_option('-i', '--items', type='int', default=20,
+                      help='number of items per feed')
+    parser.add_option('-r', '--rounds', type='int', default=10,
+                      help='number of times every feed is queued')
+    options, args = parser.parse_args()
+
+    log.reset(level=logging.WARNING)
+    config.configure(DATABASE='sqlite:', ADDINS=[store_enclosures()],
+                     DAEMON_STATS_INTERVAL=None)
+    addins.reinstall()
+    create_tables()
+
+    for i in range(options.feeds):
+        feed = db.models.Feed()
+        db.backend.add(feed)
+    db.backend.commit()
+    feed = None
+
+    daemon = provide_loop_daemon()
+    print '%5s %8s %10s %10s' % ('round', 'objects', 'backend', 'rss (kb)')
+    for round in range(options.rounds):
+        for feed in db.backend.iter_feeds():
+            feed.url = make_feed(round, options.items)
+            daemon.update_feed(feed)
+        feed = None
+
+        gc.collect()
+        stats = daemon.get_stats()
+        print '%5d %8d %10d %10d' % (
+            round+1, len(gc.get_objects()), stats['store_alive_objects'],
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Parses a large, gzip-compressed feed and reports how much the peak
+memory usage (RSS) of the process grows.
+
+Compares the way the feed parser handles a response now, decompressing
+it while reading, against reading and decompressing the whole response
+in one go, then converting it to UTF-8 through unicode, which is what
+it used to do.
+
+Each measurement runs in a fresh process, as the peak RSS can't be
+reset.
+"""
+
+import os
+import sys
+import gzip
+import resource
+import tempfile
+import subprocess
+from cStringIO import StringIO
+from optparse import OptionParser, SUPPRESS_HELP
+
+from feedplatform.deps import feedparser
+from feedplatform.test import MockHTTPResponse
+
+
+def make_feed(size):
+    item = ('<item><guid>http://example.org/%%d</guid><title>Item</title>'
+            '<description>%s</description></item>' % ('\xc3\xa4 ' * 500))
+    count = size / len(item) + 1
+    return ('<?xml version="1.0" encoding="utf-8"?><rss><channel>%s'
+            '</channel></rss>' % ''.join([item % i for i in range(count)]))
+
+
+def parse_streaming(data):
+    return feedparser.parse(MockHTTPResponse(200, 'OK',
+        {'Content-Encoding': 'gzip', 'Content-Type': 'application/rss+xml'},
+        data, 'http://feeds/large'))
+
+
+def parse_buffered(data):
+    response = MockHTTPResponse(200, 'OK', {}, data, 'http://feeds/large')
+    data = response.read()
+    data = gzip.GzipFile(fileobj=StringIO(data)).read()
+    data = unicode(data, 'utf-8').encode('utf-8')
+    return feedparser.parse(data)
+
+
+def measure(mode, filename):
+    data = open(filename, 'rb').read()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {'streaming': parse_streaming,
+              'buffered': parse_buffered}[mode](data)
+    assert not result.bozo, result.bozo_exception
+    print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-s', '--size', type='int', default=20,
+                      help='uncompressed feed size in megabytes')
+    parser.add_option('--child', nargs=2, help=SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        return measure(*options.child)
+
+    feed = make_feed(options.size * 1024 * 1024)
+    fd, filename = tempfile.mkstemp()
+    try:
+        f = os.fdopen(fd, 'wb')
+        compressed = gzip.GzipFile(fileobj=f, mode='wb')
+        compressed.write(feed)
+        compressed.close()
+        f.close()
+        print 'feed: %d kb, compressed: %d kb' % (
+            len(feed) / 1024, os.path.getsize(filename) / 1024)
+        del feed
+
+        print '%10s %16s' % ('mode', 'peak rss (+kb)')
+        for mode in ('buffered', 'streaming'):
+            output = subprocess.Popen(
+                [sys.executable, __file__, '--child', mode, filename],
+                stdout=subprocess.PIPE).communicate()[0]
+            print '%10s %16s' % (mode, output.strip())
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
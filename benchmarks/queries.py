@@ -0,0 +1,93 @@
+"""Profiles repeated updates of a feed whose items all exist already,
+against an in-memory SQLite database, and reports how much of the
+time is spent compiling SQL.
+
+With the statement cache of the Storm backend, the item and enclosure
+lookups should be compiled only once, during the first update; use
+``--uncached`` to compare with compiling every query.
+"""
+
+import logging
+import cProfile, pstats
+from optparse import OptionParser
+
+from storm import variables as stormvars
+
+from feedplatform.lib import store_enclosures
+from feedplatform.conf import config
+from feedplatform import db, parse, addins, log
+
+
+def make_feed(num_items):
+    items = ''.join(['<item><guid>http://example.org/%d</guid>'
+                     '<enclosure url="http://example.org/%d.mp3" /></item>'
+                     % (i, i) for i in range(num_items)])
+    return u'<rss><channel>%s</channel></rss>' % items
+
+
+def create_tables():
+    types = {stormvars.IntVariable: 'INTEGER',
+             stormvars.UnicodeVariable: 'VARCHAR',
+             stormvars.DateTimeVariable: 'TIMESTAMP'}
+    for name, model in db.models.iteritems():
+        fields = ['%s %s%s' % (field._detect_attr_name(model),
+                               types[field._variable_class],
+                               field._primary and ' PRIMARY KEY' or '')
+                  for field in model._storm_columns]
+        db.store.execute('CREATE TABLE %s (%s)' % (name, ', '.join(fields)))
+
+
+class _NoCache(dict):
+    def __setitem__(self, key, value):
+        pass
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-i', '--items', type='int', default=200,
+                      help='number of items in the feed')
+    parser.add_option('-n', '--updates', type='int', default=20,
+                      help='number of updates to profile')
+    parser.add_option('--uncached', action='store_true',
+                      help='compile every query from scratch')
+    options, args = parser.parse_args()
+
+    log.reset(level=logging.WARNING)
+    config.configure(DATABASE='sqlite:', ADDINS=[store_enclosures()])
+    addins.reinstall()
+    create_tables()
+    if options.uncached:
+        db.backend._statements = _NoCache()
+
+    feed = db.models.Feed()
+    feed.url = make_feed(options.items)
+    db.backend.add(feed)
+    db.backend.flush()
+    # the first update creates the items
+    parse.update_feed(feed)
+
+    profile = cProfile.Profile()
+    profile.runcall(lambda: [parse.update_feed(feed)
+                             for i in range(options.updates)])
+    stats = pstats.Stats(profile)
+
+    total = stats.total_tt
+    compile_time = compile_calls = 0
+    for (filename, line, func), (cc, nc, tt, ct, callers) in \
+            stats.stats.iteritems():
+        # Storm's compiler entry point may be implemented in C, and
+        # thus invisible to the profiler; every SELECT passes through
+        # this function, though.
+        if filename.endswith('expr.py') and func == 'compile_select':
+            compile_calls, compile_time = nc, ct
+
+    entries = options.items * options.updates
+    print 'updates: %d x %d entries' % (options.updates, options.items)
+    print 'total:           %8.1fms  (%.3fms per entry)' % (
+        total*1000, total*1000/entries)
+    print 'SELECT compiles: %8.1fms  (%d compiles, %.1f%% of total)' % (
+        compile_time*1000, compile_calls, compile_time/total*100)
+
+
+if __name__ == '__main__':
+    main()
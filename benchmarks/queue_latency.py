@@ -0,0 +1,98 @@
+"""Measures how long it takes ``provide_queue_daemon`` to start
+updating a feed once it is put on the queue, and how much CPU time
+the daemon uses while it has nothing to do.
+
+With a ``FeedQueue``, the daemon blocks without a timeout and is
+woken up by the queue itself; a plain ``Queue.Queue`` (``--plain``)
+has to be polled, which costs both latency and CPU, as in Python 2,
+waiting with a timeout means checking every few milliseconds.
+
+The feeds aren't actually fetched, so the numbers are only about the
+hand-over from the producer to the daemon.
+"""
+
+import os
+import time
+import Queue
+import logging
+import threading
+from optparse import OptionParser
+
+from feedplatform.lib import provide_queue_daemon
+from feedplatform.queues import FeedQueue
+from feedplatform.conf import config
+from feedplatform import db, addins, log
+
+
+class record_start(addins.base):
+    def __init__(self):
+        self.started = {}
+        self.event = threading.Event()
+    def on_before_parse(self, feed, parser_args):
+        self.started[feed.id] = time.time()
+        self.event.set()
+        # don't fetch anything
+        return True
+
+
+def cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--feeds', type='int', default=200,
+                      help='number of feeds to queue, one at a time')
+    parser.add_option('-i', '--idle', type='float', default=5,
+                      help='seconds to measure the idle CPU usage for')
+    parser.add_option('--plain', action='store_true',
+                      help='use a plain Queue.Queue holding the feeds')
+    options, args = parser.parse_args()
+
+    log.reset(level=logging.WARNING)
+    recorder = record_start()
+    config.configure(STORAGE_BACKEND=db.MemoryBackend, ADDINS=[recorder],
+                     DAEMON_STATS_INTERVAL=None)
+    addins.reinstall()
+    feeds = []
+    for i in range(options.feeds):
+        feed = db.models.Feed()
+        feed.url = u'http://example.org/%d' % i
+        db.backend.add(feed)
+        feeds.append(feed)
+    db.backend.commit()
+
+    queue = options.plain and Queue.Queue() or FeedQueue()
+    daemon = provide_queue_daemon(queue)
+    daemon.start(daemon=True)
+
+    latencies = []
+    for feed in feeds:
+        recorder.event.clear()
+        queued = time.time()
+        queue.put(feed)
+        recorder.event.wait()
+        latencies.append(recorder.started[feed.id] - queued)
+    latencies.sort()
+
+    before, start = cpu_time(), time.time()
+    time.sleep(options.idle)
+    idle_cpu = (cpu_time() - before) / (time.time() - start)
+
+    start = time.time()
+    daemon.stop()
+    daemon.join()
+    stop_time = time.time() - start
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+    print 'queue:         %s' % queue.__class__.__name__
+    print 'latency (ms):  p50=%.2f p90=%.2f p99=%.2f max=%.2f' % tuple(
+        [percentile(p) * 1000 for p in (0.5, 0.9, 0.99, 1)])
+    print 'idle CPU:      %.2f%%' % (idle_cpu * 100)
+    print 'stop (ms):     %.2f' % (stop_time * 1000)
+
+
+if __name__ == '__main__':
+    main()
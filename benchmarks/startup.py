@@ -0,0 +1,81 @@
+"""Measures the cold start of a process, up to and including the
+first ``update_feed`` call.
+
+Each run happens in a fresh interpreter, so that nothing is cached.
+Also reports which of the heavyweight optional modules ended up being
+imported - ideally, none of them are, unless an addin that needs them
+is installed.
+"""
+
+import os, sys
+import subprocess
+from optparse import OptionParser
+
+
+# Executed in the child process; prints the timings.
+CHILD_CODE = r"""
+import time, sys
+start = time.time()
+
+from feedplatform.lib import *
+from feedplatform.conf import config
+from feedplatform import db, parse, addins
+imported = time.time()
+
+config.configure(
+    STORAGE_BACKEND=db.MemoryBackend,
+    ADDINS=[collect_feed_data('title'), collect_item_data('title'),
+            store_enclosures(), handle_feed_images(), %(extra_addins)s])
+addins.reinstall()
+feed = db.models.Feed()
+configured = time.time()
+
+feed.url = u'<rss><channel><title>t</title>' \
+           u'<item><guid>1</guid><title>i</title></item></channel></rss>'
+db.backend.add(feed)
+db.backend.flush()
+parse.update_feed(feed)
+updated = time.time()
+
+heavy = [m for m in ('PIL', 'SocketServer', 'chardet', 'BeautifulSoup')
+         if m in sys.modules]
+print imported-start, configured-imported, updated-configured, \
+      ','.join(heavy) or '-'
+"""
+
+
+def run_child(extra_addins=''):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    proc = subprocess.Popen(
+        [sys.executable, '-c', CHILD_CODE % {'extra_addins': extra_addins}],
+        stdout=subprocess.PIPE, env=env)
+    output = proc.communicate()[0].strip().splitlines()[-1]
+    imported, configured, updated, heavy = output.split()
+    return float(imported), float(configured), float(updated), heavy
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--runs', type='int', default=10,
+                      help='number of processes to start')
+    parser.add_option('--addins', default='',
+                      help='additional addins to install, as Python code, '
+                           'e.g. "feed_image_thumbnails(((10,10),), \'/tmp\')"')
+    options, args = parser.parse_args()
+
+    results = [run_child(options.addins) for i in range(options.runs)]
+    for i, label in enumerate(('import', 'configure', 'first update')):
+        values = sorted([r[i] for r in results])
+        print '%-14s min %7.1fms   median %7.1fms' % (
+            label, values[0]*1000, values[len(values)//2]*1000)
+    totals = sorted([sum(r[:3]) for r in results])
+    print '%-14s min %7.1fms   median %7.1fms' % (
+        'total', totals[0]*1000, totals[len(totals)//2]*1000)
+    print 'heavy modules imported: %s' % results[-1][3]
+
+
+if __name__ == '__main__':
+    main()
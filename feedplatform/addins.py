@@ -120,6 +120,10 @@ def get_addins():
     return _ADDINS
 
 
+# Addin classes that were already verified to be constructible
+# without arguments; see ``_make_addin``.
+_CONSTRUCTIBLE = set()
+
 def _make_addin(addin):
     """Normalizes addin's given by the user - makes sure an instance
     is returned.
@@ -128,6 +132,8 @@ def _make_addin(addin):
     Otherwise, an error is raised, or ``addin`` is returned unmodified.
     """
     if isinstance(addin, type):
+        if addin in _CONSTRUCTIBLE:
+            return addin()
         if not addin.__init__ is object.__init__: # won't work with getargspec
             args, _, _, defaults = inspect.getargspec(addin.__init__)
             # for method types, the first argument will be the
@@ -141,6 +147,7 @@ def _make_addin(addin):
                     'rather than an instance, but requires arguments '
                     'to be constructed.' % addin.__name__)
 
+        _CONSTRUCTIBLE.add(addin)
         addin = addin()
     return addin
 
@@ -15,6 +15,22 @@ Example Usage:
     except QueueSystemError, e:
         print "We did something wrong: %s", e.message
 
+To send many feeds, use ``send_many``, which sends them all over a
+single connection, without waiting for each response in turn:
+
+    for feed, error in zip(feeds, send_many(address, feeds)):
+        if error:
+            ...
+
+If you are sending feeds regularly, you may also keep a
+``QueueConnection`` around; it connects when needed, and reconnects
+if the connection was lost:
+
+    connection = QueueConnection('/var/run/feedplatform.ping')
+    connection.send('http://example.org/news.xml')
+    connection.send_many([1, 2, 3])
+    connection.close()
+
 You can choose not to catch system errors, for example, e.g. instead
 letting your logging system deal with it.
 
@@ -30,7 +46,8 @@ this a static method of the ``provide_socket_queue_controller`` addin:
 import socket
 
 
-__all__ = ('send_to_queue', 'QueueError', 'QueueUserError', 'QueueSystemError',)
+__all__ = ('send_to_queue', 'send_many', 'QueueConnection', 'QueueError',
+           'QueueUserError', 'QueueSystemError',)
 
 
 class QueueError(Exception):
@@ -43,29 +60,137 @@ class QueueSystemError(QueueError):
     pass
 
 
-def send_to_queue(address, feed_id_or_url):
-    s = socket.socket(isinstance(address, basestring) \
-                            and socket.AF_UNIX or socket.AF_INET)
+def _make_error(response):
+    """Return the exception for the given response line, or ``None``
+    if it indicates success.
+    """
     try:
+        code, msg = response.split(' ', 1)
+        code = int(code)
+    except ValueError:
+        return QueueSystemError('Invalid response from bot: %s' % response)
+    if 200 <= code < 400:
+        return None
+    elif code == 404:
+        error = QueueUserError('The requested feed was not found')
+    else:
+        error = QueueSystemError('Bot was unable to handle the request: %s' % msg)
+    error.code = code
+    return error
+
+
+class QueueConnection(object):
+    """A connection to the queue controller at ``address``, which can
+    be used for any number of requests.
+
+    ``window`` is the number of requests ``send_many`` sends ahead
+    before reading the responses.
+    """
+
+    def __init__(self, address, timeout=None, window=100):
+        self.address = address
+        self.timeout = timeout
+        self.window = window
+        self.socket = None
+        self.rfile = None
+
+    def connect(self):
+        if self.socket is not None:
+            return
+        s = socket.socket(isinstance(self.address, basestring) \
+                                and socket.AF_UNIX or socket.AF_INET)
+        s.settimeout(self.timeout)
         try:
-            s.connect(address)
+            s.connect(self.address)
         except socket.error, msg:
+            s.close()
             raise QueueSystemError('Unable to connect to bot, try again later')
-        else:
-            s.send("%s\n" % feed_id_or_url)
-            response = s.recv(1024)
-            code, msg = response.split(' ', 1)
-            try:
-                code = int(code)
-            except ValueError:
-                raise QueueSystemError('Invalid response code from bot: %s' % code)
-            if 200 <= code < 400:
-                return
-            elif code == 404:
-                error = QueueUserError('The requested feed was not found')
-            elif code >= 500:
-                error = QueueSystemError('Bot was unable to handle the request: %s' % msg)
-            error.code = code
+        self.socket = s
+        self.rfile = s.makefile('rb')
+
+    def close(self):
+        if self.socket is not None:
+            self.rfile.close()
+            self.socket.close()
+            self.socket = self.rfile = None
+
+    def send(self, feed_id_or_url, priority=None, deadline=None):
+        """Put a feed on the queue; raises a ``QueueError`` if that
+        fails.
+
+        ``priority`` and ``deadline`` are used if the bot's queue
+        supports them; see ``provide_socket_queue_controller``.
+        """
+        error = self.send_many([feed_id_or_url], priority, deadline)[0]
+        if error:
             raise error
+
+    def send_many(self, feeds, priority=None, deadline=None):
+        """Put each of the given feeds on the queue. Returns a list
+        with an item for each feed, either ``None`` or the
+        ``QueueError`` that occured for it.
+
+        Raises ``QueueSystemError`` only if talking to the bot fails
+        altogether.
+        """
+        options = ''
+        if priority is not None:
+            options += ' priority=%s' % priority
+        if deadline is not None:
+            options += ' deadline=%s' % deadline
+        feeds = ['%s%s' % (self._encode(f), options) for f in feeds]
+        results = []
+        reused = self.socket is not None
+        try:
+            self._send_many(feeds, results)
+        except QueueSystemError:
+            # the bot may have closed an idle connection; try once more
+            if not reused or results:
+                raise
+            self._send_many(feeds, results)
+        return results
+
+    def _send_many(self, feeds, results):
+        self.connect()
+        try:
+            for i in range(0, len(feeds), self.window):
+                batch = feeds[i:i+self.window]
+                self.socket.sendall(''.join(["%s\n" % f for f in batch]))
+                for feed in batch:
+                    response = self.rfile.readline()
+                    if not response:
+                        raise QueueSystemError('Connection closed by bot')
+                    results.append(_make_error(response.strip()))
+        except (socket.error, QueueSystemError), e:
+            # we don't know what state the connection is in
+            self.close()
+            if isinstance(e, QueueSystemError):
+                raise
+            raise QueueSystemError('Unable to talk to bot: %s' % e)
+
+    def _encode(self, feed_id_or_url):
+        if isinstance(feed_id_or_url, unicode):
+            feed_id_or_url = feed_id_or_url.encode('utf8')
+        return str(feed_id_or_url).replace('\n', '')
+
+    def __del__(self):
+        self.close()
+
+
+def send_to_queue(address, feed_id_or_url, priority=None, deadline=None):
+    connection = QueueConnection(address)
+    try:
+        connection.send(feed_id_or_url, priority, deadline)
+    finally:
+        connection.close()
+
+
+def send_many(address, feeds, priority=None, deadline=None):
+    """Like ``send_to_queue``, but for many feeds at once, which are
+    sent over a single connection. See ``QueueConnection.send_many``.
+    """
+    connection = QueueConnection(address)
+    try:
+        return connection.send_many(feeds, priority, deadline)
     finally:
-        s.close()
\ No newline at end of file
+        connection.close()
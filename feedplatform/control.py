@@ -0,0 +1,248 @@
+"""The control channel of a running daemon, through which the
+``control`` command inspects and steers it.
+"""
+
+import os
+import errno
+import threading
+
+from feedplatform import db
+from feedplatform import util
+from feedplatform.conf import config
+
+
+__all__ = ('ControlServer', 'send_command',)
+
+
+class ControlServer(threading.Thread):
+    """Lets ``daemon`` be inspected and controlled while it runs,
+    through a socket at ``address``: a (host, port) tuple, or the
+    filename of a UNIX socket. The ``start`` command runs one if the
+    DAEMON_CONTROL_ADDRESS setting is given, and ``control`` talks to
+    it.
+
+    Like with the ``provide_socket_queue_controller`` addin, each
+    request is a line, and each response starts with a status line
+    ("CODE MSG"). It is followed by any data the command returns, one
+    item per line, and ends with an empty line. The commands are:
+
+        status          whether the daemon is paused, the number of
+                        workers and of feeds being updated
+        pause           stop updating feeds; those under way are
+                        completed
+        resume          continue after ``pause``
+        workers N       change the number of worker threads (see
+                        ``base_daemon.set_workers``)
+        in-flight       the feeds currently being updated, one per
+                        line: id, stage (see ``parse.UpdateProgress``),
+                        seconds elapsed and url
+        slowest         the slowest updates of about the last hour,
+                        with the time spent in each stage, if the
+                        DAEMON_SLOWEST_FEEDS setting is given
+        update FEED     update the feed with the given id or url right
+                        away, even if paused, and report the result
+        help            list the commands
+
+    The codes are the same as with the queue controller: 200 for
+    success, 304 if there was nothing to do, 400 for invalid requests,
+    404 if a feed does not exist, and 500 for errors.
+
+    Updates requested through ``update`` run in the connection's own
+    thread, with a database connection of its own (as long as the
+    DATABASE setting is used), and observe the per-host limits like
+    the daemon's workers do.
+    """
+
+    class ControlHandler:
+        """Implements the protocol; a classic class, to be combined
+        with ``SocketServer.StreamRequestHandler``, see
+        ``daemons.provide_socket_queue_controller``.
+        """
+
+        def handle(self):
+            while not self.server.stop_event.isSet():
+                line = self.rfile.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                status, lines = self.handle_line(line)
+                self.wfile.write(''.join(['%s\n' % l for l in
+                                          [status] + lines + ['']]))
+
+        def handle_line(self, line):
+            parts = line.split()
+            command, args = parts[0].lower(), parts[1:]
+            method = getattr(self, 'do_%s' % command.replace('-', '_'),
+                             None)
+            if method is None:
+                return '400 Unknown command: %s' % command, []
+            if len(args) != method.im_func.func_code.co_argcount - 1:
+                return '400 Wrong number of arguments for %s' % command, []
+            try:
+                return method(*args)
+            except Exception, e:
+                self.server.log.exception('Control command failed: %s' % line)
+                return '500 %s' % e, []
+
+        def do_help(self):
+            return '200 Commands:', ['status', 'pause', 'resume',
+                                     'workers N', 'in-flight', 'slowest',
+                                     'update FEED', 'help']
+
+        def do_status(self):
+            daemon = self.server.daemon
+            return '200 %s, workers=%s, in flight=%d' % (
+                daemon.paused and 'paused' or 'running',
+                getattr(daemon, 'workers', 1),
+                len(daemon.get_in_flight())), []
+
+        def do_pause(self):
+            if self.server.daemon.paused:
+                return '304 Already paused', []
+            self.server.daemon.pause()
+            return '200 Paused', []
+
+        def do_resume(self):
+            if not self.server.daemon.paused:
+                return '304 Not paused', []
+            self.server.daemon.resume()
+            return '200 Resumed', []
+
+        def do_workers(self, count):
+            if not count.isdigit():
+                return '400 Not a number: %s' % count, []
+            try:
+                self.server.daemon.set_workers(int(count))
+            except ValueError, e:
+                return '400 %s' % e, []
+            return '200 Running %s workers' % count, []
+
+        def do_in_flight(self):
+            in_flight = self.server.daemon.get_in_flight()
+            return '200 %d feeds in flight' % len(in_flight), [
+                '#%s %s %.1fs %s' % (p.feed_id, p.stage, p.elapsed,
+                                     p.url.encode('utf8'))
+                for p in in_flight]
+
+        def do_slowest(self):
+            slowest = self.server.daemon.slowest_feeds
+            if slowest is None:
+                return '304 DAEMON_SLOWEST_FEEDS is not configured', []
+            updates = slowest.get()
+            return '200 %d slowest updates' % len(updates), [
+                '#%s %s, %s' % (p.feed_id, p.summary(), p.url.encode('utf8'))
+                for p in updates]
+
+        def do_update(self, feed):
+            if config.DATABASE:
+                db.use_thread_store()
+            try:
+                if feed.isdigit():
+                    feed = db.backend.get_feed(int(feed))
+                else:
+                    feed = db.get_one(db.backend.find_feeds(
+                        unicode(feed, 'utf8')))
+                if not feed:
+                    return '404 Feed not found', []
+                feed_id = feed.id
+                try:
+                    progress = self.server.daemon.update_feed(
+                        feed, ignore_pause=True)
+                except Exception, e:
+                    return '500 Updating feed #%d failed: %s' % (
+                        feed_id, e), []
+                if progress.skipped:
+                    return '200 Feed #%d skipped by addin, at %s' % (
+                        feed_id, progress.stage), []
+                return '200 Updated feed #%d in %.2fs: status %s, %d new ' \
+                       'item(s)' % (feed_id, progress.elapsed, progress.status,
+                                  progress.items_created), []
+            finally:
+                feed = None
+                if config.DATABASE:
+                    db.close_thread_store()
+
+    def __init__(self, daemon, address, log=None):
+        super(ControlServer, self).__init__()
+        self.setDaemon(True)
+        self.daemon = daemon
+        self.address = address
+        self.log = log or daemon.log
+        self.stop_event = util.Event()
+        self.ready = threading.Event()
+        self.server = None
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        import SocketServer, select
+        class handler_class(ControlServer.ControlHandler,
+                            SocketServer.StreamRequestHandler):
+            pass
+
+        try:
+            if isinstance(self.address, basestring):
+                if os.path.exists(self.address):
+                    os.unlink(self.address)
+                server_class = SocketServer.ThreadingUnixStreamServer
+            else:
+                server_class = SocketServer.ThreadingTCPServer
+            self.server = server_class(self.address, handler_class)
+        finally:
+            self.ready.set()
+        server = self.server
+        try:
+            server.daemon = self.daemon
+            server.log = self.log
+            server.stop_event = self.stop_event
+            server.daemon_threads = True
+            while not self.stop_event.isSet():
+                r,w,e = select.select([server.socket, self.stop_event],
+                                      [], [])
+                if server.socket in r:
+                    server.handle_request()
+        finally:
+            server.server_close()
+            if isinstance(self.address, basestring):
+                try:
+                    os.unlink(self.address)
+                except OSError, e:
+                    # someone else may have cleaned up already
+                    if e.errno != errno.ENOENT:
+                        raise
+
+
+def send_command(address, command, timeout=None):
+    """Send ``command`` to the ``ControlServer`` at ``address``, and
+    return the response as a tuple of (code, message, lines).
+    """
+    import socket
+    if isinstance(address, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+        sock.sendall('%s\n' % command)
+        f = sock.makefile('rb')
+        status = f.readline().rstrip('\n')
+        lines = []
+        while True:
+            line = f.readline()
+            if not line:
+                raise IOError('connection closed before the response '
+                              'was complete')
+            line = line.rstrip('\n')
+            if not line:
+                break
+            lines.append(line)
+    finally:
+        sock.close()
+    code, _, message = status.partition(' ')
+    if not code.isdigit():
+        raise IOError('invalid response: %s' % status)
+    return int(code), message, lines
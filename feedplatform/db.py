@@ -1,20 +1,34 @@
 """Sets up the database, models, connections etc. based on the
 user's configuration file.
 
-The Storm ORM is used as the backend.
+The Storm ORM is used to define the models, and by default, to store
+them. However, the core and the builtin addins do not talk to the
+Storm store directly, but rather go through a narrow storage backend
+interface, available as ``backend``. See ``StormBackend`` for the
+operations it supports. This makes it possible to plug in backends
+optimized for specific use cases, like ``MemoryBackend``, without
+touching any addins (see the STORAGE_BACKEND setting).
 """
 
 import sys
 import re
 import copy
+import uuid
+import threading
 
 from storm.locals import *
 from storm.store import ResultSet as StormResultSet
+from storm.expr import State
+from storm.info import get_cls_info
+from storm.cache import Cache
 
 from feedplatform.conf import config
+from feedplatform import log
 
 
-__all__ = ('store', 'database', 'models',
+__all__ = ('store', 'database', 'models', 'backend',
+           'StormBackend', 'MemoryBackend',
+           'use_thread_store', 'close_thread_store', 'reset_after_fork',
            'MultipleObjectsReturned', 'get_one')
 
 
@@ -79,6 +93,7 @@ uncap_model_name.expr = re.compile(r'(?<!^)(((?<=[a-z])[A-Z])|([A-Z](?![A-Z]|$))
 database = None
 store = None
 models = None
+backend = None
 
 
 class DatabaseProxy(object):
@@ -112,6 +127,461 @@ class DatabaseProxy(object):
         return setattr(self.obj, name, value)
 
 
+class StoreProxy(DatabaseProxy):
+    """Like ``DatabaseProxy``, but a thread may choose to use a store
+    of its own rather than the shared one, see ``use_thread_store``.
+    """
+
+    def __init__(self, create_func):
+        super(StoreProxy, self).__init__(create_func)
+        self.__dict__['local'] = threading.local()
+
+    def _get_store(self):
+        thread_store = getattr(self.local, 'store', None)
+        if thread_store is not None:
+            return thread_store
+        self._connect()
+        return self.obj
+
+    def __getattr__(self, name):
+        return getattr(self._get_store(), name)
+
+    def __setattr__(self, name, value):
+        return setattr(self._get_store(), name, value)
+
+
+def use_thread_store():
+    """Give the current thread a store of its own, which from now on
+    will be used whenever the thread accesses ``store`` (and thus,
+    the default storage backend).
+
+    This is what allows feeds to be updated in multiple threads at
+    once. Note that objects must then not be passed between threads;
+    rather, pass primary keys, and load the objects in the thread
+    that uses them.
+
+    Call ``close_thread_store`` when the thread is done.
+    """
+    if not config.DATABASE:
+        raise ValueError('The database is not configured (see '
+            'the DATABASE setting)')
+    store.local.store = Store(database, cache=Cache(config.STORE_CACHE_SIZE))
+
+
+def reset_after_fork():
+    """Forget the database connection and stores, without closing
+    them, so that a process forked off from one that used them opens
+    a connection of its own, rather than sharing the parent's.
+    """
+    for proxy in (database, store, backend):
+        proxy.__dict__['obj'] = None
+    store.__dict__['local'] = threading.local()
+
+
+def close_thread_store():
+    """Close the store of the current thread, and return to using the
+    shared one.
+    """
+    thread_store = getattr(store.local, 'store', None)
+    if thread_store is not None:
+        del store.local.store
+        thread_store.close()
+
+
+class BackendProxy(DatabaseProxy):
+    """Like ``DatabaseProxy``, but for the storage backend.
+
+    Only if the default Storm backend is used do we require a
+    database connection to be configured.
+    """
+
+    def _connect(self):
+        if not self.obj:
+            self.__dict__['obj'] = self.create_func()
+
+
+class StormBackend(object):
+    """The default storage backend, storing models using the Storm
+    store (``feedplatform.db.store``).
+
+    Defines the interface every backend needs to implement. Objects
+    passed around are always instances of the models in ``models``.
+
+    Note that there is no explicit update operation: Changes to
+    objects that were previously added, or returned by the backend,
+    will be saved on the next ``flush``.
+    """
+
+    # Max. number of parameters we pass to a single query. SQLite for
+    # example doesn't support more than 999 by default.
+    max_query_params = 512
+
+    def __init__(self, store):
+        self.store = store
+        self._statements = {}
+        self._compiled_find = None
+
+    def _find(self, key, cls, params, build_where):
+        """Return a list of the ``cls`` objects matching the where
+        clause returned by ``build_where``, using a precompiled
+        statement if possible (see ``_find_compiled``).
+
+        That relies on Storm internals; if this version of Storm
+        doesn't have them, we fall back to a regular ``store.find``.
+        """
+        if self._compiled_find is None:
+            self._compiled_find = self._can_compile()
+            if not self._compiled_find:
+                log.get('db').warning('Cannot use precompiled statements '
+                    'with this version of Storm, falling back to '
+                    'store.find()')
+        if self._compiled_find:
+            return self._find_compiled(key, cls, params, build_where)
+        return list(self.store.find(cls, build_where()))
+
+    def _can_compile(self):
+        """Check for the Storm internals ``_find_compiled`` uses.
+        """
+        return hasattr(StormResultSet, '_get_select') and \
+               hasattr(Store, '_load_object') and \
+               hasattr(getattr(self.store, '_connection', None), 'compile')
+
+    def _find_compiled(self, key, cls, params, build_where):
+        """Return a list of the ``cls`` objects matching the where
+        clause returned by ``build_where``.
+
+        The queries run during an update are always the same, only the
+        values change. Rather than building a new expression and
+        compiling it to SQL every time, we do so only once per ``key``
+        and ``cls`` (the latter changes with the model configuration),
+        and from then on only bind ``params`` to the statement. This
+        also means that the SQL text stays identical, which allows the
+        database driver to reuse its prepared statement (the sqlite3
+        module for example keeps a cache).
+
+        ``params`` is a list of Storm variables, and needs to match
+        the parameters in the compiled clause, in order.
+        ``build_where`` is only called when no statement is cached.
+        """
+        statement = self._statements.get((key, cls))
+        if statement is None:
+            select = self.store.find(cls, build_where())._get_select()
+            state = State()
+            statement = self.store._connection.compile(select, state)
+            if len(state.parameters) != len(params):
+                raise ValueError('%s: expected %d parameters, got %d' % (
+                    key, len(state.parameters), len(params)))
+            self._statements[(key, cls)] = statement
+
+        cls_info = get_cls_info(cls)
+        result = self.store.execute(statement, params)
+        return [self.store._load_object(cls_info, result, values)
+                for values in result]
+
+    def get_feed(self, feed_id):
+        """Return the feed with the given primary key, or ``None``.
+        """
+        return self.store.get(models.Feed, feed_id)
+
+    def find_feeds(self, url):
+        """Return a list of all feeds that use ``url``.
+        """
+        return list(self.store.find(models.Feed, models.Feed.url == url))
+
+    def find_feed_ids(self, feed_ids):
+        """Return the set of those of ``feed_ids`` that belong to an
+        existing feed, without loading the feeds.
+        """
+        result = set()
+        feed_ids = list(feed_ids)
+        Feed = models.Feed
+        for i in xrange(0, len(feed_ids), self.max_query_params):
+            chunk = feed_ids[i:i+self.max_query_params]
+            found = self.store.find(Feed, Feed.id.is_in(chunk))
+            result.update(found.values(Feed.id))
+        return result
+
+    def iter_feeds(self, select=None):
+        """Iterate over all feeds.
+
+        Only the ids are queried upfront; each feed is then loaded
+        individually. SQLite, for example, won't let us update a row
+        while it is still part of an open result set.
+
+        If given, ``select`` is called with the id and url of each feed,
+        and only those feeds for which it returns ``True`` are loaded.
+        """
+        Feed = models.Feed
+        if select is None:
+            ids = list(self.store.find(Feed).values(Feed.id))
+        else:
+            ids = [feed_id for feed_id, url in
+                   self.store.find(Feed).values(Feed.id, Feed.url)
+                   if select(feed_id, url)]
+        for feed_id in ids:
+            feed = self.get_feed(feed_id)
+            # may have been deleted in the meantime
+            if feed is not None:
+                yield feed
+
+    def claim_feeds(self, owner, count, now, until):
+        """Claim up to ``count`` feeds whose lease has expired at
+        ``now`` (or that never had one) for ``owner``, until ``until``,
+        and return them.
+
+        The candidates are selected first, then claimed by an UPDATE
+        that repeats the condition, so that two processes can never
+        claim the same feed. A subquery would save the extra query,
+        but MySQL supports neither LIMIT in it, nor one on the table
+        being updated. The claimed feeds are marked with a token unique
+        to this call, and read back by it, before ``claimed_by`` is
+        set to ``owner``; comparing ``lease_expires`` instead fails if
+        the database doesn't store microseconds.
+
+        Requires the ``claimed_by`` and ``lease_expires`` fields, as
+        added by ``provide_lease_daemon``. The caller needs to commit.
+        """
+        Feed = models.Feed
+        # Take the write lock before reading; otherwise, in databases
+        # that lock the whole table, like SQLite, two processes reading
+        # at the same time would wait for each other to finish.
+        self.store.find(Feed, Feed.id == None).set(claimed_by=None)
+        due = Or(Feed.lease_expires == None, Feed.lease_expires <= now)
+        ids = list(self.store.find(Feed, due).order_by(
+            Feed.lease_expires, Feed.id)[:count].values(Feed.id))
+        if not ids:
+            return []
+        token = u'%s/%s' % (owner, uuid.uuid4().hex)
+        self.store.find(Feed, Feed.id.is_in(ids), due).set(
+            claimed_by=token, lease_expires=until)
+        feeds = list(self.store.find(Feed, Feed.claimed_by == token))
+        self.store.find(Feed, Feed.claimed_by == token).set(
+            claimed_by=owner)
+        return feeds
+
+    def renew_leases(self, owner, feed_ids, until):
+        """Extend the leases ``owner`` holds on the given feeds to
+        ``until``. Leases that were lost are not renewed.
+        """
+        Feed = models.Feed
+        self.store.find(Feed, Feed.id.is_in(list(feed_ids)),
+                        Feed.claimed_by == owner).set(lease_expires=until)
+
+    def release_feeds(self, owner, feed_ids, due=None):
+        """Give up the leases ``owner`` holds on the given feeds. They
+        can be claimed again from ``due`` on, or right away.
+        """
+        Feed = models.Feed
+        self.store.find(Feed, Feed.id.is_in(list(feed_ids)),
+                        Feed.claimed_by == owner).set(
+            claimed_by=None, lease_expires=due)
+
+    def get_items(self, feed, guids):
+        """Resolve the given ``guids`` to the items of ``feed``.
+
+        Returns a dict that maps each guid to a list of the matching
+        items - normally, there will be only one. guids that do not
+        exist are missing from the result.
+        """
+        result = {}
+        guids = list(guids)
+        Item = models.Item
+        for i in xrange(0, len(guids), self.max_query_params):
+            chunk = guids[i:i+self.max_query_params]
+            # Only ever use a power of two number of parameters, padding
+            # the list with a repeated guid, so that we get by with a
+            # handful of different statements.
+            size = 1
+            while size < len(chunk):
+                size *= 2
+            chunk += chunk[-1:] * (size - len(chunk))
+
+            params = [Item.feed_id.variable_factory(value=feed.id)] + \
+                     [Item.guid.variable_factory(value=g) for g in chunk]
+            for item in self._find(('get_items', size), Item, params,
+                                   lambda: And(Item.feed_id == feed.id,
+                                               Item.guid.is_in(chunk))):
+                result.setdefault(item.guid, []).append(item)
+        return result
+
+    def get_enclosures(self, item):
+        """Return a list of all enclosures of ``item``.
+        """
+        Enclosure = models.Enclosure
+        params = [Enclosure.item_id.variable_factory(value=item.id)]
+        return self._find('get_enclosures', Enclosure, params,
+                          lambda: Enclosure.item_id == item.id)
+
+    def add(self, obj):
+        """Add a new object; it will be inserted on the next flush.
+        """
+        self.store.add(obj)
+
+    def remove(self, obj):
+        """Delete ``obj``.
+        """
+        self.store.remove(obj)
+
+    def flush(self):
+        """Write all pending changes, assigning primary keys to new
+        objects.
+        """
+        self.store.flush()
+
+    def commit(self):
+        self.store.commit()
+
+    def rollback(self):
+        """Discard all changes since the last commit.
+        """
+        self.store.rollback()
+
+    def release(self):
+        """Let go of objects that are no longer needed, so that they
+        can be garbage collected. Long-running processes call this
+        between feeds, after committing.
+
+        Objects still referenced elsewhere remain valid.
+        """
+        self.store._cache.clear()
+
+    def get_stats(self):
+        """Return a dict of statistics about the backend, like the
+        number of objects it currently holds.
+        """
+        return {'store_cache_size': len(self.store._cache.get_cached()),
+                'store_alive_objects': len(self.store._alive)}
+
+
+class MemoryBackend(object):
+    """A storage backend that keeps all objects in memory.
+
+    Useful for benchmarks, tests, and for one-off jobs like syncing
+    a single feed, where no database is needed. The Storm models are
+    still used, but are never added to a store - which also means
+    that only references that are explicitly assigned (as opposed to
+    only setting the foreign key) will work, and reference sets, e.g.
+    ``feed.items``, are not available at all.
+
+    Objects are indexed when they are flushed, so the attributes used
+    for lookups (the feed url, the item guid, the parents) should not
+    change afterwards.
+    """
+
+    def __init__(self):
+        self._rows = {}        # table name -> {id -> object}
+        self._next_id = {}     # table name -> next free primary key
+        self._pending = []
+        self._items = {}       # (feed_id, guid) -> list of items
+        self._enclosures = {}  # item_id -> list of enclosures
+
+    def _table(self, obj):
+        return obj.__storm_table__
+
+    def get_feed(self, feed_id):
+        return self._rows.get('feed', {}).get(feed_id)
+
+    def find_feeds(self, url):
+        return [f for f in self._rows.get('feed', {}).itervalues()
+                if f.url == url]
+
+    def find_feed_ids(self, feed_ids):
+        feeds = self._rows.get('feed', {})
+        return set([i for i in feed_ids if i in feeds])
+
+    def iter_feeds(self, select=None):
+        for feed_id in sorted(self._rows.get('feed', {}).keys()):
+            feed = self.get_feed(feed_id)
+            if feed is not None and \
+               (select is None or select(feed.id, feed.url)):
+                yield feed
+
+    def claim_feeds(self, owner, count, now, until):
+        due = [f for f in self._rows.get('feed', {}).itervalues()
+               if f.lease_expires is None or f.lease_expires <= now]
+        due.sort(key=lambda f: (f.lease_expires, f.id))
+        for feed in due[:count]:
+            feed.claimed_by, feed.lease_expires = owner, until
+        return due[:count]
+
+    def renew_leases(self, owner, feed_ids, until):
+        for feed_id in feed_ids:
+            feed = self.get_feed(feed_id)
+            if feed is not None and feed.claimed_by == owner:
+                feed.lease_expires = until
+
+    def release_feeds(self, owner, feed_ids, due=None):
+        for feed_id in feed_ids:
+            feed = self.get_feed(feed_id)
+            if feed is not None and feed.claimed_by == owner:
+                feed.claimed_by, feed.lease_expires = None, due
+
+    def get_items(self, feed, guids):
+        result = {}
+        for guid in guids:
+            items = self._items.get((feed.id, guid))
+            if items:
+                result[guid] = list(items)
+        return result
+
+    def get_enclosures(self, item):
+        return list(self._enclosures.get(item.id, ()))
+
+    def add(self, obj):
+        if not obj in self._pending:
+            self._pending.append(obj)
+
+    def remove(self, obj):
+        if obj in self._pending:
+            self._pending.remove(obj)
+            return
+        self._rows.get(self._table(obj), {}).pop(obj.id, None)
+        for index in (self._items, self._enclosures):
+            for objs in index.itervalues():
+                if obj in objs:
+                    objs.remove(obj)
+
+    def flush(self):
+        for obj in self._pending:
+            table = self._table(obj)
+            if obj.id is None:
+                obj.id = self._next_id.get(table, 1)
+            self._next_id[table] = max(self._next_id.get(table, 1), obj.id+1)
+            self._rows.setdefault(table, {})[obj.id] = obj
+
+            if table == models.Item.__storm_table__:
+                self._items.setdefault((obj.feed_id, obj.guid), []).append(obj)
+            elif hasattr(models, 'Enclosure') and \
+                 table == models.Enclosure.__storm_table__:
+                self._enclosures.setdefault(obj.item_id, []).append(obj)
+        self._pending = []
+
+    def commit(self):
+        self.flush()
+
+    def rollback(self):
+        # changes to objects are not tracked, so this can only
+        # discard objects that were never flushed
+        self._pending = []
+
+    def release(self):
+        # everything we hold is our data
+        pass
+
+    def get_stats(self):
+        return {'objects': sum([len(rows) for rows in self._rows.values()])}
+
+
+def _create_backend():
+    backend = config.STORAGE_BACKEND
+    if backend is None:
+        return StormBackend(store)
+    # may be given as a class or factory
+    if callable(backend):
+        backend = backend()
+    return backend
+
+
 # Note how all columns are given as a tuple to be generated dynamically.
 # For some types like ``Reference`` this is quite important, since the
 # instance itself hooks up with the models it is used with - links that
@@ -131,6 +601,30 @@ BASE_MODELS = {
 }
 
 
+# Model classes that have previously been built, by a key identifying
+# the blueprints they were built from. Allows us to skip the work when
+# the models are reconstructed without anything having changed, e.g.
+# on ``reconfigure()``, or when addins are reinstalled.
+_MODEL_CACHE = {}
+_MODEL_CACHE_SIZE = 20
+
+def _get_models_cache_key(blueprints):
+    """Return a key for ``blueprints`` that can be used with the model
+    cache, or ``None`` if they can't be cached.
+
+    The latter is the case when any field is given as an instance
+    rather than a creation tuple, since those instances bind to the
+    model class they are used with.
+    """
+    key = []
+    for name, fields in sorted(blueprints.items()):
+        for field_name, field_value in sorted(fields.items()):
+            if not isinstance(field_value, tuple):
+                return None
+        key.append((name, sorted(fields.items())))
+    return repr((key, sorted(config.TABLES.items())))
+
+
 import types
 
 class ModelsProxy(types.ModuleType):
@@ -187,6 +681,14 @@ class ModelsProxy(types.ModuleType):
         # like "PropertyPathError: Path 'feed_id' matches multiple properties".
         Storm._storm_property_registry.clear()
 
+        # if we have built these exact models before, reuse them
+        cache_key = _get_models_cache_key(blueprints)
+        if cache_key in _MODEL_CACHE:
+            self._models = _MODEL_CACHE[cache_key]
+            for model in self._models.itervalues():
+                Storm._storm_property_registry.add_class(model)
+            return
+
         # create the actual model objects
         new_models = {}
         for name, fields in blueprints.items():
@@ -217,6 +719,10 @@ class ModelsProxy(types.ModuleType):
                 raise ValueError('Failed to process TABLES setting: '
                     '"%s" is not a valid model name' % model_name)
 
+        if cache_key is not None:
+            if len(_MODEL_CACHE) >= _MODEL_CACHE_SIZE:
+                _MODEL_CACHE.clear()
+            _MODEL_CACHE[cache_key] = new_models
         self._models = new_models
 
 
@@ -241,7 +747,12 @@ def reconfigure():
     # when someone first attempts to use the objects.
     global database, store
     database = DatabaseProxy(lambda: create_database(config.DATABASE))
-    store = DatabaseProxy(lambda: Store(database))
+    store = StoreProxy(lambda: Store(database,
+                                     cache=Cache(config.STORE_CACHE_SIZE)))
+
+    # The storage backend that should be used for all model access.
+    global backend
+    backend = BackendProxy(_create_backend)
 
     # Setup a proxy to the models. We can't build them directly, since
     # we are not allowed to access the config at this point.
@@ -76,6 +76,7 @@ SANITIZE_HTML = 1
 
 # ---------- required modules (should come with any Python distribution) ----------
 import sgmllib, re, sys, copy, urlparse, time, rfc822, types, cgi, urllib, urllib2
+import codecs
 try:
     from cStringIO import StringIO as _StringIO
 except:
@@ -129,15 +130,27 @@ try:
 except:
     pass
 
+# Some of the optional modules below are expensive to import, and only
+# needed for certain feeds; they are imported on first use.
+_optional_modules = {}
+def _import_optional(name):
+    '''Import and return an optional module, or None if not available'''
+    if not _optional_modules.has_key(name):
+        try:
+            _optional_modules[name] = __import__(name)
+        except:
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
 # chardet library auto-detects character encodings
 # Download from http://chardet.feedparser.org/
-try:
-    import chardet
-    if _debug:
+# (imported on first use)
+def _import_chardet():
+    chardet = _import_optional('chardet')
+    if chardet and _debug:
         import chardet.constants
         chardet.constants._debug = 1
-except:
-    chardet = None
+    return chardet
 
 # reversable htmlentitydefs mappings for Python 2.2
 try:
@@ -156,10 +169,7 @@ except:
 # feedparser is tested with BeautifulSoup 3.0.x, but it might work with the
 # older 2.x series.  If it doesn't, and you can figure out why, I'll accept a
 # patch and modify the compatibility statement accordingly.
-try:
-    import BeautifulSoup
-except:
-    BeautifulSoup = None
+# (imported on first use)
 
 # ---------- don't touch these ----------
 class ThingsNobodyCaresAboutButMe(Exception): pass
@@ -167,6 +177,9 @@ class CharacterEncodingOverride(ThingsNobodyCaresAboutButMe): pass
 class CharacterEncodingUnknown(ThingsNobodyCaresAboutButMe): pass
 class NonXMLContentType(ThingsNobodyCaresAboutButMe): pass
 class UndeclaredNamespace(Exception): pass
+class DownloadLimitExceeded(IOError): pass
+class ResponseTooLarge(DownloadLimitExceeded): pass
+class DownloadTimeout(DownloadLimitExceeded): pass
 
 sgmllib.tagfind = re.compile('[a-zA-Z][-_.:a-zA-Z0-9]*')
 sgmllib.special = re.compile('<!')
@@ -1861,7 +1874,7 @@ class _MicroformatsParser:
     known_binary_extensions =  ['zip','rar','exe','gz','tar','tgz','tbz2','bz2','z','7z','dmg','img','sit','sitx','hqx','deb','rpm','bz2','jar','rar','iso','bin','msi','mp2','mp3','ogg','ogm','mp4','m4v','m4a','avi','wma','wmv']
 
     def __init__(self, data, baseuri, encoding):
-        self.document = BeautifulSoup.BeautifulSoup(data)
+        self.document = _import_optional('BeautifulSoup').BeautifulSoup(data)
         self.baseuri = baseuri
         self.encoding = encoding
         if type(data) == type(u''):
@@ -2254,7 +2267,7 @@ class _MicroformatsParser:
                 self.xfn.append({"relationships": xfn_rels, "href": elm.get('href', ''), "name": elm.string})
 
 def _parseMicroformats(htmlSource, baseURI, encoding):
-    if not BeautifulSoup: return
+    if not _import_optional('BeautifulSoup'): return
     if _debug: sys.stderr.write('entering _parseMicroformats\n')
     p = _MicroformatsParser(htmlSource, baseURI, encoding)
     p.vcard = p.findVCards(p.document)
@@ -2733,6 +2746,71 @@ def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, h
     # treat url_file_stream_or_string as string
     return _StringIO(str(url_file_stream_or_string))
 
+_READ_CHUNK_SIZE = 64 * 1024
+
+def _get_decompressor(f):
+    '''Return a zlib decompression object for the Content-Encoding of f, if any'''
+    if not (zlib and hasattr(f, 'headers')):
+        return None
+    encoding = f.headers.get('content-encoding', '')
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+    return None
+
+def _read_limited(f, max_size=None, deadline=None, max_decompressed_size=None, stats=None):
+    '''Read and decompress the whole resource, but give up if it is larger
+    than max_size bytes, decompresses to more than max_decompressed_size
+    bytes, or is not done by the time.time() value deadline
+
+    Compressed data is decompressed chunk by chunk as it arrives, so only
+    the decompressed content is kept in memory. If stats is a dict, the
+    number of bytes read so far is kept in its 'download_size' item, and
+    the time spent decompressing in 'decompress_time'.
+
+    The deadline is only checked between chunks, so it may be exceeded
+    by up to one socket timeout.
+    '''
+    decompressor = _get_decompressor(f)
+    if max_size is not None and hasattr(f, 'info'):
+        try:
+            length = int(f.info().getheader('Content-Length'))
+        except (TypeError, ValueError):
+            pass
+        else:
+            if length > max_size:
+                raise ResponseTooLarge('Content-Length of %d exceeds %d bytes' % (length, max_size))
+    chunks, size, decompressed_size = [], 0, 0
+    while 1:
+        if deadline is not None and time.time() > deadline:
+            raise DownloadTimeout('download took too long')
+        chunk = f.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if stats is not None:
+            stats['download_size'] = size
+        if max_size is not None and size > max_size:
+            raise ResponseTooLarge('response exceeds %d bytes' % max_size)
+        if decompressor:
+            decompress_start = time.time()
+            if max_decompressed_size is None:
+                chunk = decompressor.decompress(chunk)
+            else:
+                # a small chunk may decompress to a lot of data, so
+                # don't even let zlib produce more than we accept
+                chunk = decompressor.decompress(chunk, max_decompressed_size - decompressed_size + 1)
+            if stats is not None:
+                stats['decompress_time'] = stats.get('decompress_time', 0) + time.time() - decompress_start
+            decompressed_size += len(chunk)
+            if max_decompressed_size is not None and decompressed_size > max_decompressed_size:
+                raise ResponseTooLarge('decompressed response exceeds %d bytes' % max_decompressed_size)
+        chunks.append(chunk)
+    if decompressor:
+        chunks.append(decompressor.flush())
+    return ''.join(chunks)
+
 _date_handlers = []
 def registerDateHandler(func):
     '''Register a date handler function (takes string, returns 9-tuple date in GMT)'''
@@ -3336,10 +3414,23 @@ def _toUTF8(data, encoding):
                 sys.stderr.write('trying utf-32le instead\n')
         encoding = 'utf-32le'
         data = data[4:]
-    newdata = unicode(data, encoding)
-    if _debug: sys.stderr.write('successfully converted %s data to unicode\n' % encoding)
     declmatch = re.compile('^<\?xml[^>]*?>')
     newdecl = '''<?xml version='1.0' encoding='utf-8'?>'''
+    if codecs.lookup(encoding).name in ('utf-8', 'ascii'):
+        # Already utf-8: decoding the whole document would only give us
+        # a (much larger) unicode copy to encode again. Validate it piece
+        # by piece instead.
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for i in xrange(0, len(data), _READ_CHUNK_SIZE):
+            decoder.decode(data[i:i+_READ_CHUNK_SIZE])
+        decoder.decode('', True)
+        if _debug: sys.stderr.write('successfully validated %s data\n' % encoding)
+        match = declmatch.search(data)
+        if match:
+            return newdecl + data[match.end():]
+        return newdecl + '\n' + data
+    newdata = unicode(data, encoding)
+    if _debug: sys.stderr.write('successfully converted %s data to unicode\n' % encoding)
     if declmatch.search(newdata):
         newdata = declmatch.sub(newdecl, newdata)
     else:
@@ -3378,8 +3469,15 @@ def _stripDoctype(data):
 
     return version, data, dict(replacement and safe_pattern.findall(replacement))
     
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[]):
-    '''Parse a feed from a URL, file, stream, or string'''
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[],
+          max_size=None, max_decompressed_size=None, timeout=None):
+    '''Parse a feed from a URL, file, stream, or string
+
+    Downloading more than max_size bytes, decompressing to more than
+    max_decompressed_size bytes, or downloading for longer than timeout
+    seconds is aborted with a DownloadLimitExceeded bozo_exception.
+    '''
+    deadline = timeout is not None and time.time() + timeout or None
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
     result['entries'] = []
@@ -3387,35 +3485,27 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         result['bozo'] = 0
     if type(handlers) == types.InstanceType:
         handlers = [handlers]
+    f = None
+    download_start = time.time()
+    result['download_size'] = 0
     try:
         f = _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers)
-        data = result['data'] = f.read()
+        # if feed is gzip-compressed, this decompresses it
+        data = result['data'] = _read_limited(f, max_size, deadline, max_decompressed_size, result)
     except Exception, e:
         result['bozo'] = 1
         result['bozo_exception'] = e
         data = None
-        f = None
-
-    # if feed is gzip-compressed, decompress it
-    if f and data and hasattr(f, 'headers'):
-        if gzip and f.headers.get('content-encoding', '') == 'gzip':
-            try:
-                data = gzip.GzipFile(fileobj=_StringIO(data)).read()
-            except Exception, e:
-                # Some feeds claim to be gzipped but they're not, so
-                # we get garbage.  Ideally, we should re-request the
-                # feed without the 'Accept-encoding: gzip' header,
-                # but we don't.
-                result['bozo'] = 1
-                result['bozo_exception'] = e
-                data = ''
-        elif zlib and f.headers.get('content-encoding', '') == 'deflate':
-            try:
-                data = zlib.decompress(data, -zlib.MAX_WBITS)
-            except Exception, e:
-                result['bozo'] = 1
-                result['bozo_exception'] = e
-                data = ''
+        if zlib and isinstance(e, zlib.error):
+            # Some feeds claim to be gzipped but they're not, so
+            # we get garbage.  Ideally, we should re-request the
+            # feed without the 'Accept-encoding: gzip' header,
+            # but we don't.
+            data = ''
+        # if we gave up on the response ourselves, keep it for the headers
+        elif not isinstance(e, DownloadLimitExceeded):
+            f = None
+    result['download_time'] = time.time() - download_start
 
     # save HTTP headers
     if hasattr(f, 'info'):
@@ -3444,7 +3534,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     http_headers = result.get('headers', {})
     result['encoding'], http_encoding, xml_encoding, sniffed_xml_encoding, acceptable_content_type = \
         _getCharacterEncoding(http_headers, data)
-    if http_headers and (not acceptable_content_type):
+    if http_headers and (not acceptable_content_type) and data is not None:
         if http_headers.has_key('content-type'):
             bozo_message = '%s is not an XML media type' % http_headers['content-type']
         else:
@@ -3485,7 +3575,8 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         except:
             pass
     # if no luck and we have auto-detection library, try that
-    if (not known_encoding) and chardet:
+    if (not known_encoding) and _import_chardet():
+        chardet = _import_chardet()
         try:
             proposed_encoding = chardet.detect(data)['encoding']
             if proposed_encoding and (proposed_encoding not in tried_encodings):
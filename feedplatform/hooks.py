@@ -95,6 +95,16 @@ _DEFAULT_HOOKS = [
     # combined with this to update item metadata.
     'new_item',
 
+    # Called when an item in a feed was detected
+    # to be already in the database, before
+    # found_item. Can return True to indicate
+    # that the item has not changed since it was
+    # last processed, in which case both
+    # found_item and process_item are skipped.
+    # Not triggered if the ``full`` option was
+    # passed to ``update_feed``.
+    'check_item',
+
     # Basically the opposing hook to new_item.
     # This gets called if an item in a feed was
     # detected to be already in the database.
@@ -134,7 +144,8 @@ _DEFAULT_HOOKS = [
 # simple method to validate names and avoid bugs due to misspellings
 SUPPORTED_HOOKS = None
 
-# store registered callbacks: dict of (callable => priority) dicts
+# store registered callbacks: lists of (callable, priority) tuples,
+# ordered by priority, then in the order they were added
 _CALLBACKS = None
 
 
@@ -156,15 +167,15 @@ def add_callback(name, func, priority=0):
     _validate_hook_name(name)
 
     if not name in _CALLBACKS:
-        _CALLBACKS[name] = {}
+        _CALLBACKS[name] = []
 
-    if func in _CALLBACKS[name]:
+    if func in [f for f, p in _CALLBACKS[name]]:
         raise ValueError('The callback (%s) is already registered' % func)
 
-    _CALLBACKS[name][func] = priority
-    _CALLBACKS[name] = dict(sorted(_CALLBACKS[name].iteritems(),
-                                   key=lambda (k,v): v,
-                                   reverse=True))
+    # the sort is stable, so callbacks with the same priority keep
+    # their order
+    _CALLBACKS[name].append((func, priority))
+    _CALLBACKS[name].sort(key=lambda (k,v): v, reverse=True)
 
 
 def any(name):
@@ -175,7 +186,7 @@ def any(name):
     you want to avoid unless necessary.
     """
     _validate_hook_name(name)
-    return len(_CALLBACKS.get(name, {})) > 0
+    return len(_CALLBACKS.get(name, [])) > 0
 
 
 def trigger(name, args=[], kwargs={}, all=False):
@@ -189,7 +200,7 @@ def trigger(name, args=[], kwargs={}, all=False):
 
     _validate_hook_name(name)
 
-    for func, priority in _CALLBACKS.get(name, {}).iteritems():
+    for func, priority in _CALLBACKS.get(name, []):
         result = func(*args, **kwargs)
         if result is not None and not all:
             return result
@@ -1,21 +1,35 @@
 import os
+import sys
+import heapq
 import logging
 import threading
 import time
-import SocketServer, select
+import datetime
 from optparse import make_option
 import Queue
 from itertools import chain
+from storm.locals import DateTime, Unicode
 from feedplatform import parse
 from feedplatform import log
 from feedplatform.deps import daemon
 from feedplatform.management import BaseCommand, CommandError
 from feedplatform import addins
 from feedplatform import db
-
-
-__all__ = ('base_daemon', 'provide_daemons', 'provide_loop_daemon',
-           'provide_queue_daemon', 'provide_socket_queue_controller',
+from feedplatform import net
+from feedplatform import util
+from feedplatform import metrics
+from feedplatform import profiling
+from feedplatform.queues import PriorityFeedQueue
+from feedplatform.control import ControlServer, send_command
+from feedplatform.sharding import Shard
+from feedplatform.supervisor import ProcessSupervisor
+from feedplatform.conf import config
+
+
+__all__ = ('base_daemon', 'WorkerPool', 'SlowFeeds',
+           'provide_daemons', 'provide_loop_daemon',
+           'provide_lease_daemon', 'provide_queue_daemon',
+           'provide_socket_queue_controller',
            'provide_multi_daemon',)
 
 
@@ -26,14 +40,23 @@ DEFAULT_LOOP_SLEEP = 0.1
 class StartDaemonCommand(BaseCommand):
     """Run the FeedPlatform bot, optionally as a daemon.
 
-    TODO: Add a remote control to enable people to inspect and interact
-    with an active bot. Imaginable are features like:
+    If the DAEMON_CONTROL_ADDRESS setting is given, the bot can be
+    inspected and controlled while it runs, using the ``control``
+    command: feeds can be updated right away, the bot paused and
+    resumed, the number of workers changed, and the feeds currently
+    being updated listed (see ``control.ControlServer``). This is not yet
+    supported with ``--processes``.
+
+    With ``--profile``, the feed updates are profiled, see
+    ``feedplatform.profiling``. The ``update`` command does the same
+    for a single feed.
+
+    TODO: Add more to the remote control. Imaginable are features like:
 
         #   get last X updated feeds
         #   get last X found items
         #   get last X log messages
         #   search for feeds
-        #   prioritize a feed (e.g. update now) (and report log result/log)
     """
 
     option_list = BaseCommand.option_list + (
@@ -45,6 +68,32 @@ class StartDaemonCommand(BaseCommand):
                   '"warning". Messages below this are ignored.'),
         make_option('--daemonize', action='store_true', default=False,
             help='Fork off and run as a daemon. Not available on all OSes.'),
+        make_option('--shard', default=None, metavar='I/N',
+            help='Only update the feeds in shard I of N (counting from 0), '
+                 'so that multiple instances can share the work. Not '
+                 'supported by all daemons.'),
+        make_option('--shard-by', default='id', metavar='KEY',
+            help='What to shard feeds by: "id", or "host" to keep all '
+                 'feeds of a host in the same shard. Defaults to "id".'),
+        make_option('--processes', type='int', default=1, metavar='N',
+            help='Run the daemon in N processes that share the work, '
+                 'restarting those that crash. Not supported by all '
+                 'daemons.'),
+        make_option('--profile', default=None, metavar='FILE',
+            help='Profile the feed updates, and write the result to FILE, '
+                 'in the callgrind format if the name ends with '
+                 '".callgrind", otherwise for the pstats module.'),
+        make_option('--profile-feeds', type='int', default=None,
+            metavar='N',
+            help='Only profile the first N feed updates.'),
+        make_option('--profile-seconds', type='float', default=None,
+            metavar='SECONDS',
+            help='Only profile for this many seconds.'),
+        make_option('--profile-interval', type='float', default=None,
+            metavar='SECONDS',
+            help='Take a new profile every this many seconds, limited by '
+                 '--profile-feeds or --profile-seconds, adding the time '
+                 'to the filename.'),
     )
     help = 'Runs the FeedPlatform bot.'
 
@@ -118,12 +167,65 @@ class StartDaemonCommand(BaseCommand):
                 else:
                     daemon_to_start = named_daemons[daemon_name]
 
+        processes = options.get('processes') or 1
+        if processes > 1:
+            if not daemon_to_start.can_multiprocess:
+                raise CommandError('this daemon does not support --processes')
+            if options.get('shard'):
+                raise CommandError('--shard and --processes cannot be '
+                                   'combined')
+            if not hasattr(os, 'fork'):
+                raise CommandError('--processes not supported on this '
+                                   'platform')
+            if options.get('profile'):
+                raise CommandError('--profile and --processes cannot be '
+                                   'combined')
+            daemon_to_start.shard_by = options.get('shard_by') or 'id'
+
+        if options.get('shard'):
+            if not daemon_to_start.can_shard:
+                raise CommandError('this daemon does not support --shard')
+            try:
+                daemon_to_start.shard = Shard.parse(options['shard'],
+                                                    options.get('shard_by'))
+            except ValueError, e:
+                raise CommandError('invalid value for --shard: %s' % e)
+
         # fork off as daemon, if requested
         if options.get('daemonize'):
             if os.name != 'posix':
                 raise CommandError('--daemonize not supported on this platform')
             daemon.daemonize()
 
+        if processes > 1:
+            if config.DAEMON_CONTROL_ADDRESS is not None:
+                daemon_to_start.log.warning('DAEMON_CONTROL_ADDRESS is '
+                    'not supported with --processes, and ignored')
+            supervisor = ProcessSupervisor(daemon_to_start, processes)
+            server = self._serve_stats(supervisor)
+            if server:
+                supervisor.servers.append(server)
+            try:
+                supervisor.run()
+            finally:
+                if server:
+                    server.stop()
+                    server.join()
+            return
+
+        if options.get('profile'):
+            if options.get('profile_interval') and not (
+                    options.get('profile_feeds') or
+                    options.get('profile_seconds')):
+                raise CommandError('--profile-interval requires '
+                                   '--profile-feeds or --profile-seconds')
+            daemon_to_start.profiler = profiling.Profiler(
+                options['profile'], options.get('profile_feeds'),
+                options.get('profile_seconds'),
+                options.get('profile_interval'), daemon_to_start.log)
+
+        server = self._serve_stats(daemon_to_start)
+        control = self._serve_control(daemon_to_start)
         try:
             # If daemon threads make trouble (http://bugs.python.org/issue1856),
             # we can always disable it. It's there for convenience's sake,
@@ -131,11 +233,323 @@ class StartDaemonCommand(BaseCommand):
             # work just fine as well.
             # TODO: parse the rest of the args, pass along as args/options
             daemon_to_start.start(daemon=True)
-            while daemon_to_start.isAlive():
-                # join with a timeout, so KeyboardInterrupts get through
-                daemon_to_start.join(DEFAULT_LOOP_SLEEP)
+            daemon_to_start.finished.wait()
         except KeyboardInterrupt:
             daemon_to_start.stop()
+        if server:
+            server.stop()
+            server.join()
+        if control:
+            control.stop()
+            control.join()
+        if daemon_to_start.profiler:
+            daemon_to_start.profiler.close()
+
+    def _serve_control(self, daemon):
+        address = config.DAEMON_CONTROL_ADDRESS
+        if address is None:
+            return None
+        server = ControlServer(daemon, address)
+        server.start()
+        server.ready.wait()
+        return server
+
+    def _serve_stats(self, source):
+        address = config.DAEMON_STATS_ADDRESS
+        if address is None:
+            return None
+        server = metrics.MetricsServer(address, source.render_metrics,
+                                       source.log)
+        server.start()
+        server.ready.wait()
+        return server
+
+
+class StatsCommand(BaseCommand):
+    """Show the statistics of a running daemon, as served at the
+    address given by the DAEMON_STATS_ADDRESS setting.
+    """
+
+    help = 'Shows the statistics of a running daemon.'
+    option_list = BaseCommand.option_list + (
+        make_option('--raw', action='store_true', default=False,
+            help='Output the metrics in the Prometheus text format.'),
+        make_option('--interval', type='float', default=None,
+            metavar='SECONDS',
+            help='Query the daemon twice, this many seconds apart, and '
+                 'show the rates in between, rather than since the '
+                 'daemon started.'),
+    )
+
+    def handle(self, *args, **options):
+        address = config.DAEMON_STATS_ADDRESS
+        if address is None:
+            raise CommandError('DAEMON_STATS_ADDRESS is not configured')
+
+        import socket
+        def query():
+            try:
+                return metrics.fetch(address)
+            except (IOError, socket.error), e:
+                raise CommandError('cannot query daemon at %s: %s' % (
+                    address, e))
+
+        text = query()
+        if options.get('raw'):
+            print text,
+            return
+        before, interval = None, options.get('interval')
+        if interval:
+            before = metrics.parse_text(text)
+            time.sleep(interval)
+            text = query()
+        for name, value in self.summarize(metrics.parse_text(text),
+                                          before, interval):
+            print '%-28s %s' % (name + ':', value)
+
+    def summarize(self, samples, before=None, interval=None):
+        """Return a list of (name, value) tuples describing the
+        metrics in ``samples``, as returned by ``metrics.parse_text``.
+
+        Counters are shown with their rate, either since the daemon
+        was started, or, if ``before`` holds the samples of an earlier
+        query, over the ``interval`` in between.
+        """
+        def total(samples, name, **labels):
+            return sum([v for n, l, v in samples if n == name and
+                        all([l.get(k) == w for k, w in labels.items()])])
+        def by_label(samples, name, label):
+            result = {}
+            for n, l, v in samples:
+                if n == name:
+                    result[l[label]] = result.get(l[label], 0) + v
+            return result
+        def delta(name, **labels):
+            value = total(samples, name, **labels)
+            if before is not None:
+                value -= total(before, name, **labels)
+            return value
+
+        if before is None:
+            interval = total(samples, 'feedplatform_uptime_seconds')
+        def rate(value):
+            if not interval:
+                return '%d' % value
+            return '%d (%.2f/s)' % (value, value / interval)
+
+        result = [('uptime', '%ds' % total(samples,
+                                            'feedplatform_uptime_seconds'))]
+        updates = delta('feedplatform_updates_total')
+        result.append(('feeds updated', rate(updates)))
+        result.append(('items created',
+                       rate(delta('feedplatform_items_created_total'))))
+        if updates:
+            result.append(('not modified (304)', '%.1f%%' % (
+                100 * delta('feedplatform_updates_total', status='304')
+                    / updates)))
+        result.append(('downloaded', '%.1f kB' % (
+            delta('feedplatform_downloaded_bytes_total') / 1024)))
+
+        # the histograms always cover everything since the start
+        for stage in ('fetch', 'parse', 'store'):
+            buckets = [(l['le'] == '+Inf' and float('inf') or float(l['le']),
+                        v) for n, l, v in samples
+                       if n == 'feedplatform_stage_seconds_bucket'
+                       and l.get('stage') == stage]
+            percentiles = [metrics.quantile(q, buckets)
+                           for q in (0.5, 0.9, 0.99)]
+            if percentiles[0] is not None:
+                result.append(('%s time' % stage,
+                    'p50=%.3fs p90=%.3fs p99=%.3fs' % tuple(percentiles)))
+
+        errors = by_label(samples, 'feedplatform_errors_total', 'error')
+        if before is not None:
+            for error, count in by_label(
+                    before, 'feedplatform_errors_total', 'error').items():
+                errors[error] -= count
+        errors = ', '.join(['%s=%d' % item
+                            for item in sorted(errors.items()) if item[1]])
+        result.append(('errors', errors or 'none'))
+
+        # everything else the daemon reports, like the queue depth
+        shown = ('feedplatform_updates_total', 'feedplatform_uptime_seconds',
+                 'feedplatform_items_created_total',
+                 'feedplatform_downloaded_bytes_total',
+                 'feedplatform_errors_total')
+        for name, labels, value in samples:
+            if name.startswith('feedplatform_') and not labels and \
+               not name in shown and not name.startswith(
+                    'feedplatform_stage_seconds'):
+                result.append((name[len('feedplatform_'):].replace('_', ' '),
+                               '%g' % value))
+        return result
+
+
+class ControlCommand(BaseCommand):
+    """Send a command to a running daemon, through the control
+    channel at the address given by the DAEMON_CONTROL_ADDRESS
+    setting; see ``control.ControlServer`` for the commands available.
+    """
+
+    help = 'Controls a running daemon; try "control help".'
+    args = 'command [arguments]'
+    option_list = BaseCommand.option_list + (
+        make_option('--timeout', type='float', default=None,
+            metavar='SECONDS',
+            help='How long to wait for a response. By default, there is '
+                 'no limit, as updating a feed may take a while.'),
+    )
+
+    def handle(self, *args, **options):
+        address = config.DAEMON_CONTROL_ADDRESS
+        if address is None:
+            raise CommandError('DAEMON_CONTROL_ADDRESS is not configured')
+        if not args:
+            raise CommandError('no command given; try "control help"')
+
+        import socket
+        try:
+            code, message, lines = send_command(address, ' '.join(args),
+                                                options.get('timeout'))
+        except (IOError, socket.error), e:
+            raise CommandError('cannot reach daemon at %s: %s' % (
+                address, e))
+        if code >= 400:
+            raise CommandError(message)
+        print message
+        for line in lines:
+            print line
+
+
+class WorkerPool(object):
+    """A number of threads, each running ``target(index)``, that can
+    be changed while they run.
+
+    Workers are expected to call ``retire`` between jobs, and return
+    if it says so. When the pool shrinks, those with the highest
+    indexes leave, once they are done with the job at hand; to wake
+    up those waiting for one, ``wakeup`` is called. ``retiring`` can
+    be used to check, without side effects, whether a worker should
+    stop waiting.
+    """
+
+    def __init__(self, target, count, daemon=False, wakeup=None):
+        self.target = target
+        self.count = count
+        self.daemon = daemon
+        self.wakeup = wakeup
+        self._lock = threading.Lock()
+        # the active workers by index; retired ones may still be
+        # finishing up, and are only found in ``_threads``.
+        self._active = {}
+        self._threads = []
+
+    def start(self):
+        self.resize(self.count)
+
+    def resize(self, count):
+        self._lock.acquire()
+        try:
+            self.count = count
+            for index in range(count):
+                if not index in self._active:
+                    thread = threading.Thread(target=self.target,
+                                              args=(index,))
+                    thread.setDaemon(self.daemon)
+                    self._active[index] = thread
+                    self._threads.append(thread)
+                    thread.start()
+        finally:
+            self._lock.release()
+        if self.wakeup:
+            self.wakeup()
+
+    def retiring(self, index):
+        return index >= self.count
+
+    def retire(self, index):
+        """Return ``True`` if worker ``index`` is no longer needed,
+        in which case it is expected to return.
+        """
+        self._lock.acquire()
+        try:
+            if index < self.count:
+                return False
+            del self._active[index]
+            return True
+        finally:
+            self._lock.release()
+
+    def join(self):
+        """Wait for all workers, including those that were retired.
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                threads = [t for t in self._threads if t.isAlive()]
+                self._threads = threads
+            finally:
+                self._lock.release()
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+
+class SlowFeeds(object):
+    """Keeps the ``size`` slowest feed updates, as
+    ``parse.UpdateProgress`` records, of about the last ``window``
+    seconds.
+
+    Updates are collected in windows of that length; those of the
+    current and the previous window are kept, so ``get`` covers at
+    least the last ``window`` seconds, and at most twice that.
+    """
+
+    def __init__(self, size, window=3600):
+        self.size = size
+        self.window = window
+        self._lock = threading.Lock()
+        self._current, self._previous = [], []
+        self._window_started = time.time()
+        self._counter = 0
+
+    def _rotate(self):
+        # with the lock held
+        now = time.time()
+        if now - self._window_started >= self.window:
+            if now - self._window_started >= 2 * self.window:
+                self._previous = []
+            else:
+                self._previous = self._current
+            self._current = []
+            self._window_started = now
+
+    def add(self, progress):
+        self._lock.acquire()
+        try:
+            self._rotate()
+            # a min-heap, so the fastest is the one to go; the counter
+            # keeps updates that took equally long apart
+            self._counter += 1
+            heapq.heappush(self._current,
+                           (progress.elapsed, self._counter, progress))
+            if len(self._current) > self.size:
+                heapq.heappop(self._current)
+        finally:
+            self._lock.release()
+
+    def get(self):
+        """Return the updates kept, slowest first."""
+        self._lock.acquire()
+        try:
+            self._rotate()
+            entries = self._current + self._previous
+        finally:
+            self._lock.release()
+        entries.sort(reverse=True)
+        return [progress for elapsed, counter, progress
+                in entries[:self.size]]
 
 
 class provide_daemons(addins.base):
@@ -144,7 +558,27 @@ class provide_daemons(addins.base):
     """
 
     def get_commands(self):
-        return {'start': StartDaemonCommand}
+        return {'start': StartDaemonCommand, 'stats': StatsCommand,
+                'control': ControlCommand}
+
+
+def _set_finished(run):
+    """Wrap the ``run`` method of a daemon class so that the
+    daemon's ``finished`` event is set when it returns. Calls of the
+    method of a base class from within only count once.
+    """
+    def run_and_finish(self, *args, **options):
+        if getattr(self, '_running', False):
+            return run(self, *args, **options)
+        self._running = True
+        try:
+            return run(self, *args, **options)
+        finally:
+            self._running = False
+            self.finished.set()
+    run_and_finish.__name__ = run.__name__
+    run_and_finish.__doc__ = run.__doc__
+    return run_and_finish
 
 
 class base_daemon(addins.base, threading.Thread):
@@ -157,18 +591,50 @@ class base_daemon(addins.base, threading.Thread):
     ``run()`` is called when the daemon is supposed to execute. In the
     same way as commands, the method is passed positional arguments (as
     ``args``) and command line options (``options``). If you write a
-    subclass, make sure that your ``run`` method checks ``stop_requested``
-    in regular intervals, and exits when asked to.
+    subclass, make sure that your ``run`` method exits when asked to,
+    as signalled by ``stop_event``. Rather than checking
+    ``stop_requested`` in regular intervals, a daemon that has nothing
+    to do should wait for the event, e.g. via ``wait_for_stop``, or by
+    passing it to ``select`` along with its sockets; and override
+    ``stop`` to wake up whatever else it might be blocked on. This way
+    idle daemons don't use any CPU, and still stop right away.
 
     While not strictly necessary, it is strongly recommended that you name
     your daemons (``name`` argument to ``__init__``). If you have more than
     one daemon installed, you will not be able to start unnamed daemons
     from the command line.
+
+    Daemons that update feeds should do so via ``update_feed``, which
+    makes sure that memory is released after each feed, and keeps the
+    statistics returned by ``get_stats``. It also keeps track of the
+    feeds currently being updated (``get_in_flight``), and, if the
+    DAEMON_SLOWEST_FEEDS setting is given, of the slowest updates
+    (``slowest_feeds``, a ``SlowFeeds`` instance); and holds off while
+    the daemon is paused (see ``pause``).
     """
 
     abstract = True
     depends = (provide_daemons,)
 
+    # Daemons that are able to only work on a part of all feeds set
+    # this to ``True``, and observe ``shard``.
+    can_shard = False
+    shard = None
+    shard_by = 'id'
+
+    # Daemons that can share their work with copies of themselves
+    # running in other processes set this to ``True``, and implement
+    # ``setup_process``; see ``supervisor.ProcessSupervisor``.
+    can_multiprocess = False
+
+    # The ``WorkerPool`` of daemons that update feeds in multiple
+    # threads, while they run; see ``set_workers``.
+    _pool = None
+
+    # A ``profiling.Profiler`` to run the updates done via
+    # ``update_feed`` through; see the ``--profile`` option.
+    profiler = None
+
     # If your daemon cannot be daemonic because it needs to do cleanup
     # work, then set this to False. It will make sure your thread is
     # never run in daemonic  mode, regardless of any possible global
@@ -176,23 +642,186 @@ class base_daemon(addins.base, threading.Thread):
     # ``stop_requested` flag correctly and react in a timely manner.`
     can_be_daemon_thread = True
 
+    class __metaclass__(type(addins.base)):
+        def __new__(cls, name, bases, attrs):
+            # whatever ``run`` a subclass defines, ``finished`` is set
+            # once it returns; unlike ``join``, the event can be waited
+            # on without blocking signals like KeyboardInterrupt.
+            if 'run' in attrs:
+                attrs['run'] = _set_finished(attrs['run'])
+            return type(addins.base).__new__(cls, name, bases, attrs)
+
     def __init__(self, name=None):
         super(base_daemon, self).__init__()
         self.name = name
-        self.stop_requested = False
+        self.stop_event = util.Event()
+        # set once ``run`` returns, see ``_set_finished``
+        self.finished = util.Event()
+        # cleared while paused
+        self.resumed = util.Event()
+        self.resumed.set()
+        self.feeds_updated = 0
+        self.in_flight = []
+        # created once there is something to keep, as the settings
+        # may not be available yet
+        self.slowest_feeds = None
+        self.started = time.time()
+        self._stats_logged = time.time()
+        self._stats_lock = threading.Lock()
 
     def start(self, daemon=False, *args, **kwargs):
         # TODO: is there a way to have daemon threads complete shutdown
         # jobs? If yes, we could get rid of this whole "can_be_daemon"
         # mechanism.
         self.setDaemon(daemon and self.can_be_daemon_thread)
+        self.started = time.time()
         super(base_daemon, self).start(*args, **kwargs)
 
     def run(self, *args, **options):
         raise NotImplementedError()
 
+    def _get_stop_requested(self):
+        return self.stop_event.isSet()
+
+    def _set_stop_requested(self, value):
+        # daemons written before ``stop_event`` set the flag directly
+        if value:
+            self.stop_event.set()
+        else:
+            self.stop_event.clear()
+
+    stop_requested = property(_get_stop_requested, _set_stop_requested)
+
     def stop(self):
-        self.stop_requested = True
+        self.stop_event.set()
+        # a paused daemon needs to get going to notice
+        self.resumed.set()
+
+    def pause(self):
+        """Stop updating feeds until ``resume`` is called. Updates
+        already under way are completed.
+        """
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    @property
+    def paused(self):
+        return not self.resumed.isSet()
+
+    def set_workers(self, count):
+        """Change the number of threads updating feeds while the
+        daemon is running. Only possible with daemons that were
+        started with multiple workers in the first place; otherwise,
+        ``ValueError`` is raised.
+        """
+        if count < 1:
+            raise ValueError('need at least one worker')
+        pool = self._pool
+        if pool is None:
+            raise ValueError('the daemon is not running multiple workers')
+        self.workers = count
+        pool.resize(count)
+
+    def get_in_flight(self):
+        """Return the ``parse.UpdateProgress`` of each feed that is
+        currently being updated, those that have been at it the
+        longest first.
+        """
+        self._stats_lock.acquire()
+        try:
+            in_flight = list(self.in_flight)
+        finally:
+            self._stats_lock.release()
+        in_flight.sort(key=lambda progress: progress.started)
+        return in_flight
+
+    def wait_for_stop(self, timeout=None):
+        """Sleep for ``timeout`` seconds, or until the daemon is
+        asked to stop. Returns ``True`` in the latter case.
+        """
+        return self.stop_event.wait(timeout)
+
+    def setup_process(self, index, count):
+        """Called in process ``index`` of ``count`` processes that run
+        this daemon, before it is started. Daemons that shard, by
+        default, then work on the shard with that index.
+        """
+        if not self.can_shard:
+            raise NotImplementedError()
+        self.shard = Shard(index, count, self.shard_by)
+
+    def update_feed(self, feed, ignore_pause=False, **kwargs):
+        """Update ``feed``, then have the storage backend release the
+        objects it no longer needs, so that memory usage stays flat
+        no matter how long the daemon runs. Returns the
+        ``parse.UpdateProgress`` of the update.
+
+        If the update fails, changes not yet committed are discarded.
+
+        While the daemon is paused, this waits until it is resumed (or
+        stopped), unless ``ignore_pause`` is given.
+        """
+        if not ignore_pause:
+            self.resumed.wait()
+        progress = parse.UpdateProgress(feed)
+        self._stats_lock.acquire()
+        try:
+            self.in_flight.append(progress)
+        finally:
+            self._stats_lock.release()
+        try:
+            try:
+                if self.profiler:
+                    self.profiler.runcall(parse.update_feed, feed,
+                                          progress=progress, **kwargs)
+                else:
+                    parse.update_feed(feed, progress=progress, **kwargs)
+            except:
+                metrics.errors.inc(error=sys.exc_info()[0].__name__)
+                db.backend.rollback()
+                raise
+        finally:
+            db.backend.release()
+            self._stats_lock.acquire()
+            try:
+                self.in_flight.remove(progress)
+                self.feeds_updated += 1
+                if config.DAEMON_SLOWEST_FEEDS and \
+                   self.slowest_feeds is None:
+                    self.slowest_feeds = SlowFeeds(
+                        config.DAEMON_SLOWEST_FEEDS)
+            finally:
+                self._stats_lock.release()
+            if self.slowest_feeds is not None:
+                self.slowest_feeds.add(progress)
+            self._log_stats()
+        return progress
+
+    def get_stats(self):
+        """Return a dict of statistics about this daemon, including
+        those of the storage backend and the network layer.
+        """
+        stats = {'feeds_updated': self.feeds_updated}
+        stats.update(db.backend.get_stats())
+        stats.update(net.get_stats())
+        return stats
+
+    def render_metrics(self):
+        """Return the metrics of this process, and the statistics of
+        this daemon, in the Prometheus text format.
+        """
+        stats = self.get_stats()
+        stats['uptime_seconds'] = time.time() - self.started
+        return metrics.render(metrics.registry.snapshot(), stats)
+
+    def _log_stats(self):
+        interval = config.DAEMON_STATS_INTERVAL
+        if interval is not None and time.time() - self._stats_logged >= interval:
+            self._stats_logged = time.time()
+            self.log.info('Stats: %s' % ', '.join(['%s=%s' % item
+                for item in sorted(self.get_stats().items())]))
 
 
 class provide_loop_daemon(base_daemon):
@@ -204,13 +833,43 @@ class provide_loop_daemon(base_daemon):
     ``callback``, if set, will be run every time a feed was updated,
     and is expected to take one argument, the number of iterations so
     far. If it returns ``True``, the loop will stop.
+
+    ``shard``, a ``Shard`` or a string like "0/4", restricts the
+    daemon to a part of all feeds; see also the ``--shard`` option of
+    the ``start`` command.
+
+    ``workers`` is the number of threads updating feeds in parallel.
+    Each uses a database connection of its own (see
+    ``db.use_thread_store``), so this doesn't work with an in-memory
+    SQLite database. Feeds are handed to the workers through a
+    ``net.HostDispatcher``, which keeps them busy while respecting the
+    per-host limits (see the HOST_* settings). With multiple workers,
+    errors during an update are logged, rather than stopping the
+    daemon, and ``callback`` is called from the worker threads. Their
+    number can then be changed while the daemon runs, via
+    ``set_workers``.
     """
 
-    def __init__(self, once=False, callback=None, *args, **kwargs):
+    can_shard = True
+    can_multiprocess = True
+
+    def __init__(self, once=False, callback=None, workers=1, shard=None,
+                 *args, **kwargs):
         self.once = once
         self.callback = callback
+        self.workers = workers
+        if isinstance(shard, basestring):
+            shard = Shard.parse(shard)
+        self.shard = shard
+        self._dispatcher = None
         super(provide_loop_daemon, self).__init__(*args, **kwargs)
 
+    def stop(self):
+        super(provide_loop_daemon, self).stop()
+        dispatcher = self._dispatcher
+        if dispatcher is not None:
+            dispatcher.wakeup()
+
     def run(self, *args, **options):
         """Loop forever, and update feeds.
 
@@ -218,21 +877,16 @@ class provide_loop_daemon(base_daemon):
         ``update_feed``, changing the parsing behavior (addins can
         use the options to adjust their behavior).
         """
-        # Code below fails in sqlite because we can't update a row
-        # while it is still part of queryset, IIRC:
-        #feed = db.store.get_next_feed()
-        #while feed:
-        #    update_feed(feed)
-        #    feed = db.store.get_next_feed()
+        if self.workers > 1:
+            return self._run_workers()
+
         callback = self.callback
         do_return = lambda: callback and callback(counter)
         counter = 0
         while True:
-            feeds = db.store.find(db.models.Feed)
-            for i in xrange(0, feeds.count()):  # XXX: only do this in sqlite
-                feed = feeds[i]
+            for feed in db.backend.iter_feeds(self.shard):
                 counter += 1
-                parse.update_feed(feed)
+                self.update_feed(feed)
                 if do_return() or self.stop_requested:
                     return
             if do_return() or self.stop_requested:
@@ -240,23 +894,226 @@ class provide_loop_daemon(base_daemon):
             if self.once:
                 return
 
+    def _run_workers(self):
+        dispatcher = self._dispatcher = net.HostDispatcher(net.get_limiter())
+        workers_done = threading.Event()
+        pool = self._pool = WorkerPool(
+            lambda index: self._work(index, dispatcher, workers_done),
+            self.workers, self.isDaemon(), dispatcher.wakeup)
+        pool.start()
+        try:
+            while not self.stop_requested:
+                # Pass on ids rather than the feeds, so that the workers
+                # can load them from their own store, and finish the
+                # transaction, so we don't lock the database.
+                jobs = [(feed.url, feed.id)
+                        for feed in db.backend.iter_feeds(self.shard)]
+                db.backend.commit()
+                db.backend.release()
+                for url, feed_id in jobs:
+                    dispatcher.put(url, feed_id)
+
+                # wait until this round is complete
+                if not dispatcher.join(cancel=self.stop_event.isSet):
+                    return
+                if self.callback and self.callback(self.feeds_updated):
+                    return
+                if self.once:
+                    return
+        finally:
+            workers_done.set()
+            dispatcher.wakeup()
+            pool.join()
+            self._dispatcher = self._pool = None
+
+    def _work(self, index, dispatcher, done):
+        pool = self._pool
+        cancel = lambda: done.isSet() or pool.retiring(index)
+        if config.DATABASE:
+            db.use_thread_store()
+        try:
+            while not done.isSet() and not pool.retire(index):
+                job = dispatcher.get(cancel=cancel)
+                if job is None:
+                    continue
+                host, feed_id = job
+                try:
+                    # may have been deleted in the meantime
+                    feed = db.backend.get_feed(feed_id)
+                    if feed is not None:
+                        self.update_feed(feed)
+                except Exception, e:
+                    self.log.error('Error updating feed #%s: %s' % (feed_id, e))
+                dispatcher.task_done(host)
+                feed = None
+                if self.callback and self.callback(self.feeds_updated):
+                    self.stop()
+        finally:
+            if config.DATABASE:
+                db.close_thread_store()
+
+
+class provide_lease_daemon(base_daemon):
+    """Updates feeds like ``provide_loop_daemon``, but can run on any
+    number of machines against the same database, with each feed being
+    updated by only one of them at a time.
+
+    Rather than going through all feeds, each worker claims a batch of
+    ``batch_size`` feeds that are due, by taking out a lease on them
+    for ``lease`` seconds (see ``db.StormBackend.claim_feeds``). The
+    lease is renewed while the worker is still busy with the batch,
+    and once a feed is updated, it is released, and becomes due again
+    after ``interval`` seconds. Feeds claimed by a node that crashed
+    are picked up by the others once their lease expires, so ``lease``
+    should comfortably exceed the time it takes to update a feed.
+
+    ``node`` identifies this process in the ``claimed_by`` field; it
+    defaults to the host name and process id. ``workers`` is the
+    number of threads, each claiming batches of its own; as with
+    ``provide_loop_daemon``, each needs its own database connection,
+    and if there is more than one, their number can be changed while
+    the daemon runs.
+
+    If ``once`` is enabled, the daemon stops when no feeds are due,
+    rather than waiting for some to become due.
+
+    Example:
+
+        [...
+         provide_lease_daemon(interval=3600, workers=5),
+        ...]
+    """
+
+    # how long to wait if no feeds are due
+    idle_sleep = 5
+
+    can_multiprocess = True
+
+    def __init__(self, node=None, batch_size=20, lease=300, interval=0,
+                 workers=1, once=False, *args, **kwargs):
+        super(provide_lease_daemon, self).__init__(*args, **kwargs)
+        self.custom_node = node
+        self.node = node or self._default_node()
+        self.batch_size = batch_size
+        self.lease = datetime.timedelta(seconds=lease)
+        self.interval = datetime.timedelta(seconds=interval)
+        self.workers = workers
+        self.once = once
+
+    def _default_node(self):
+        import socket
+        return u'%s:%d' % (socket.gethostname(), os.getpid())
+
+    def setup_process(self, index, count):
+        # the leases take care of sharing the work, we just need to
+        # tell the processes apart
+        if self.custom_node:
+            self.node = u'%s.%d' % (self.custom_node, index)
+        else:
+            self.node = self._default_node()
+
+    def get_fields(self):
+        return {'feed': {
+            'claimed_by': (Unicode, (), {}),
+            'lease_expires': (DateTime, (), {}),
+        }}
+
+    def run(self, *args, **options):
+        if self.workers == 1:
+            return self._work(u'%s/0' % self.node, False)
+        pool = self._pool = WorkerPool(
+            lambda index: self._work(u'%s/%d' % (self.node, index), True,
+                                     index),
+            self.workers, self.isDaemon())
+        try:
+            pool.start()
+            pool.join()
+        finally:
+            self._pool = None
+
+    def _work(self, owner, own_store, index=None):
+        # ``index`` is given when running in a ``WorkerPool``
+        pool = self._pool
+        if own_store and config.DATABASE:
+            db.use_thread_store()
+        try:
+            while not self.stop_requested:
+                if index is not None and pool.retire(index):
+                    return
+                now = datetime.datetime.utcnow()
+                try:
+                    feeds = db.backend.claim_feeds(owner, self.batch_size,
+                                                   now, now + self.lease)
+                    db.backend.commit()
+                except Exception, e:
+                    # e.g. a deadlock with another node; try again
+                    self.log.warning('Claiming feeds failed: %s' % e)
+                    db.backend.rollback()
+                    self.wait_for_stop(DEFAULT_LOOP_SLEEP)
+                    continue
+                if feeds:
+                    self._update_batch(owner, feeds)
+                elif self.once:
+                    return
+                else:
+                    self.wait_for_stop(self.idle_sleep)
+        finally:
+            if own_store and config.DATABASE:
+                db.close_thread_store()
+
+    def _update_batch(self, owner, feeds):
+        pending = [feed.id for feed in feeds]
+        expires = feeds[0].lease_expires
+        try:
+            while feeds and not self.stop_requested:
+                feed = feeds.pop(0)
+                now = datetime.datetime.utcnow()
+                if expires - now < self.lease / 2:
+                    expires = now + self.lease
+                    db.backend.renew_leases(owner, pending, expires)
+                    db.backend.commit()
+                try:
+                    self.update_feed(feed)
+                except Exception, e:
+                    self.log.error('Error updating feed #%s: %s' % (feed.id, e))
+                pending.remove(feed.id)
+                try:
+                    db.backend.release_feeds(owner, [feed.id],
+                        datetime.datetime.utcnow() + self.interval)
+                    db.backend.commit()
+                except Exception, e:
+                    # the lease will run out eventually
+                    self.log.warning('Releasing feed #%s failed: %s' % (
+                        feed.id, e))
+                    db.backend.rollback()
+                feed = None
+        finally:
+            # let others have the feeds we didn't get to
+            if pending:
+                db.backend.release_feeds(owner, pending)
+                db.backend.commit()
+
 
 class provide_queue_daemon(base_daemon):
     """Parses the feeds that are in the given queue. If the queue is
     empty, it waits until new feeds are added.
 
-    Python's ``Queue`` module is used (``queue`` in Python 3).
+    Python's ``Queue`` module is used (``queue`` in Python 3). The
+    queue may hold feed ids, as ``feedplatform.queues.FeedQueue`` does,
+    or model instances.
 
     This addin is commonly used to support "ping"-like services.
 
     Example:
 
-        queue = collections.deque()
+        queue = FeedQueue()
         [...
          provide_queue_daemon(queue),
         ...]
 
-    # TODO: add option to work as a LIFO stack.
+    If some feeds should be updated before others, say because a user
+    is waiting for them, use a ``feedplatform.queues.PriorityFeedQueue``.
+    The queue's own statistics are included in ``get_stats``.
 
     TODO: Support a mgmt command to add stuff to a queue (and possibly
     other actions, like query, pop). This should probably be implemented
@@ -267,24 +1124,56 @@ class provide_queue_daemon(base_daemon):
         super(provide_queue_daemon, self).__init__(*args, **kwargs)
         self.queue = queue
 
+    def get_stats(self):
+        stats = super(provide_queue_daemon, self).get_stats()
+        if hasattr(self.queue, 'get_stats'):
+            stats.update(self.queue.get_stats())
+        return stats
+
+    def stop(self):
+        super(provide_queue_daemon, self).stop()
+        if hasattr(self.queue, 'wakeup'):
+            self.queue.wakeup()
+
+    def _get(self):
+        if hasattr(self.queue, 'wakeup'):
+            # The queues from ``feedplatform.queues`` can be woken up
+            # by ``stop``, so we can block without a timeout, which
+            # doesn't poll, and take a new feed as soon as it arrives.
+            return self.queue.get(cancel=self.stop_event.isSet)
+        # Other queues need to be checked every now and then.
+        return self.queue.get(timeout=DEFAULT_LOOP_SLEEP)
+
     def run(self):
         while not self.stop_requested:
             try:
-                # Since Queue itself just uses an infinite loop to
-                # implement it's blocking feature, we sort of don't
-                # need to bother specifying a timeout. We'd rather
-                # use the opportunity to check ``stop_requested``
-                # more often.
-                feed = self.queue.get(timeout=0.1)
+                feed = self._get()
+                feed_id = None
+                if isinstance(feed, (int, long)):
+                    feed_id, feed = feed, None
                 try:
                     # We need to be careful here, there's really no
                     # guarantee that the feed still exists.
-                    parse.update_feed(feed)
+                    if feed_id is not None:
+                        feed = db.backend.get_feed(feed_id)
+                    if feed is None:
+                        self.log.warning('Queued feed #%d no longer '
+                                         'exists' % feed_id)
+                    else:
+                        self.update_feed(feed)
                 except Exception, e:
                     # TODO: do not catch all exceptions
                     self.log.error('Error handling queued feed: %s' % e)
+                # Queues that hold on to feeds until they are processed,
+                # like ``SQLiteFeedQueue``, need to know that we are
+                # done. Feeds that failed are not retried, only those
+                # we never got to.
+                if feed_id is not None and hasattr(self.queue, 'ack'):
+                    self.queue.ack(feed_id)
+                # don't keep the feed alive until the next one arrives
+                feed = None
             except Queue.Empty:
-                time.sleep(DEFAULT_LOOP_SLEEP)
+                pass
 
 
 class provide_socket_queue_controller(base_daemon):
@@ -293,18 +1182,30 @@ class provide_socket_queue_controller(base_daemon):
 
     ``socket`` must be either a filename, or 2-tuple of (hostname, port).
 
-    If your queue ``queue_timeout``
+    If your queue is limited in size, ``timeout`` is how long to wait
+    for it to make room before giving up. With the queues from
+    ``feedplatform.queues``, checking whether a feed is already queued
+    takes constant time; other queues need to be searched.
 
     The protocol spoken is pretty simple: The daemon expects each queue
     put request on a separate line, and each line may either consist
     of the feed's id or an url. In the latter case the url column should
     be unique - if multiple feeds currently match such a request, the
     daemon will respond with a 500 error.
-    The response is a status line in HTTP format ("CODE MSG"), with CODE
+    Any number of requests may be sent over one connection, and clients
+    need not wait for a response before sending the next request; the
+    responses are sent in the order of the requests. Empty lines are
+    ignored.
+    The feed may be followed by options, separated by spaces, in the
+    form NAME=VALUE: ``priority`` and ``deadline`` are passed along
+    to a ``feedplatform.queues.PriorityFeedQueue``, and ignored for
+    other queues. For example: "42 priority=interactive deadline=30".
+    Each response is a status line in HTTP format ("CODE MSG"), with CODE
     being one of the following:
 
-        200    ok, feed was added to queue
+        200    ok, feed was added to queue (or moved up in it)
         304    the feed is already in the queue, nothing was done
+        400    the request is invalid
         404    the given feed does not exist in the database
         500    something unexpected went wrong
         507    queue is full (if limited)
@@ -314,20 +1215,98 @@ class provide_socket_queue_controller(base_daemon):
 
     can_be_daemon_thread = False
 
-    class SocketControllerHandler(SocketServer.StreamRequestHandler):
+    class SocketControllerHandler:
+        """Implements the protocol; combined with
+        ``SocketServer.StreamRequestHandler`` in ``run()``, so that the
+        module is only loaded when the controller is actually used.
+
+        This is a classic class, like ``StreamRequestHandler`` itself,
+        as the two can't otherwise be combined.
+        """
         def handle(self):
+            # Whatever arrived in one piece is handled as one batch, so
+            # that clients sending many requests at once (see
+            # ``queuecontrol.send_many``) don't cost a query each.
+            if config.DATABASE:
+                db.use_thread_store()
+            try:
+                buffer = ''
+                while not self.server.stop_requested:
+                    data = self.connection.recv(65536)
+                    lines = (buffer + data).split('\n')
+                    buffer = lines.pop()
+                    if not data:
+                        lines.append(buffer)
+                    lines = [l.strip() for l in lines if l.strip()]
+                    if lines:
+                        self.wfile.write(''.join(['%s\n' % r for r in
+                                                  self.handle_lines(lines)]))
+                    if not data:
+                        break
+            finally:
+                if config.DATABASE:
+                    db.close_thread_store()
+
+        def handle_lines(self, lines):
+            """Return the responses to a batch of requests.
+
+            If the queue takes ids, feeds requested by id are checked
+            for existence all at once, and never loaded.
+            """
+            try:
+                feed_ids = None
+                if hasattr(self.server.queue, 'add'):
+                    ids = [int(l.split()[0]) for l in lines
+                           if l.split()[0].isdigit()]
+                    try:
+                        feed_ids = db.backend.find_feed_ids(ids)
+                    except Exception, e:
+                        return ['500 %s' % e] * len(lines)
+                return [self.handle_line(l, feed_ids) for l in lines]
+            finally:
+                if config.DATABASE:
+                    # don't hold on to the read transaction, and see
+                    # the feeds added in the meantime next time
+                    db.store.rollback()
+
+        def handle_line(self, rstr, feed_ids=None):
+            """Return the response to a single request. ``feed_ids``
+            are the existing feeds among those requested by id, if
+            already known (see ``handle_lines``).
+            """
             result = '200 Ok'
             try:
-                rstr = self.rfile.readline().strip()
-                if rstr.isdigit():
-                    feed = db.store.get(db.models.Feed, int(rstr))
+                rstr, options = self.parse_options(rstr)
+            except ValueError, e:
+                return '400 %s' % e
+            try:
+                feed = None
+                if rstr.isdigit() and feed_ids is not None:
+                    feed_id = int(rstr)
+                    if not feed_id in feed_ids:
+                        feed_id = None
                 else:
-                    feed = db.get_one(db.store.find(
-                        db.models.Feed, db.models.Feed.url == \
+                    if rstr.isdigit():
+                        feed = db.backend.get_feed(int(rstr))
+                    else:
+                        feed = db.get_one(db.backend.find_feeds(
                             unicode(rstr, 'utf8')))
+                    feed_id = feed and feed.id
 
-                if not feed:
+                if feed_id is None:
                     result = '404 Feed not found'
+                elif hasattr(self.server.queue, 'add'):
+                    if not isinstance(self.server.queue, PriorityFeedQueue):
+                        options = {}
+                    try:
+                        if not self.server.queue.add(feed_id,
+                                timeout=self.server.queue_timeout,
+                                **options):
+                            result = '304 Feed already in queue'
+                    except Queue.Full:
+                        result = '507 Queue is full'
+                    except ValueError, e:
+                        result = '400 %s' % e
                 else:
                     # We're accessing queue's internal ``deque`` object
                     # here, in order to be able to use "in". Since we're
@@ -348,7 +1327,20 @@ class provide_socket_queue_controller(base_daemon):
                         result = '304 Feed already in queue'
             except Exception, e:
                 result = '500 %s' % e
-            self.wfile.write("%s\n"%result)
+            return result
+
+        def parse_options(self, rstr):
+            parts = rstr.split()
+            options = {}
+            for part in parts[1:]:
+                name, _, value = part.partition('=')
+                if name == 'priority' and value:
+                    options[name] = int(value) if value.isdigit() else value
+                elif name == 'deadline' and value:
+                    options[name] = float(value)
+                else:
+                    raise ValueError('Invalid option: %s' % part)
+            return parts[0], options
 
     def __init__(self, queue, socket, timeout=None, *args, **kwargs):
         super(provide_socket_queue_controller, self).__init__(*args, **kwargs)
@@ -357,23 +1349,33 @@ class provide_socket_queue_controller(base_daemon):
         self.queue_timeout = timeout
 
     def run(self, *args, **options):
+        import SocketServer, select
+        class handler_class(
+                provide_socket_queue_controller.SocketControllerHandler,
+                SocketServer.StreamRequestHandler):
+            pass
+
         if isinstance(self.socket, basestring):
             server_class = SocketServer.ThreadingUnixStreamServer
             is_local_socket = True
         else:
             server_class = SocketServer.ThreadingTCPServer
             is_local_socket = False
-        server = server_class(self.socket,
-            provide_socket_queue_controller.SocketControllerHandler)
+        server = server_class(self.socket, handler_class)
         try:
             server.queue = self.queue
             server.queue_timeout = self.queue_timeout
+            server.daemon_threads = True
+            server.stop_requested = False
             while not self.stop_requested:
-                r,w,e = select.select([server.socket], [], [], 0.5)
-                if r:
+                r,w,e = select.select([server.socket, self.stop_event],
+                                      [], [])
+                if server.socket in r:
                     server.handle_request()
         finally:
             # cleanup
+            server.stop_requested = True
+            server.server_close()
             if is_local_socket:
                 os.unlink(self.socket)
 
@@ -423,6 +1425,14 @@ class provide_multi_daemon(base_daemon):
     def all_daemons(self):
         return [d for d in chain([self.main_daemon], self.other_daemons) if d]
 
+    def get_stats(self):
+        stats = super(provide_multi_daemon, self).get_stats()
+        for d in self.all_daemons:
+            child_stats = d.get_stats()
+            child_stats['feeds_updated'] += stats['feeds_updated']
+            stats.update(child_stats)
+        return stats
+
     def run(self, *args, **options):
         for d in self.all_daemons:
             # Run child as daemon if we ourselves are in daemon mode.
@@ -430,21 +1440,11 @@ class provide_multi_daemon(base_daemon):
             # about running in daemon mode, the change will be passed
             # down to use here.
             d.start(daemon=self.isDaemon())
-        while not self.stop_requested:
-            for d in self.all_daemons:
-                # TODO: Using join() here seems to be actually more
-                # resource heavy than checking isAlive of every thread
-                # manually, and having a time.sleep() call (+0.2% CPU
-                # on my MacMini 2nd Gen. The same is probably true for
-                # the join() call in ``StartDaemonCommand``. Maybe we
-                # should revert the change that introduced this (see
-                # changeset 239).
-                d.join(DEFAULT_LOOP_SLEEP)
+        # Joining the children with a timeout, as we used to, has a
+        # measurable CPU cost, as does checking on them and sleeping.
+        # Blocking waits don't.
+        self.wait_for_stop()
         for d in self.all_daemons:
             d.stop()
-        while any([d.isAlive() for d in self.all_daemons]):
-             # wait until all childs stopped
-             # TODO: shutdown should hopefully happen fast, is a sleep
-             # necessary here or does it actually hurt by adding more
-             # delay?
-            time.sleep(DEFAULT_LOOP_SLEEP)
+        for d in self.all_daemons:
+            d.join()
@@ -3,4 +3,5 @@
 
 from http import *
 from collect_feed_data import *
-from images import *
\ No newline at end of file
+from images import *
+from websub import *
\ No newline at end of file
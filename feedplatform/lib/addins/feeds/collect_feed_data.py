@@ -98,6 +98,22 @@ class base_data_collector(addins.base):
         return {self.model_name: dict([(k['target'], k['field'])
                     for n, k in self.fields.iteritems()])}
 
+    def _get_source_fields(self):
+        """Return the names of the keys this collector reads from the
+        source dict.
+
+        Subclasses can use this to implement ``get_entry_fields``.
+        Special fields (``__now``) are not included.
+        """
+        result = []
+        for source_name in self.fields:
+            if source_name.startswith('__'):
+                continue
+            if self.date_fields and source_name in self.date_fields:
+                source_name = "%s_parsed" % source_name
+            result.append(source_name)
+        return result
+
     def _process(self, obj, source_dict, *args, **kwargs):
         """Call this in your respective subclass hook callback.
 
@@ -1,17 +1,25 @@
 """Addins that relate to HTTP functionality.
 """
 
-from storm.locals import DateTime, Unicode
+import datetime
+import calendar
+import httplib
+import email.utils
+
+from storm.locals import DateTime, Int, Unicode
 
 from feedplatform import addins
 from feedplatform import db
+from feedplatform import net
 from feedplatform.util import \
-    datetime_to_struct, struct_to_datetime, to_unicode
+    datetime_to_struct, struct_to_datetime, to_unicode, asciify_url
 
 
 __all__ = (
     'update_redirects',
     'save_bandwith',
+    'backoff_failures',
+    'remember_redirects',
 )
 
 
@@ -72,9 +80,9 @@ class update_redirects(addins.base):
         if data_dict.status == 301:
             new_url = data_dict.href
             self.log.info('Feed #%d: permanent redirect to %s' % (feed.id, new_url))
-            dup_feeds = db.store.find(db.models.Feed, db.models.Feed.url == new_url)
+            dup_feeds = db.backend.find_feeds(new_url)
 
-            if dup_feeds.any():
+            if dup_feeds:
                 return self._conflict_strategy(feed, new_url, dup_feeds)
             else:
                 feed.url = new_url
@@ -82,7 +90,7 @@ class update_redirects(addins.base):
     def _delete_self(self, feed, new_url, dup_feeds):
         self.log.info('Redirect target already exists: removing self')
         # XXX: delete related objects
-        db.store.remove(feed)
+        db.backend.remove(feed)
 
         # don't process this feed further
         return False
@@ -95,7 +103,7 @@ class update_redirects(addins.base):
             # XXX: we need a solution to delete related objects as well.
             # Storm doesn't seem to do it, and ON DELETE * is not
             # supported by every database backend.
-            db.store.remove(f)
+            db.backend.remove(f)
         self.log.debug('%d duplicate feeds removed' % count)
         feed.url = new_url
 
@@ -165,4 +173,191 @@ class save_bandwith(addins.base):
 
     def _get_modified(self, feed):
         if not self.custom_storage:
-            return feed.http_modified
\ No newline at end of file
+            return feed.http_modified
+
+class backoff_failures(addins.base):
+    """Stop wasting time on feeds that fail, or are gone for good.
+
+    Whenever a feed can't be fetched, be it due to a timeout or other
+    network error, or a HTTP status code of 400 and above, the number
+    of consecutive failures is increased, the type of error recorded,
+    and the feed will not be requested again until a delay has
+    passed. The delay starts at ``delay`` seconds and doubles with
+    every further failure, up to ``max_delay``. If the server sends a
+    ``Retry-After`` header, we will not come back any earlier than
+    requested.
+
+    A feed that returns 410 Gone, or has failed continuously for
+    ``park_after`` seconds, is parked: it will no longer be updated
+    at all, until you reset the ``parked`` field. Set ``park_after``
+    to None to only park feeds that are gone. All three values may
+    also be given as ``timedelta`` instances.
+
+    Once a feed can be fetched again, the failure count is reset.
+
+    Note that failed feeds are not processed any further, i.e. other
+    ``after_parse`` hooks after this addin will not run for them.
+    """
+
+    def __init__(self, delay=60, max_delay=86400, park_after=86400*30):
+        self.delay = self._to_timedelta(delay)
+        self.max_delay = self._to_timedelta(max_delay)
+        self.park_after = self._to_timedelta(park_after)
+
+    def _to_timedelta(self, value):
+        if value is None or isinstance(value, datetime.timedelta):
+            return value
+        return datetime.timedelta(seconds=value)
+
+    def get_fields(self):
+        return {'feed': {
+            'failures': (Int, (), {'default': 0}),
+            'failure_class': (Unicode, (), {}),
+            'failing_since': (DateTime, (), {}),
+            'next_attempt': (DateTime, (), {}),
+            'parked': (DateTime, (), {}),
+        }}
+
+    def on_before_parse(self, feed, parser_args):
+        if feed.parked:
+            self.log.debug('Feed #%d: parked since %s, skipping' % (
+                feed.id, feed.parked))
+            return True
+        if feed.next_attempt and \
+           datetime.datetime.utcnow() < feed.next_attempt:
+            self.log.debug('Feed #%d: failed %d times (%s), backing off '
+                'until %s' % (feed.id, feed.failures, feed.failure_class,
+                              feed.next_attempt))
+            return True
+
+    def on_after_parse(self, feed, data_dict):
+        error = self._get_error(data_dict)
+        if not error:
+            if feed.failures:
+                self.log.info('Feed #%d: recovered after %d failures' % (
+                    feed.id, feed.failures))
+                feed.failures = 0
+                feed.failure_class = feed.failing_since = None
+                feed.next_attempt = None
+            return
+
+        now = datetime.datetime.utcnow()
+        feed.failures = (feed.failures or 0) + 1
+        feed.failure_class = error
+        if not feed.failing_since:
+            feed.failing_since = now
+
+        if data_dict.get('status') == 410:
+            self.log.warn('Feed #%d: gone (status 410), parking' % feed.id)
+            feed.parked = now
+        elif self.park_after is not None and \
+             now - feed.failing_since >= self.park_after:
+            self.log.warn('Feed #%d: failing since %s (%s), parking' % (
+                feed.id, feed.failing_since, error))
+            feed.parked = now
+        else:
+            delay = self._get_delay(feed.failures)
+            retry_after = self._get_retry_after(data_dict, now)
+            if retry_after and retry_after > delay:
+                delay = retry_after
+            feed.next_attempt = now + delay
+            self.log.info('Feed #%d: failure %d (%s), next attempt at %s' % (
+                feed.id, feed.failures, error, feed.next_attempt))
+
+        # don't process the error response any further
+        return True
+
+    def _get_delay(self, failures):
+        """Return the delay after ``failures`` consecutive failures.
+
+        This is calculated in seconds, and capped before the timedelta
+        is created; doubling the delay as a ``timedelta`` overflows
+        after a few dozen failures.
+        """
+        seconds = self.delay.seconds + self.delay.days * 86400
+        # 2**63 is more than enough to exceed any sensible max_delay
+        seconds = seconds * 2.0**min(failures-1, 63)
+        seconds = min(seconds, self.max_delay.days * 86400 +
+                               self.max_delay.seconds)
+        return datetime.timedelta(seconds=seconds)
+
+    def _get_error(self, data_dict):
+        """Return a string describing the kind of error that occured
+        while fetching the feed, or None if it was successful.
+        """
+        status = data_dict.get('status')
+        if status and status >= 400:
+            return u'http_%d' % status
+        # the parser also reports syntax errors in bozo_exception;
+        # we are only interested in those that occur while fetching.
+        e = data_dict.get('bozo_exception')
+        if isinstance(e, (IOError, httplib.HTTPException)):
+            # URLError wraps the actual problem, e.g. a timeout
+            if isinstance(getattr(e, 'reason', None), Exception):
+                e = e.reason
+            return to_unicode(e.__class__.__name__)
+        return None
+
+    def _get_retry_after(self, data_dict, now):
+        """Parse the ``Retry-After`` header, which can be either a
+        number of seconds or a HTTP date, into a ``timedelta``.
+        """
+        value = data_dict.get('headers', {}).get('retry-after')
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return datetime.timedelta(seconds=int(value))
+        date = email.utils.parsedate_tz(value)
+        if date:
+            return datetime.datetime.utcfromtimestamp(
+                email.utils.mktime_tz(date)) - now
+        return None
+
+class remember_redirects(addins.base):
+    """Stores the redirects a feed's url leads to with the feed, so
+    that they can still be skipped after a restart.
+
+    Redirects are recorded and skipped by ``feedplatform.net`` (see
+    the REDIRECT_CACHE_TTL setting), but only for as long as the
+    process runs. This addin persists what is known about a feed's
+    url: the final target, the status of the last redirect, and when
+    the redirects expire, if they are temporary.
+    """
+
+    def get_fields(self):
+        return {'feed': {
+            'redirect_url': (Unicode, (), {}),
+            'redirect_status': (Int, (), {}),
+            'redirect_expires': (DateTime, (), {}),
+        }}
+
+    def on_before_parse(self, feed, parser_args):
+        cache = net.get_redirect_cache()
+        if cache is None or not feed.redirect_url:
+            return
+        url = asciify_url(feed.url)
+        # what we found out since is more recent
+        if cache.lookup(url)[3]:
+            return
+        expires = None
+        if feed.redirect_expires:
+            if feed.redirect_expires <= datetime.datetime.utcnow():
+                return
+            expires = calendar.timegm(feed.redirect_expires.utctimetuple())
+        cache.add(url, feed.redirect_url.encode('latin-1'),
+                  feed.redirect_status, expires)
+
+    def on_after_parse(self, feed, data_dict):
+        cache = net.get_redirect_cache()
+        if cache is None:
+            return
+        target, status, expires, hops = cache.lookup(asciify_url(feed.url))
+        if hops:
+            feed.redirect_url = target.decode('latin-1')
+            feed.redirect_status = status
+            feed.redirect_expires = expires and \
+                datetime.datetime.utcfromtimestamp(expires)
+        else:
+            feed.redirect_url = feed.redirect_status = None
+            feed.redirect_expires = None
\ No newline at end of file
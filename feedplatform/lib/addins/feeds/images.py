@@ -42,7 +42,6 @@ from feedplatform import addins
 from feedplatform import db
 from feedplatform import hooks
 from feedplatform import util
-from feedplatform.deps import thumbnail
 from collect_feed_data import base_data_collector
 
 
@@ -117,6 +116,13 @@ class RemoteImage(object):
         """
         return hasattr(self, '_request')
 
+    def close(self):
+        """Close the HTTP request, if one was made. Until then, it
+        counts against the limits of the image's host.
+        """
+        if self.request_opened:
+            self._request.close()
+
     @property
     def content_type(self):
         """Return the images mime type, as indicated by the server in
@@ -530,6 +536,8 @@ class handle_feed_images(addins.base):
             hooks.trigger('feed_image_failed',
                         args=[feed, image_dict, image, e],)
             return
+        finally:
+            image.close()
 
 
 class feed_image_restrict_size(addins.base):
@@ -734,6 +742,8 @@ class feed_image_thumbnails(store_feed_images):
         super(feed_image_thumbnails, self).__init__(path, format)
 
     def on_update_feed_image(self, feed, image_dict, image):
+        # requires PIL, which we only want to load when needed
+        from feedplatform.deps import thumbnail
         for size in self.sizes:
             path = self._resolve_path(feed, image, {
                 'width': size[0],
@@ -0,0 +1,417 @@
+"""Addins that let feeds which support WebSub (formerly known as
+PubSubHubbub) be pushed to us, rather than polling them.
+
+A feed that supports WebSub advertises a hub (``<link rel="hub">``).
+We ask the hub to notify us, at a callback url, whenever the feed
+changes. The hub then first verifies that we actually asked for this,
+and from then on sends us the new content of the feed.
+
+Two addins are involved: ``websub_subscribe`` manages the
+subscriptions while feeds are updated as usual, and
+``provide_websub_daemon`` runs the HTTP server the hubs talk to,
+putting the feeds they notify us about on a queue, as processed by
+``provide_queue_daemon``:
+
+    queue = Queue.Queue()
+    ADDINS = [
+        websub_subscribe('http://example.org:8080/', secret='...'),
+        provide_multi_daemon(provide_queue_daemon(queue), [
+            provide_websub_daemon(queue, ('', 8080))], name='push'),
+        ...
+    ]
+
+See https://www.w3.org/TR/websub/.
+"""
+
+import cgi
+import hmac
+import urllib
+import urllib2
+import httplib
+import hashlib
+import datetime
+import threading
+import Queue
+from cStringIO import StringIO
+
+from storm.locals import DateTime, Unicode
+
+from feedplatform import addins
+from feedplatform import db
+from feedplatform import util
+from feedplatform.conf import config
+from feedplatform.lib.addins.doers.daemons import base_daemon
+
+
+__all__ = (
+    'websub_subscribe',
+    'provide_websub_daemon',
+)
+
+
+class _PushedContentHandler(urllib2.BaseHandler):
+    """Serves the content a hub pushed to us, instead of fetching the
+    feed again.
+    """
+
+    # before any handler that would actually go out to the network
+    handler_order = 100
+
+    def __init__(self, content, content_type):
+        self.content = content
+        self.content_type = content_type
+
+    def http_open(self, req):
+        headers = httplib.HTTPMessage(StringIO(
+            'Content-Type: %s\r\n\r\n' % self.content_type))
+        response = urllib.addinfourl(StringIO(self.content), headers,
+                                     req.get_full_url(), 200)
+        response.msg = 'OK'
+        return response
+    https_open = http_open
+
+
+class websub_subscribe(addins.base):
+    """Subscribes to the hubs that feeds advertise, and keeps the
+    subscriptions alive.
+
+    ``callback_url`` is the url under which ``provide_websub_daemon``
+    can be reached from the outside; the feed id is appended to it.
+
+    If ``secret`` is given, hubs are asked to sign the content they
+    send, and content that isn't signed correctly is ignored. Each
+    feed uses a different secret derived from it.
+
+    Feeds with an active subscription are still polled, but only every
+    ``poll_interval`` seconds, in case the hub fails us. Subscriptions
+    are requested for ``lease_seconds``, and renewed when they are
+    about to expire.
+    """
+
+    def __init__(self, callback_url, secret=None, lease_seconds=86400*10,
+                 poll_interval=86400):
+        self.callback_url = callback_url.rstrip('/')
+        self.secret = secret
+        self.lease_seconds = lease_seconds
+        self.poll_interval = datetime.timedelta(seconds=poll_interval)
+        # if the hub doesn't verify a request in this time, we try again
+        self.request_timeout = datetime.timedelta(hours=1)
+        self._pushed = {}
+        self._lock = threading.Lock()
+
+    def get_fields(self):
+        return {'feed': {
+            'websub_hub': (Unicode, (), {}),
+            'websub_topic': (Unicode, (), {}),
+            'websub_requested': (DateTime, (), {}),
+            'websub_expires': (DateTime, (), {}),
+            'websub_polled': (DateTime, (), {}),
+        }}
+
+    def get_callback_url(self, feed):
+        return '%s/%d' % (self.callback_url, feed.id)
+
+    def get_secret(self, feed):
+        if self.secret:
+            return hmac.new(self.secret, str(feed.id),
+                            hashlib.sha1).hexdigest()
+
+    def is_subscribed(self, feed):
+        return bool(feed.websub_expires and
+                    feed.websub_expires > datetime.datetime.utcnow())
+
+    def push(self, feed_id, content=None, content_type=None):
+        """Called by the daemon when a hub notifies us. ``content``
+        will be used the next time the feed is updated, rather than
+        fetching it, unless it is ``None``.
+        """
+        self._lock.acquire()
+        try:
+            self._pushed[feed_id] = (content, content_type)
+        finally:
+            self._lock.release()
+
+    def discard(self, feed_id):
+        """Forget the content pushed for the feed, e.g. because the
+        daemon could not queue it, and the hub will try again.
+        """
+        self._lock.acquire()
+        try:
+            self._pushed.pop(feed_id, None)
+        finally:
+            self._lock.release()
+
+    def on_before_parse(self, feed, parser_args):
+        self._lock.acquire()
+        try:
+            pushed = self._pushed.pop(feed.id, None)
+        finally:
+            self._lock.release()
+
+        now = datetime.datetime.utcnow()
+        if pushed is not None:
+            content, content_type = pushed
+            if content is not None:
+                self.log.debug('Feed #%d: using pushed content' % feed.id)
+                parser_args['handlers'] = [
+                    _PushedContentHandler(content, content_type)] + \
+                    list(parser_args['handlers'])
+            return
+
+        if self.is_subscribed(feed):
+            if feed.websub_polled and \
+               now - feed.websub_polled < self.poll_interval:
+                self.log.debug('Feed #%d: pushed by hub, not polling' % (
+                    feed.id))
+                return True
+            feed.websub_polled = now
+
+    def on_after_parse(self, feed, data_dict):
+        if data_dict.get('status', 200) >= 400 or not data_dict.get('feed'):
+            return
+
+        hub = topic = None
+        for link in data_dict.feed.get('links', []):
+            if link.get('rel') == 'hub' and not hub:
+                hub = link.get('href')
+            elif link.get('rel') == 'self' and not topic:
+                topic = link.get('href')
+        topic = topic or data_dict.get('href') or feed.url
+        hub, topic = util.to_unicode(hub), util.to_unicode(topic)
+
+        if hub != feed.websub_hub or (hub and topic != feed.websub_topic):
+            if feed.websub_hub and self.is_subscribed(feed):
+                self._request(feed, 'unsubscribe')
+            feed.websub_hub = hub
+            feed.websub_topic = hub and topic or None
+            feed.websub_requested = feed.websub_expires = None
+            feed.websub_polled = None
+
+        if not hub:
+            return
+        now = datetime.datetime.utcnow()
+        if feed.websub_requested and \
+           now - feed.websub_requested < self.request_timeout:
+            return
+        renew_at = feed.websub_expires and \
+            feed.websub_expires - 2 * self.poll_interval
+        if not renew_at or renew_at <= now:
+            if self._request(feed, 'subscribe'):
+                feed.websub_requested = now
+
+    def _request(self, feed, mode):
+        params = {
+            'hub.mode': mode,
+            'hub.topic': feed.websub_topic.encode('utf-8'),
+            'hub.callback': self.get_callback_url(feed),
+        }
+        if mode == 'subscribe':
+            params['hub.lease_seconds'] = str(self.lease_seconds)
+            if self.secret:
+                params['hub.secret'] = self.get_secret(feed)
+        self.log.info('Feed #%d: sending %s request to hub %s' % (
+            feed.id, mode, feed.websub_hub))
+        return self._post(feed.websub_hub, params)
+
+    def _post(self, url, params):
+        try:
+            util.urlopen(url, urllib.urlencode(params)).close()
+        except util.UrlOpenError, e:
+            self.log.warning('Request to hub %s failed: %s' % (url, e))
+            return False
+        return True
+
+
+# the algorithms hubs may sign content with
+SIGNATURE_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'sha384': hashlib.sha384,
+    'sha512': hashlib.sha512,
+}
+
+
+def _compare_digest(a, b):
+    """Compare two strings in constant time, so that the time taken
+    doesn't tell an attacker how much of a signature was right.
+    """
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def _with_thread_store(func):
+    """Requests are handled in the server's thread, while feeds are
+    updated in others; give it a store of its own, rather than
+    committing changes of the shared store that aren't ours.
+    """
+    def wrapper(self):
+        if config.DATABASE:
+            db.use_thread_store()
+        try:
+            return func(self)
+        finally:
+            if config.DATABASE:
+                db.close_thread_store()
+    wrapper.__name__, wrapper.__doc__ = func.__name__, func.__doc__
+    return wrapper
+
+
+class WebSubRequestHandler:
+    """Answers the requests of hubs; combined with
+    ``BaseHTTPServer.BaseHTTPRequestHandler`` in ``run()``.
+    """
+
+    def _check_signature(self, secret, content):
+        header = self.headers.getheader('X-Hub-Signature') or ''
+        method, _, signature = header.partition('=')
+        digestmod = SIGNATURE_ALGORITHMS.get(method.lower())
+        if digestmod is None:
+            return False
+        expected = hmac.new(secret, content, digestmod).hexdigest()
+        return _compare_digest(signature.lower(), expected)
+
+    def _get_feed(self):
+        path, _, query = self.path.partition('?')
+        self.params = dict([(k, v[-1]) for k, v in
+                            cgi.parse_qs(query).items()])
+        feed_id = path.strip('/')
+        if not feed_id.isdigit():
+            return None
+        return db.backend.get_feed(int(feed_id))
+
+    def _respond(self, code, body=''):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @_with_thread_store
+    def do_GET(self):
+        """Verification of intent: does the (un)subscription the hub
+        is asking about match what we want?
+        """
+        subscriber = self.server.subscriber
+        feed = self._get_feed()
+        mode = self.params.get('hub.mode')
+        topic = util.to_unicode(self.params.get('hub.topic'))
+        wanted = feed is not None and feed.websub_hub and \
+            topic == feed.websub_topic
+
+        if mode == 'subscribe' and wanted:
+            lease = self.params.get('hub.lease_seconds', '')
+            lease = lease.isdigit() and int(lease) or \
+                subscriber.lease_seconds
+            feed.websub_requested = None
+            feed.websub_expires = datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=lease)
+            feed.websub_polled = datetime.datetime.utcnow()
+            db.backend.commit()
+            self.server.log.info('Feed #%d: subscribed at hub for %d '
+                                 'seconds' % (feed.id, lease))
+        elif mode == 'unsubscribe' and not wanted:
+            pass
+        elif mode == 'denied' and feed is not None:
+            feed.websub_requested = feed.websub_expires = None
+            db.backend.commit()
+            self.server.log.warning('Feed #%d: subscription denied by hub '
+                                    '(%s)' % (feed.id,
+                                    self.params.get('hub.reason')))
+            return self._respond(200)
+        else:
+            return self._respond(404)
+        self._respond(200, self.params.get('hub.challenge', ''))
+
+    @_with_thread_store
+    def do_POST(self):
+        """Content distribution.
+        """
+        subscriber = self.server.subscriber
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if config.FEED_MAX_SIZE is not None and length > config.FEED_MAX_SIZE:
+            return self._respond(413)
+        content = self.rfile.read(length)
+
+        feed = self._get_feed()
+        if feed is None or not subscriber.is_subscribed(feed):
+            return self._respond(410)
+
+        # content that isn't properly signed is to be acknowledged, but
+        # otherwise ignored
+        secret = subscriber.get_secret(feed)
+        if secret and not self._check_signature(secret, content):
+            self.server.log.warning('Feed #%d: ignoring content with '
+                                    'invalid signature' % feed.id)
+            return self._respond(202)
+
+        # Hubs may also just tell us that the feed has changed
+        content_type = self.headers.getheader('Content-Type', '')
+        if not content.strip() or not 'xml' in content_type:
+            content = None
+        # the content needs to be in place before the feed can be
+        # picked up from the queue
+        subscriber.push(feed.id, content, content_type)
+        try:
+            # the feed belongs to this thread's store; pass its id
+            self.server.queue.put(feed.id,
+                                  timeout=self.server.queue_timeout)
+        except Queue.Full:
+            subscriber.discard(feed.id)
+            return self._respond(503)
+        self._respond(202)
+
+    def log_message(self, format, *args):
+        self.server.log.debug(format % args)
+
+
+class provide_websub_daemon(base_daemon):
+    """Runs the HTTP server hubs send their requests to, at the
+    (host, port) ``address``, and puts the ids of the feeds they notify
+    us about on ``queue`` (see ``provide_queue_daemon``).
+
+    Signatures may use any of the ``SIGNATURE_ALGORITHMS``.
+
+    Requires ``websub_subscribe`` to be installed as well.
+
+    ``timeout`` is how long to wait if the queue is full. If it stays
+    full, the hub is asked to try again later.
+    """
+
+    def __init__(self, queue, address, timeout=None, *args, **kwargs):
+        super(provide_websub_daemon, self).__init__(*args, **kwargs)
+        self.queue = queue
+        self.address = address
+        self.queue_timeout = timeout
+        self.server = None
+
+    def run(self, *args, **options):
+        import BaseHTTPServer, select
+        subscribers = [a for a in addins.get_addins()
+                       if isinstance(a, websub_subscribe)]
+        if not subscribers:
+            raise RuntimeError('provide_websub_daemon requires the '
+                               'websub_subscribe addin')
+
+        class handler_class(WebSubRequestHandler,
+                            BaseHTTPServer.BaseHTTPRequestHandler):
+            pass
+        server = BaseHTTPServer.HTTPServer(self.address, handler_class)
+        server.subscriber = subscribers[0]
+        server.queue = self.queue
+        server.queue_timeout = self.queue_timeout
+        server.log = self.log
+        self.server = server
+        try:
+            while not self.stop_requested:
+                r,w,e = select.select([server.socket, self.stop_event],
+                                      [], [])
+                if server.socket in r:
+                    server.handle_request()
+        finally:
+            server.server_close()
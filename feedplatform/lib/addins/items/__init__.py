@@ -3,4 +3,5 @@
 
 from guid import *
 from collect_item_data import *
-from enclosures import *
\ No newline at end of file
+from enclosures import *
+from unchanged import *
\ No newline at end of file
@@ -30,6 +30,9 @@ class collect_item_data(base_data_collector):
     }
     date_fields = ('updated',)
 
+    def get_entry_fields(self):
+        return self._get_source_fields()
+
     def on_found_item(self, feed, item, entry_dict):
         return self._process(item, entry_dict)
 
@@ -89,6 +89,9 @@ class store_enclosures(addins.base):
             }
         }
 
+    def get_entry_fields(self):
+        return ('enclosures',)
+
     def on_process_item(self, feed, item, entry_dict, item_created):
         """
         Per the suggested protocol, we're using ``process_item``, since we
@@ -98,15 +101,19 @@ class store_enclosures(addins.base):
 
         enclosures = entry_dict.get('enclosures', ())
 
-        # check for deleted enclosures (don't bother with new items)
+        # Load the existing enclosures in one go (don't bother with new
+        # items), and check for those that have been deleted.
+        existing = {}
         if not item_created:
             available_hrefs = [e.get('href') for e in enclosures]
-            for enclosure in item.enclosures:
+            for enclosure in db.backend.get_enclosures(item):
                 if not enclosure.href in available_hrefs:
                     self.log.debug('Item #%d: enclosure #%d ("%s") no '
                         'longer exists - deleting.' % (
                             item.id, enclosure.id, enclosure.href))
-                    db.store.remove(enclosure)
+                    db.backend.remove(enclosure)
+                else:
+                    existing.setdefault(enclosure.href, []).append(enclosure)
 
         # add new enclosures
         for enclosure_dict in enclosures:
@@ -117,10 +124,7 @@ class store_enclosures(addins.base):
                 continue
 
             try:
-                enclosure = db.get_one(
-                    db.store.find(db.models.Enclosure,
-                        db.models.Enclosure.href == href,
-                        db.models.Enclosure.item_id == item.id))
+                enclosure = db.get_one(existing.get(href, []))
             except db.MultipleObjectsReturned:
                 # TODO: log a warning/error, provide a hook
                 # TODO: test for this case
@@ -135,7 +139,9 @@ class store_enclosures(addins.base):
                     enclosure = db.models.Enclosure()
                     enclosure.item = item
                     enclosure.href = href
-                    db.store.add(enclosure)
+                    db.backend.add(enclosure)
+                # the item may list the same enclosure multiple times
+                existing[href] = [enclosure]
 
                 # HOOK: NEW_ENCLOSURE
                 hooks.trigger('new_enclosure',
@@ -206,6 +212,11 @@ class collect_enclosure_data(base_data_collector):
         else:
             return self.USE_DEFAULT
 
+    def get_entry_fields(self):
+        # enclosure fields are part of ``enclosures``, but the
+        # duration is read from the item itself.
+        return ('enclosures', 'itunes_duration',)
+
     def on_found_enclosure(self, feed, enclosure, enclosure_dict):
         return self._process(enclosure, enclosure_dict)
 
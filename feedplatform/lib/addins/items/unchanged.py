@@ -0,0 +1,131 @@
+"""Addins that help avoid redundant work for items that have not
+changed since they were last seen.
+"""
+
+import time
+import base64
+from hashlib import md5
+from storm.locals import Unicode
+
+from feedplatform import addins
+
+
+__all__ = (
+    'skip_unchanged_items',
+)
+
+
+class skip_unchanged_items(addins.base):
+    """Stores a compact fingerprint of every item's entry data, and
+    uses it to skip the ``found_item`` and ``process_item`` hooks for
+    items that have not changed since the last update.
+
+    Most feeds will contain mostly entries we already know about, and
+    which, more likely than not, have not changed in the meantime.
+    Without this addin, collectors and ``store_enclosures`` would
+    nevertheless redo their work every single time.
+
+    The fingerprint covers only those fields of the entry that the
+    installed addins declare they are interested in. To do so, an
+    addin provides a ``get_entry_fields`` method, returning an
+    iterable of ``entry_dict`` keys it reads:
+
+        class my_addin(addins.base):
+            def get_entry_fields(self):
+                return ('title', 'link',)
+            def on_found_item(self, feed, item, entry_dict):
+                ...
+
+    If any addin uses the ``found_item`` or ``process_item`` hooks
+    (or the enclosure equivalents) without declaring its fields, there
+    is no way for us to know what it depends on, and the full entry is
+    used to calculate the fingerprint. Things will still work, but
+    changes that are irrelevant to all of your addins will cause
+    items to be reprocessed.
+
+    Pass the ``full`` option to ``update_feed`` to force all items
+    to be processed regardless, e.g.:
+
+        update_feed(feed, options={'full': True})
+
+    ``field`` can be used to change the name of the model field the
+    fingerprint is stored in.
+    """
+
+    # Hooks whose callbacks we expect to operate on entry data; any
+    # addin providing them needs to tell us what it uses.
+    item_hooks = ('found_item', 'process_item', 'create_enclosure',
+                  'new_enclosure', 'found_enclosure', 'process_enclosure',)
+
+    def __init__(self, field='fingerprint'):
+        self.field = field
+
+    def get_fields(self):
+        return {'item': {self.field: (Unicode, (), {})}}
+
+    def get_entry_fields(self):
+        # we don't need anything, but we need to say so
+        return ()
+
+    def _get_relevant_fields(self):
+        """Determine the entry fields the installed addins depend on.
+
+        Returns ``None`` if the full entry needs to be considered.
+        The result is cached for as long as the list of installed
+        addins doesn't change.
+        """
+        installed = addins.get_addins()
+        if getattr(self, '_fields_for', None) is not installed:
+            fields = set()
+            for addin in installed:
+                if hasattr(addin, 'get_entry_fields'):
+                    fields.update(addin.get_entry_fields())
+                elif [h for h in self.item_hooks if hasattr(addin, 'on_%s' % h)]:
+                    self.log.debug('%s does not declare the entry fields '
+                        'it uses, fingerprinting full entries' % addin)
+                    fields = None
+                    break
+            self._fields_for, self._fields = installed, fields
+        return self._fields
+
+    def _fingerprint(self, entry_dict):
+        fields = self._get_relevant_fields()
+        if fields is None:
+            fields = entry_dict.keys()
+        data = [(name, _canonical(entry_dict.get(name)))
+                for name in sorted(fields)]
+        digest = md5(repr(data)).digest()
+        return unicode(base64.urlsafe_b64encode(digest).rstrip('='))
+
+    def on_check_item(self, feed, item, entry_dict):
+        self._current = entry_dict, self._fingerprint(entry_dict)
+        if getattr(item, self.field) == self._current[1]:
+            return True
+
+    def on_found_item(self, feed, item, entry_dict):
+        # reuse the value calculated in check_item, if available
+        current = getattr(self, '_current', (None, None))
+        if current[0] is entry_dict:
+            fingerprint = current[1]
+        else:
+            fingerprint = self._fingerprint(entry_dict)
+        setattr(item, self.field, fingerprint)
+
+    def on_new_item(self, feed, item, entry_dict):
+        setattr(item, self.field, self._fingerprint(entry_dict))
+
+
+def _canonical(value):
+    """Convert ``value`` to a structure with a stable ``repr``, i.e.
+    dicts are replaced with sorted lists of (key, value) pairs, and
+    strings are normalized to bytestrings.
+    """
+    if hasattr(value, 'keys'):
+        return [(k, _canonical(value[k])) for k in sorted(value.keys())]
+    elif isinstance(value, time.struct_time):
+        return tuple(value)
+    elif isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    elif isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
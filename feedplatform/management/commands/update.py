@@ -0,0 +1,48 @@
+"""Update a single feed right away, optionally profiling the update.
+"""
+
+from optparse import make_option
+from feedplatform.management import BaseCommand, CommandError
+from feedplatform import db
+from feedplatform import log
+from feedplatform import parse
+from feedplatform import profiling
+
+
+class Command(BaseCommand):
+    help = 'Updates the feed with the given id or url.'
+    args = 'feed'
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', default=False,
+            help='Process all items, even those that are unchanged.'),
+        make_option('--profile', default=None, metavar='FILE',
+            help='Profile the update, and write the result to FILE, in '
+                 'the callgrind format if the name ends with ".callgrind", '
+                 'otherwise for the pstats module.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('expected the id or url of a single feed')
+        if args[0].isdigit():
+            feed = db.backend.get_feed(int(args[0]))
+        else:
+            try:
+                feed = db.get_one(db.backend.find_feeds(
+                    unicode(args[0], 'utf8')))
+            except db.MultipleObjectsReturned:
+                raise CommandError('multiple feeds match %s' % args[0])
+        if feed is None:
+            raise CommandError('no such feed: %s' % args[0])
+
+        progress = parse.UpdateProgress(feed)
+        update_options = options.get('full') and {'full': True} or {}
+        if options.get('profile'):
+            profiler = profiling.Profiler(options['profile'],
+                                          log=log.log)
+            profiler.runcall(parse.update_feed, feed, update_options,
+                             progress)
+            profiler.close()
+        else:
+            parse.update_feed(feed, update_options, progress)
+        print 'Feed #%d: %s' % (progress.feed_id, progress.summary())
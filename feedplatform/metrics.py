@@ -0,0 +1,448 @@
+"""Counters and histograms about the work done by this process, to
+be exported in the Prometheus text format.
+
+The core records the following as feeds are updated:
+
+    feedplatform_updates_total{status}
+        feed updates, by HTTP status ("none" if there was no response)
+    feedplatform_items_created_total
+        new items
+    feedplatform_downloaded_bytes_total
+        bytes downloaded, before decompression
+    feedplatform_stage_seconds{stage}
+        time spent per feed on "fetch" (the network), "parse" (the
+        feed parser) and "store" (handling the items, including the
+        addins involved, and writing them to the database)
+    feedplatform_errors_total{error}
+        errors, by class: exceptions raised while updating a feed, and
+        those the feed parser ran into (see ``bozo_exception``)
+
+Addins can add metrics of their own to ``registry``.
+
+If the DAEMON_STATS_ADDRESS setting is given, a running daemon serves
+these, and its statistics (see ``base_daemon.get_stats``), over HTTP
+(see ``MetricsServer``). The ``stats`` command queries them.
+"""
+
+import os
+import time
+import errno
+import socket
+import threading
+
+from feedplatform import util
+
+
+__all__ = ('Counter', 'Histogram', 'Registry', 'registry', 'merge',
+           'render', 'parse_text', 'quantile', 'MetricsServer', 'fetch',)
+
+
+# in seconds; a good fit for the stages of a feed update
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)
+
+
+class Metric(object):
+    """Base class of metrics with a value per combination of the
+    values of their ``labels``.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError('%s needs the labels %s' % (
+                self.name, ', '.join(self.labels)))
+        return tuple([str(labels[name]) for name in self.labels])
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.values = {}
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """Return the current values in a form that can be serialized
+        as JSON, merged with others, and rendered.
+        """
+        self.lock.acquire()
+        try:
+            samples = [[list(key), self._copy(value)]
+                       for key, value in self.values.items()]
+        finally:
+            self.lock.release()
+        return {'type': self.type, 'help': self.help,
+                'labels': list(self.labels), 'samples': samples}
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    """A value that only goes up.
+
+        requests = Counter('myaddin_requests_total', 'Requests made',
+                           labels=('host',))
+        requests.inc(host='example.org')
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    """Counts observed values in ``buckets``, given as the upper
+    bounds of each; ``quantile`` can estimate percentiles from them.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.lock.acquire()
+        try:
+            counts = self.values.get(key)
+            if counts is None:
+                # one per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        result = super(Histogram, self).snapshot()
+        result['buckets'] = list(self.buckets)
+        return result
+
+    def _copy(self, value):
+        return list(value)
+
+
+class Registry(object):
+    """A set of metrics, by name.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        """Add ``metric``, and return it; if there already is one with
+        that name, that one is returned instead, so modules can
+        declare their metrics without worrying about being reloaded.
+        """
+        self.lock.acquire()
+        try:
+            return self.metrics.setdefault(metric.name, metric)
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        """Reset all values to zero, e.g. in a forked process.
+        """
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self):
+        return dict([(name, metric.snapshot())
+                     for name, metric in self.metrics.items()])
+
+
+registry = Registry()
+
+updates = registry.add(Counter('feedplatform_updates_total',
+    'Feed updates, by HTTP status', labels=('status',)))
+items_created = registry.add(Counter('feedplatform_items_created_total',
+    'Items created'))
+downloaded_bytes = registry.add(Counter(
+    'feedplatform_downloaded_bytes_total',
+    'Bytes downloaded, before decompression'))
+stage_seconds = registry.add(Histogram('feedplatform_stage_seconds',
+    'Time spent per feed in each stage of the update',
+    labels=('stage',)))
+errors = registry.add(Counter('feedplatform_errors_total',
+    'Errors, by class', labels=('error',)))
+
+
+def merge(snapshots):
+    """Merge the snapshots of multiple registries, e.g. those of
+    several processes, by adding up their values.
+    """
+    result = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            if not name in result:
+                result[name] = dict(metric, samples={})
+            samples = result[name]['samples']
+            for labels, value in metric['samples']:
+                key = tuple(labels)
+                if not key in samples:
+                    samples[key] = value
+                elif isinstance(value, list):
+                    samples[key] = [a + b for a, b in
+                                    zip(samples[key], value)]
+                else:
+                    samples[key] += value
+    for metric in result.values():
+        metric['samples'] = [[list(k), v]
+                             for k, v in metric['samples'].items()]
+    return result
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, str(value)
+        .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs])
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(snapshot, stats=None, prefix='feedplatform_'):
+    """Render a ``snapshot`` in the Prometheus text format.
+
+    ``stats``, a dict as returned by ``base_daemon.get_stats``, is
+    included as well, each numeric value as a gauge named after its
+    key, with ``prefix``.
+    """
+    lines = []
+    for name in sorted(snapshot.keys()):
+        metric = snapshot[name]
+        lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['type']))
+        for labels, value in sorted(metric['samples']):
+            if metric['type'] == 'histogram':
+                cumulative = 0
+                bounds = [_format_value(float(b)) for b in metric['buckets']]
+                for bound, count in zip(bounds + ['+Inf'], value[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(
+                        metric['labels'], labels, [('le', bound)]),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (name, _format_labels(
+                    metric['labels'], labels), _format_value(value[-1])))
+                lines.append('%s_count%s %d' % (name, _format_labels(
+                    metric['labels'], labels), cumulative))
+            else:
+                lines.append('%s%s %s' % (name, _format_labels(
+                    metric['labels'], labels), _format_value(value)))
+    for key, value in sorted((stats or {}).items()):
+        if isinstance(value, bool) or \
+           not isinstance(value, (int, long, float)):
+            continue
+        lines.append('# TYPE %s%s gauge' % (prefix, key))
+        lines.append('%s%s %s' % (prefix, key, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_text(text):
+    """Parse the Prometheus text format, as produced by ``render``,
+    into a list of (name, labels, value) tuples, ``labels`` being a
+    dict.
+    """
+    samples = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name, _, rest = line.partition('{')
+        labels = {}
+        if rest:
+            label_str, _, value = rest.rpartition('}')
+            for pair in _split_labels(label_str):
+                k, _, v = pair.partition('=')
+                labels[k] = v[1:-1].replace('\\n', '\n') \
+                    .replace('\\"', '"').replace('\\\\', '\\')
+        else:
+            name, _, value = line.partition(' ')
+        samples.append((name.strip(), labels, float(value.split()[0])))
+    return samples
+
+
+def _split_labels(s):
+    # commas may appear inside quoted values
+    parts, current, quoted, escaped = [], '', False, False
+    for c in s:
+        if c == ',' and not quoted:
+            parts.append(current)
+            current = ''
+            continue
+        if c == '"' and not escaped:
+            quoted = not quoted
+        escaped = c == '\\' and not escaped
+        current += c
+    if current:
+        parts.append(current)
+    return parts
+
+
+def quantile(q, buckets):
+    """Estimate the ``q`` quantile (0 to 1) from a list of (upper
+    bound, cumulative count) tuples, interpolating linearly within a
+    bucket, as Prometheus' ``histogram_quantile`` does. Returns
+    ``None`` if nothing was observed.
+    """
+    buckets = sorted(buckets)
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = q * buckets[-1][1]
+    lower_bound, lower_count = 0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                # all we know is that it's above the largest bound
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * \
+                (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+class MetricsServer(threading.Thread):
+    """Serves the text returned by ``collect``, a function, to HTTP
+    GET requests at ``address``: a (host, port) tuple, or the filename
+    of a UNIX socket.
+    """
+
+    def __init__(self, address, collect, log=None):
+        super(MetricsServer, self).__init__()
+        self.setDaemon(True)
+        self.address = address
+        self.collect = collect
+        self.log = log
+        self.stop_event = util.Event()
+        self.ready = threading.Event()
+        self.server = None
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close_after_fork(self):
+        """Close the listening socket inherited by a forked process.
+        The server thread itself doesn't exist in the child, and the
+        socket remains open in the parent.
+        """
+        if self.server is not None:
+            self.server.socket.close()
+
+    def _make_server(self):
+        import BaseHTTPServer, SocketServer
+        collect, log = self.collect, self.log
+
+        class handler_class(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    body, code = collect(), 200
+                except Exception, e:
+                    if log:
+                        log.exception('Collecting metrics failed')
+                    body, code = 'error: %s\n' % e, 500
+                self.send_response(code)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                if log:
+                    log.debug(format % args)
+
+        if isinstance(self.address, basestring):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            class server_class(SocketServer.UnixStreamServer):
+                def get_request(self):
+                    request, client_address = self.socket.accept()
+                    # BaseHTTPRequestHandler expects a (host, port) tuple
+                    return request, ('local', 0)
+        else:
+            server_class = BaseHTTPServer.HTTPServer
+        return server_class(self.address, handler_class)
+
+    def run(self):
+        import select
+        try:
+            self.server = self._make_server()
+        finally:
+            self.ready.set()
+        try:
+            while not self.stop_event.isSet():
+                r,w,e = select.select([self.server.socket, self.stop_event],
+                                      [], [])
+                if self.server.socket in r:
+                    self.server.handle_request()
+        finally:
+            self.server.server_close()
+            if isinstance(self.address, basestring):
+                try:
+                    os.unlink(self.address)
+                except OSError, e:
+                    # someone else may have cleaned up already
+                    if e.errno != errno.ENOENT:
+                        raise
+
+
+def fetch(address, timeout=10):
+    """Return the metrics served by a ``MetricsServer`` at ``address``.
+    """
+    if isinstance(address, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        host = 'localhost'
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        host = address[0]
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+        sock.sendall('GET /metrics HTTP/1.0\r\nHost: %s\r\n\r\n' % host)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    head, _, body = ''.join(chunks).partition('\r\n\r\n')
+    status = head.split('\r\n')[0].split(' ', 2)
+    if len(status) < 2 or status[1] != '200':
+        raise IOError('server responded with "%s": %s' % (
+            ' '.join(status[1:]), body.strip()))
+    return body
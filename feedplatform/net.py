@@ -0,0 +1,855 @@
+"""Network access shared by everything that fetches urls: the feed
+parser, as well as addins downloading images and such.
+
+Currently, this provides:
+
+    * A pool of persistent HTTP connections, so that feeds hosted on
+      the same server (think Feedburner, Blogspot) don't each pay for
+      a new TCP connection and TLS handshake. The pool is used via
+      urllib2 handlers (see ``get_handlers``); both
+      ``parse.update_feed`` and ``util.urlopen`` install them
+      automatically (see the HTTP_KEEPALIVE setting).
+
+    * A limiter that restricts the number of concurrent requests to,
+      and the request rate for, each host, so that we stay polite when
+      fetching in parallel. Again, ``parse.update_feed`` and
+      ``util.urlopen`` both use it (see the HOST_* settings).
+      ``HostDispatcher`` helps to make the most of multiple workers
+      under those limits.
+
+    * A DNS cache, so that host names are not resolved again for
+      every single request (see the DNS_CACHE_* settings). It is used
+      by the urllib2 handlers mentioned above.
+
+    * A redirect cache, so that once we know where a url redirects
+      to, we can go there directly (see the REDIRECT_CACHE_TTL
+      setting). The handlers record the redirects they see, and
+      ``parse.update_feed`` and ``util.urlopen`` skip them.
+"""
+
+import time
+import socket
+import httplib
+import urllib2
+import urlparse
+import threading
+from collections import deque
+
+from feedplatform.conf import config
+
+
+__all__ = ('ConnectionPool', 'DNSCache', 'KeepAliveHTTPHandler',
+           'KeepAliveHTTPSHandler', 'HostLimiter', 'HostDispatcher',
+           'get_host', 'get_pool', 'get_handlers', 'get_limiter',
+           'RedirectCache', 'get_dns_cache', 'get_redirect_cache',
+           'resolve_redirects', 'forget_redirects',
+           'get_stats', 'reset',)
+
+
+class ConnectionPool(object):
+    """Keeps idle HTTP connections around for reuse, keyed by
+    scheme, host and port.
+
+    At most ``max_idle_per_host`` idle connections are kept for any
+    one host; connections that have been idle for longer than
+    ``idle_timeout`` seconds are closed rather than reused, since
+    servers are likely to have dropped them by then.
+
+    The pool doesn't limit the connections in use: there is one per
+    request in progress, and those are limited by the ``HostLimiter``.
+
+    The pool is thread-safe.
+    """
+
+    def __init__(self, max_idle_per_host=4, idle_timeout=30):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}   # key -> list of (connection, time released)
+        self._lock = threading.Lock()
+        self.stats = {'connections_opened': 0, 'connections_reused': 0}
+
+    def get(self, key):
+        """Return an idle connection for ``key``, or ``None``.
+        """
+        expired = []
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            now = time.time()
+            while idle:
+                conn, released = idle.pop()
+                if now - released <= self.idle_timeout:
+                    self.stats['connections_reused'] += 1
+                    return conn
+                expired.append(conn)
+            return None
+        finally:
+            self._lock.release()
+            for conn in expired:
+                conn.close()
+
+    def put(self, key, conn):
+        """Return ``conn`` to the pool, once the response to the last
+        request has been read completely.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def opened(self, key, conn):
+        """Called for every new connection.
+        """
+        self._lock.acquire()
+        try:
+            self.stats['connections_opened'] += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Close all idle connections.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn, released in conns:
+                conn.close()
+
+
+class DNSCache(object):
+    """Caches the results of host name lookups for ``ttl`` seconds.
+
+    Failed lookups are cached as well, for ``negative_ttl`` seconds,
+    so that feeds on a domain that no longer exists don't each wait
+    for the resolver to give up.
+
+    The system resolver doesn't tell us the TTL of its answers, so a
+    fixed value is used. To make up for that, an entry is dropped if
+    we fail to connect to any of its addresses.
+
+    ``resolver`` is the function doing the actual lookups, with the
+    signature of ``socket.getaddrinfo``. Thread-safe.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, resolver=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.resolver = resolver or socket.getaddrinfo
+        self._cache = {}    # args -> (expires, addresses or exception)
+        self._lock = threading.Lock()
+        self.stats = {'dns_hits': 0, 'dns_misses': 0}
+
+    def getaddrinfo(self, host, port, *args):
+        """Like ``socket.getaddrinfo``, but answered from the cache
+        if possible.
+        """
+        key = (host, port) + args
+        self._lock.acquire()
+        try:
+            entry = self._cache.get(key)
+            if entry and entry[0] > time.time():
+                self.stats['dns_hits'] += 1
+                result = entry[1]
+            else:
+                self.stats['dns_misses'] += 1
+                result = None
+        finally:
+            self._lock.release()
+
+        if result is None:
+            try:
+                result = self.resolver(host, port, *args)
+                expires = time.time() + self.ttl
+            except socket.gaierror, e:
+                result = e
+                expires = time.time() + self.negative_ttl
+            self._lock.acquire()
+            try:
+                self._cache[key] = (expires, result)
+            finally:
+                self._lock.release()
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def invalidate(self, host, port):
+        """Forget everything about ``host`` and ``port``.
+        """
+        self._lock.acquire()
+        try:
+            for key in self._cache.keys():
+                if key[:2] == (host, port):
+                    del self._cache[key]
+        finally:
+            self._lock.release()
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                          source_address=None):
+        """Like ``socket.create_connection``, but resolving ``address``
+        through the cache.
+        """
+        host, port = address
+        error = None
+        for af, socktype, proto, canonname, sa in \
+                self.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sa)
+                return sock
+            except socket.error, e:
+                error = e
+                if sock is not None:
+                    sock.close()
+        # the addresses we have may be outdated
+        self.invalidate(host, port)
+        if error is not None:
+            raise error
+        raise socket.error('getaddrinfo returned an empty list')
+
+
+class RedirectCache(object):
+    """Remembers where urls redirect to.
+
+    Permanent redirects (301, 308) are kept until they are explicitly
+    forgotten, e.g. because the target no longer works; temporary
+    ones (302, 303, 307) only for ``ttl`` seconds, or not at all if
+    ``ttl`` is 0.
+
+    Thread-safe.
+    """
+
+    PERMANENT = (301, 308)
+    TEMPORARY = (302, 303, 307)
+
+    # more hops than we could ever have recorded means a loop
+    max_hops = 10
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._redirects = {}    # url -> (target, status, expires)
+        self._lock = threading.Lock()
+        self._prune_size = 1000
+        self.stats = {'redirect_hops_saved': 0}
+
+    def add(self, url, target, status, expires=None):
+        """Record that ``url`` redirects to ``target`` with the HTTP
+        status code ``status``.
+
+        ``expires`` may be given as a ``time.time()`` value; otherwise,
+        the redirect is kept forever if it is permanent, or for ``ttl``
+        seconds.
+        """
+        if expires is None and not status in self.PERMANENT:
+            if not self.ttl:
+                return
+            expires = time.time() + self.ttl
+        self._lock.acquire()
+        try:
+            self._redirects[url] = (target, status, expires)
+            if len(self._redirects) > self._prune_size:
+                self._prune()
+        finally:
+            self._lock.release()
+
+    def _prune(self):
+        now = time.time()
+        for url, (target, status, expires) in self._redirects.items():
+            if expires is not None and expires <= now:
+                del self._redirects[url]
+        self._prune_size = max(1000, len(self._redirects) * 2)
+
+    def lookup(self, url):
+        """Follow the redirects recorded for ``url``.
+
+        Returns a tuple (target, status, expires, hops): ``status`` is
+        that of the last redirect (like the feed parser reports it),
+        ``expires`` the time the first of the redirects expires, or
+        ``None`` if they are all permanent. If we don't know about any
+        redirects, ``(url, None, None, 0)`` is returned.
+        """
+        status = expires = None
+        hops = 0
+        now = time.time()
+        self._lock.acquire()
+        try:
+            while hops < self.max_hops:
+                entry = self._redirects.get(url)
+                if entry is None:
+                    break
+                if entry[2] is not None and entry[2] <= now:
+                    del self._redirects[url]
+                    break
+                url, status = entry[:2]
+                if entry[2] is not None:
+                    expires = min(expires or entry[2], entry[2])
+                hops += 1
+        finally:
+            self._lock.release()
+        return url, status, expires, hops
+
+    def resolve(self, url):
+        """Return a tuple of the url to request instead of ``url``,
+        and the status of the last redirect that was skipped, or
+        ``None``.
+        """
+        target, status, expires, hops = self.lookup(url)
+        if hops:
+            self._lock.acquire()
+            try:
+                self.stats['redirect_hops_saved'] += hops
+            finally:
+                self._lock.release()
+        return target, status
+
+    def forget(self, url):
+        """Forget the redirect recorded for ``url``, so that the next
+        request goes to ``url`` itself again.
+        """
+        self._lock.acquire()
+        try:
+            self._redirects.pop(url, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._redirects.clear()
+        finally:
+            self._lock.release()
+
+
+class _PooledResponse(object):
+    """Wraps a ``httplib.HTTPResponse``, and hands the connection back
+    to the pool once the response has been read completely.
+
+    If the response is closed early, the connection can't be reused,
+    and is closed as well.
+    """
+
+    def __init__(self, response, conn, key, pool):
+        self._response = response
+        self._conn, self._key, self._pool = conn, key, pool
+        self._check()
+
+    def _check(self):
+        if self._conn is not None and self._response.isclosed():
+            conn, self._conn = self._conn, None
+            if self._response.will_close:
+                conn.close()
+            else:
+                self._pool.put(self._key, conn)
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self._check()
+        return data
+    recv = read
+
+    def fileno(self):
+        return self._response.fileno()
+
+    def close(self):
+        self._response.close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class KeepAliveHandlerMixin(object):
+    """Implements the ``do_open`` of ``urllib2.AbstractHTTPHandler``
+    using connections from a ``ConnectionPool``.
+
+    A connection taken from the pool may have been closed by the
+    server in the meantime, in which case we simply try the next one,
+    or a new connection.
+
+    If the handler has a ``dns_cache``, it is used to resolve host
+    names when opening new connections. If it has a ``redirect_cache``,
+    all redirects are recorded there.
+
+    The urllib2 handlers are old-style classes, so we can't use
+    ``super()``.
+    """
+
+    dns_cache = None
+    redirect_cache = None
+
+    def do_open(self, http_class, req, **http_conn_args):
+        # Tunnels through a proxy are not worth the trouble.
+        if req._tunnel_host:
+            return urllib2.AbstractHTTPHandler.do_open(
+                self, http_class, req, **http_conn_args)
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (req.get_type(), host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = \
+            self.pool.max_idle_per_host and 'keep-alive' or 'close'
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if not reused:
+                conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                conn.set_debuglevel(self._debuglevel)
+                if self.dns_cache:
+                    conn._create_connection = self.dns_cache.create_connection
+                self.pool.opened(key, conn)
+            try:
+                conn.request(req.get_method(), req.get_selector(),
+                             req.data, headers)
+                response = conn.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused:
+                    continue
+                raise urllib2.URLError(e)
+            break
+
+        # See ``urllib2.AbstractHTTPHandler.do_open`` for why we need
+        # to wrap the response like this.
+        fp = socket._fileobject(_PooledResponse(response, conn, key, self.pool),
+                                close=True)
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+
+        if self.redirect_cache is not None:
+            location = response.getheader('location')
+            if location and response.status in (
+                    RedirectCache.PERMANENT + RedirectCache.TEMPORARY):
+                url = req.get_full_url()
+                self.redirect_cache.add(url, urlparse.urljoin(url, location),
+                                        response.status)
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+
+    def __init__(self, pool, debuglevel=0, dns_cache=None,
+                 redirect_cache=None):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+        self.dns_cache = dns_cache
+        self.redirect_cache = redirect_cache
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+
+    def __init__(self, pool, debuglevel=0, context=None, dns_cache=None,
+                 redirect_cache=None):
+        urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+        self.pool = pool
+        self.dns_cache = dns_cache
+        self.redirect_cache = redirect_cache
+
+
+def get_host(url):
+    """Return the name of the host ``url`` points to, or ``None`` if
+    there is none, e.g. for local files.
+    """
+    try:
+        return urlparse.urlsplit(url).hostname
+    except ValueError:
+        return None
+
+
+class HostLimiter(object):
+    """Limits the number of concurrent requests to each host, and the
+    rate at which they are made.
+
+    At most ``max_concurrent`` requests to a host may be in progress,
+    and each has to start at least ``min_interval`` seconds after the
+    previous one. ``overrides`` maps domain names to tuples of
+    (max_concurrent, min_interval) for hosts that need different
+    treatment; a domain also applies to its subdomains:
+
+        HostLimiter(2, 0, {'feedburner.com': (8, 0),
+                           'example.org': (1, 5)})
+
+    A ``max_concurrent`` of ``None`` doesn't limit the number of
+    requests.
+
+    Requests are wrapped in ``acquire`` and ``release`` calls, which
+    take the host name as returned by ``get_host``. ``None`` is
+    accepted and never limited.
+
+    The limiter is thread-safe.
+    """
+
+    def __init__(self, max_concurrent=2, min_interval=0, overrides={}):
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self.overrides = dict(overrides)
+        self._active = {}       # host -> number of requests in progress
+        self._last = {}         # host -> time the last request started
+        self._cond = threading.Condition()
+
+    def get_limits(self, host):
+        """Return the (max_concurrent, min_interval) tuple for ``host``.
+        """
+        parts = host.split('.')
+        for i in range(len(parts)):
+            domain = '.'.join(parts[i:])
+            if domain in self.overrides:
+                return self.overrides[domain]
+        return self.max_concurrent, self.min_interval
+
+    def wait_time(self, host):
+        """Return the number of seconds until a request to ``host``
+        may start, ``0`` if it may start right away, or ``None`` if
+        the host is at its concurrency limit, i.e. we need to wait for
+        a request to finish.
+        """
+        if host is None:
+            return 0
+        self._cond.acquire()
+        try:
+            return self._wait_time(host, time.time())
+        finally:
+            self._cond.release()
+
+    def _wait_time(self, host, now):
+        max_concurrent, min_interval = self.get_limits(host)
+        if max_concurrent is not None and \
+           self._active.get(host, 0) >= max_concurrent:
+            return None
+        return max(0, self._last.get(host, 0) + min_interval - now)
+
+    def acquire(self, host):
+        """Block until a request to ``host`` may be made.
+        """
+        if host is None:
+            return
+        self._cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                wait = self._wait_time(host, now)
+                if wait == 0:
+                    break
+                self._cond.wait(wait)
+            self._active[host] = self._active.get(host, 0) + 1
+            self._last[host] = now
+        finally:
+            self._cond.release()
+
+    def release(self, host):
+        """Mark a request to ``host`` as finished.
+        """
+        if host is None:
+            return
+        self._cond.acquire()
+        try:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+class HostDispatcher(object):
+    """Hands out jobs to a pool of workers, taking the limits of a
+    ``HostLimiter`` into account.
+
+    Jobs for a host that is at its limit are held back, while those
+    for other hosts are handed out, going round-robin through the
+    hosts. This way, the workers stay busy even if a large part of
+    the jobs is for the same host, and don't just end up waiting for
+    the limiter.
+
+        dispatcher.put(feed.url, feed.id)
+        ...
+        # in each worker:
+        host, feed_id = dispatcher.get()
+        try:
+            ...
+        finally:
+            dispatcher.task_done(host)
+
+    The dispatcher itself doesn't acquire the limiter; the worker is
+    expected to do so when making the actual request.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self._pending = {}      # host -> deque of jobs
+        self._hosts = deque()   # hosts with pending jobs, in turn
+        self._active = {}       # host -> jobs handed out, not yet done
+        self._cond = threading.Condition()
+
+    def put(self, url, job):
+        """Add ``job``, which will make a request to ``url``.
+        """
+        host = get_host(url)
+        self._cond.acquire()
+        try:
+            if not host in self._pending:
+                self._pending[host] = deque()
+                self._hosts.append(host)
+            self._pending[host].append(job)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _wait_time(self, host):
+        if host is None:
+            return 0
+        max_concurrent, min_interval = self.limiter.get_limits(host)
+        if self._active.get(host, 0) >= max_concurrent:
+            return None
+        return self.limiter.wait_time(host)
+
+    def get(self, timeout=None, cancel=None):
+        """Return a tuple of (host, job) for the next job that can be
+        run, waiting up to ``timeout`` seconds for one to become
+        available. Returns ``None`` if that doesn't happen, or if
+        ``cancel``, a function, returns ``True`` while waiting; call
+        ``wakeup`` to have it checked.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            while True:
+                if cancel is not None and cancel():
+                    return None
+                wait = None
+                for i in range(len(self._hosts)):
+                    host = self._hosts[0]
+                    self._hosts.rotate(-1)
+                    host_wait = self._wait_time(host)
+                    if host_wait == 0:
+                        jobs = self._pending[host]
+                        job = jobs.popleft()
+                        if not jobs:
+                            del self._pending[host]
+                            self._hosts.remove(host)
+                        self._active[host] = self._active.get(host, 0) + 1
+                        return host, job
+                    elif host_wait is not None:
+                        wait = min(wait or host_wait, host_wait)
+
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait = min(wait or remaining, remaining)
+                self._cond.wait(wait)
+        finally:
+            self._cond.release()
+
+    def task_done(self, host):
+        """Mark a job for ``host`` returned by ``get`` as finished.
+        """
+        self._cond.acquire()
+        try:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def join(self, timeout=None, cancel=None):
+        """Wait until all jobs are done. Returns ``False`` if that
+        didn't happen within ``timeout`` seconds, or if ``cancel``
+        returns ``True``, as with ``get``.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            while self._pending or self._active:
+                if cancel is not None and cancel():
+                    return False
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+        finally:
+            self._cond.release()
+
+    def wakeup(self):
+        """Have the threads waiting in ``get`` or ``join`` check their
+        ``cancel`` function.
+        """
+        self._cond.acquire()
+        try:
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+_pool = None
+_limiter = None
+_dns_cache = None
+_redirect_cache = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the connection pool shared by the whole process,
+    created based on the configuration the first time it is needed.
+
+    If HTTP_KEEPALIVE is disabled, the pool doesn't keep any
+    connections.
+    """
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            if config.HTTP_KEEPALIVE:
+                _pool = ConnectionPool(
+                    config.HTTP_MAX_IDLE_CONNECTIONS_PER_HOST,
+                    config.HTTP_IDLE_TIMEOUT)
+            else:
+                _pool = ConnectionPool(0, 0)
+        return _pool
+    finally:
+        _pool_lock.release()
+
+
+def get_limiter():
+    """Return the host limiter shared by the whole process, created
+    based on the configuration the first time it is needed.
+    """
+    global _limiter
+    _pool_lock.acquire()
+    try:
+        if _limiter is None:
+            _limiter = HostLimiter(config.HOST_MAX_CONCURRENT,
+                                   config.HOST_MIN_INTERVAL,
+                                   config.HOST_LIMITS)
+        return _limiter
+    finally:
+        _pool_lock.release()
+
+
+def get_dns_cache():
+    """Return the DNS cache shared by the whole process, or ``None``
+    if it is disabled.
+    """
+    global _dns_cache
+    if not config.DNS_CACHE_TTL:
+        return None
+    _pool_lock.acquire()
+    try:
+        if _dns_cache is None:
+            _dns_cache = DNSCache(config.DNS_CACHE_TTL,
+                                  config.DNS_CACHE_NEGATIVE_TTL)
+        return _dns_cache
+    finally:
+        _pool_lock.release()
+
+
+def get_redirect_cache():
+    """Return the redirect cache shared by the whole process, or
+    ``None`` if it is disabled.
+    """
+    global _redirect_cache
+    if config.REDIRECT_CACHE_TTL is None:
+        return None
+    _pool_lock.acquire()
+    try:
+        if _redirect_cache is None:
+            _redirect_cache = RedirectCache(config.REDIRECT_CACHE_TTL)
+        return _redirect_cache
+    finally:
+        _pool_lock.release()
+
+
+def resolve_redirects(url):
+    """Return a tuple of the url to request in place of ``url``,
+    skipping the redirects we know about, and the status code of the
+    last of those redirects, or ``None``.
+    """
+    cache = get_redirect_cache()
+    if cache is None:
+        return url, None
+    return cache.resolve(url)
+
+
+def forget_redirects(url):
+    """To be called if requesting the url returned by
+    ``resolve_redirects`` for ``url`` failed: the next request will
+    follow the redirects afresh.
+    """
+    cache = get_redirect_cache()
+    if cache is not None:
+        cache.forget(url)
+
+
+def get_handlers(existing=()):
+    """Return the urllib2 handlers that should be installed for
+    network access, in addition to the handlers in ``existing``.
+
+    If ``existing`` already includes handlers for HTTP or HTTPS, we
+    leave those alone.
+    """
+    if not config.HTTP_KEEPALIVE and not config.DNS_CACHE_TTL and \
+       config.REDIRECT_CACHE_TTL is None:
+        return []
+    handlers = []
+    for handler_class in (KeepAliveHTTPHandler, KeepAliveHTTPSHandler):
+        base = handler_class.__bases__[-1]
+        if not [h for h in existing if isinstance(h, base) or
+                    (isinstance(h, type) and issubclass(h, base))]:
+            handlers.append(handler_class(
+                get_pool(), dns_cache=get_dns_cache(),
+                redirect_cache=get_redirect_cache()))
+    return handlers
+
+
+def get_stats():
+    """Return a dict of statistics about network access.
+    """
+    stats = {}
+    for obj in (_pool, _dns_cache, _redirect_cache):
+        if obj is not None:
+            stats.update(obj.stats)
+    return stats
+
+
+def reset():
+    """Close all pooled connections, and have the pool, the limiter
+    and the caches be recreated on next use, e.g. after the
+    configuration changed.
+    """
+    global _pool, _limiter, _dns_cache, _redirect_cache
+    _pool_lock.acquire()
+    try:
+        pool, _pool = _pool, None
+        _limiter = None
+        _dns_cache = None
+        _redirect_cache = None
+    finally:
+        _pool_lock.release()
+    if pool is not None:
+        pool.clear()
@@ -8,18 +8,94 @@ The management tools and parsing scripts exposed to the user depend
 on this code.
 """
 
+import time
+
 from feedplatform.deps import feedparser
 from feedplatform import hooks
 from feedplatform.log import log
 from feedplatform.conf import config
 from feedplatform import db
+from feedplatform import net
+from feedplatform import metrics
 from feedplatform.util import asciify_url, with_socket_timeout
 
 
-__all__ = ('update_feed',)
+__all__ = ('update_feed', 'UpdateProgress',)
+
+
+class UpdateProgress(object):
+    """Follows a feed through ``update_feed``, so that its progress
+    can be watched from other threads, and records where the time
+    went.
+
+    ``stage`` is where the update is at: "before_parse" (the hook),
+    "wait_host" (waiting for other requests to the same host to
+    finish, see ``net.get_limiter``), "fetch" (downloading and
+    parsing the feed), "after_parse" (the hook), and then, for each
+    item, "resolve" (determining the guid, and finding the item in the
+    database), "item_hooks" (the other hooks run for each item) and
+    "flush"; and finally "commit". Once the update is complete,
+    ``finished`` is set, and ``stage`` is ``None``.
+
+    ``timings`` holds the seconds spent in each stage so far; "fetch"
+    is broken down into "network", "decompress" (if the response was
+    compressed) and "parse" once it is done. ``status`` is the HTTP
+    status of the response, once there is one, and ``items_created``
+    the number of new items so far. If an addin stopped the update
+    early, ``skipped`` is set.
+    """
+
+    # the order in which the stages are shown
+    stages = ('before_parse', 'wait_host', 'fetch', 'network',
+              'decompress', 'parse', 'after_parse', 'resolve',
+              'item_hooks', 'flush', 'commit')
+
+    def __init__(self, feed):
+        self.feed_id = feed.id
+        self.url = feed.url
+        self.started = time.time()
+        self.finished = None
+        self.stage = None
+        self.timings = {}
+        self.status = None
+        self.items_created = 0
+        self.skipped = False
+        self._entered = self.started
+
+    def enter(self, stage):
+        """Start with ``stage``, and add the time since the last call
+        to the timing of the stage before.
+        """
+        now = time.time()
+        if self.stage is not None:
+            self.timings[self.stage] = \
+                self.timings.get(self.stage, 0) + now - self._entered
+        self.stage, self._entered = stage, now
+
+    def finish(self):
+        if self.finished is None:
+            self.enter(None)
+            self.finished = self._entered
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
 
+    def summary(self):
+        """Return a line describing the update, and where its time
+        went.
+        """
+        timings = ['%s=%.3fs' % (stage, self.timings[stage])
+                   for stage in self.stages if stage in self.timings]
+        result = '%.3fs (%s), status %s, %d new item(s)' % (
+            self.elapsed, ' '.join(timings), self.status,
+            self.items_created)
+        if self.skipped:
+            result += ', skipped by addin'
+        return result
 
-def update_feed(feed, options={}):
+
+def update_feed(feed, options={}, progress=None):
     """Parse and update a single feed, as specified by the instance
     of the ``Feed`` model in ``feed``.
 
@@ -33,20 +109,47 @@ def update_feed(feed, options={}):
     performance heavy jobs like downloading a feed image are only
     processed when necessary in light mode, but will be forced in
     full mode.
+
+    The core itself currently supports the ``full`` option: If it is
+    set, existing items will always be fully processed, even if an
+    addin reports them as unchanged (see the ``check_item`` hook).
+
+    ``progress``, an ``UpdateProgress``, is kept up to date as the
+    update goes along. Updates that take longer than the
+    SLOW_FEED_THRESHOLD setting are logged along with their timings.
     """
+    if progress is None:
+        progress = UpdateProgress(feed)
+    try:
+        _update_feed(feed, options, progress)
+    finally:
+        progress.finish()
+        threshold = config.SLOW_FEED_THRESHOLD
+        if threshold is not None and progress.elapsed >= threshold:
+            log.warn('Feed #%d is slow: %s, %s' % (
+                progress.feed_id, progress.summary(), progress.url))
+
+
+def _update_feed(feed, options, progress):
 
     # instead of adding an additional argument every hook, pass
     # the option along via ``feed``.
     feed._options = options.copy()
 
     # HOOK: BEFORE_PARSE
+    progress.enter('before_parse')
     parser_args = {
         'agent': config.USER_AGENT,
-        'handlers': list(config.URLLIB2_HANDLERS),
+        'handlers': list(config.URLLIB2_HANDLERS) +
+                    net.get_handlers(config.URLLIB2_HANDLERS),
+        'max_size': config.FEED_MAX_SIZE,
+        'max_decompressed_size': config.FEED_MAX_DECOMPRESSED_SIZE,
+        'timeout': config.FEED_DOWNLOAD_TIMEOUT,
     }
     stop = hooks.trigger('before_parse', args=[feed, parser_args])
     if stop:
         log.info('Feed #%d skipped by addin' % (feed.id))
+        progress.skipped = True
         return
 
     # ACTION: PARSE FEED
@@ -54,13 +157,39 @@ def update_feed(feed, options={}):
     # It may be worth noting that FeedParser already IDNA-encodes by
     # itself, but expects the path/query etc. to already be quoted,
     # or it'll screw up the url badly.
-    data_dict = feedparser.parse(asciify_url(feed.url), **parser_args)
+    #
+    # If we know that the url redirects, we go to the target right
+    # away. For addins, it should look like the redirect happened as
+    # usual, so we report the status code of the redirect.
+    #
+    # We may have to wait here if we are already busy with the host
+    # in a different thread, or have just been talking to it.
+    url = asciify_url(feed.url)
+    target, redirect_status = net.resolve_redirects(url)
+    host, limiter = net.get_host(target), net.get_limiter()
+    progress.enter('wait_host')
+    limiter.acquire(host)
+    try:
+        progress.enter('fetch')
+        data_dict = feedparser.parse(target, **parser_args)
+        progress.enter('after_parse')
+    finally:
+        limiter.release(host)
+    if redirect_status:
+        status = data_dict.get('status')
+        if status == 200:
+            data_dict['status'] = redirect_status
+        elif status is None or status >= 400:
+            net.forget_redirects(url)
+    _record_fetch(data_dict, progress)
 
     # HOOK: AFTER_PARSE
     stop = hooks.trigger('after_parse', args=[feed, data_dict])
     if stop:
         log.info('Feed #%d: Futher processing skipped by addin' % (feed.id))
+        progress.skipped = True
         return
+    store_started = time.time()
 
     # The bozo feature Universal Feed Parser allow it to parse feeds
     # that are not well-formed (http://feedparser.org/docs/bozo.html).
@@ -85,10 +214,22 @@ def update_feed(feed, options={}):
         # TODO: add a hook here
         log.warn('Feed #%d bozo: %s' % (feed.id, data_dict.bozo_exception))
 
+    # ACTION: PREFETCH ITEMS
+    progress.enter('resolve')
+    #
+    # Rather than querying the database for every single entry, try
+    # to resolve all the guids the feed provides itself in one go.
+    # Addins may still come up with different guids, which we then
+    # need to look up individually, but usually this is all we need.
+    prefetched_guids = set([e.get('guid') for e in data_dict.entries
+                            if e.get('guid')])
+    known_items = db.backend.get_items(feed, prefetched_guids)
+
     # ACTION: HANDLE ITEMS
     for entry_dict in data_dict.entries:
 
         # HOOK: ITEM
+        progress.enter('item_hooks')
         stop = hooks.trigger('item', args=[feed, data_dict, entry_dict])
         if stop:
             log.debug('Feed #%d: Item was skipped by addin' % (feed.id))
@@ -100,6 +241,7 @@ def update_feed(feed, options={}):
         # few fixed requirements that we have: we need a guid.
         # Addins can provide new ways to determine one, but if all
         # fails, we just can't handle the item.
+        progress.enter('resolve')
         guid = hooks.trigger('get_guid', args=[feed, entry_dict])
         if not guid:
             guid = entry_dict.get('guid')
@@ -131,10 +273,11 @@ def update_feed(feed, options={}):
             item = db.get_one(hooks.trigger('get_item',
                                             args=[feed, entry_dict, guid]))
             if item is None:
-                # does the item already exist for *this feed*?
-                item = db.get_one((db.store.find(db.models.Item,
-                                                 db.models.Item.feed==feed,
-                                                 db.models.Item.guid==guid)))
+                # does the item already exist for *this feed*? Unless
+                # the guid was prefetched, we need to ask the backend.
+                if not guid in known_items and not guid in prefetched_guids:
+                    known_items.update(db.backend.get_items(feed, [guid]))
+                item = db.get_one(known_items.get(guid, []))
             if item is None:
                 item = db.get_one(hooks.trigger('need_item',
                                                 args=[feed, entry_dict, guid]))
@@ -144,6 +287,7 @@ def update_feed(feed, options={}):
                return
 
 
+        progress.enter('item_hooks')
         if not item:
             # HOOK: CREATE_ITEM
             item = hooks.trigger('create_item', args=[feed, entry_dict, guid])
@@ -152,7 +296,7 @@ def update_feed(feed, options={}):
                 item.feed = feed
                 item.guid = guid
 
-            db.store.add(item)
+            db.backend.add(item)
             # HOOK: NEW_ITEM
             #
             # Note how this happens before flushing(), so that any
@@ -161,10 +305,30 @@ def update_feed(feed, options={}):
             # the process_item hook instead.
             hooks.trigger('new_item', args=[feed, item, entry_dict])
 
-            db.store.flush()
+            progress.enter('flush')
+            db.backend.flush()
+            progress.enter('item_hooks')
             log.info('Feed #%d: found new item (#%d)' % (feed.id, item.id))
+            metrics.items_created.inc()
+            progress.items_created += 1
+            # the feed may contain the same guid multiple times
+            known_items[item.guid] = [item]
             item_created = True
         else:
+            # HOOK: CHECK_ITEM
+            #
+            # The vast majority of entries in a feed will usually be
+            # ones we have already seen, unchanged. Give addins the
+            # chance to tell us so, so we can skip the work required
+            # to process them again.
+            if not feed._options.get('full'):
+                unchanged = hooks.trigger('check_item',
+                                          args=[feed, item, entry_dict])
+                if unchanged:
+                    log.debug('Feed #%d: item #%d unchanged, skipping' % (
+                        feed.id, item.id))
+                    continue
+
             # HOOK: FOUND_ITEM
             hooks.trigger('found_item', args=[feed, item, entry_dict])
             item_created = False
@@ -173,9 +337,35 @@ def update_feed(feed, options={}):
         hooks.trigger('process_item', args=[feed, item, entry_dict, item_created])
 
         # flush once for each item
-        db.store.flush()
+        progress.enter('flush')
+        db.backend.flush()
 
     # commit once for each feed
-    db.store.commit()
+    progress.enter('commit')
+    db.backend.commit()
+    metrics.stage_seconds.observe(time.time() - store_started, stage='store')
+
+
+def _record_fetch(data_dict, progress):
+    """Break down the time ``progress`` spent in the "fetch" stage,
+    and update the metrics concerned with getting the feed.
+    """
+    elapsed = progress.timings.pop('fetch', 0)
+    fetch_time = min(data_dict.get('download_time', 0), elapsed)
+    decompress_time = min(data_dict.get('decompress_time', 0), fetch_time)
+    progress.timings['network'] = fetch_time - decompress_time
+    if decompress_time:
+        progress.timings['decompress'] = decompress_time
+    progress.timings['parse'] = elapsed - fetch_time
+    progress.status = data_dict.get('status')
+
+    metrics.updates.inc(status=data_dict.get('status', 'none'))
+    metrics.downloaded_bytes.inc(data_dict.get('download_size', 0))
+    metrics.stage_seconds.observe(fetch_time, stage='fetch')
+    metrics.stage_seconds.observe(elapsed - fetch_time, stage='parse')
+    if data_dict.get('bozo'):
+        metrics.errors.inc(
+            error=data_dict.bozo_exception.__class__.__name__)
+
 
 update_feed = with_socket_timeout(update_feed)
\ No newline at end of file
@@ -0,0 +1,242 @@
+"""Profiling of feed updates, as done by the ``--profile`` option of
+the ``start`` and ``update`` commands.
+
+A ``Profiler`` runs the updates under ``cProfile``, and writes the
+result either in the ``pstats`` format, to be examined with the
+``pstats`` module, or, if the filename ends with ".callgrind" or
+starts with "callgrind.out", in the callgrind format, as understood
+by KCachegrind and similar tools.
+
+Addins hook into the update through methods named after the hooks,
+so in a plain profile, all ``on_after_parse`` methods, for example,
+look alike. The profiles written here name them after the addin
+class as well, like "handle_feed_images.on_after_parse", and the
+time spent in each is logged when a profile is written.
+"""
+
+import os
+import time
+import cProfile
+import pstats
+import threading
+
+from feedplatform import addins
+
+
+__all__ = ('Profiler', 'label_hooks', 'hook_summary', 'write_callgrind',)
+
+
+class Profiler(object):
+    """Profiles the calls made through ``runcall``, in any number of
+    threads, and writes the result to ``filename``.
+
+    A profile covers ``feeds`` calls, or ``seconds`` seconds, whichever
+    is reached first; if neither is given, it covers everything until
+    ``close`` is called. Afterwards, calls are no longer profiled,
+    unless ``interval`` is given: then, a new profile is started that
+    many seconds after the last one was, so that a long running daemon
+    can be sampled every now and then, without paying for the profiler
+    all of the time. In that case, the time each profile was started
+    is added to ``filename``.
+
+    ``log``, if given, is told where the profiles went, and which addin
+    hooks they spent the most time in.
+    """
+
+    def __init__(self, filename, feeds=None, seconds=None, interval=None,
+                 log=None):
+        self.filename = filename
+        self.feeds = feeds
+        self.seconds = seconds
+        self.interval = interval
+        self.log = log
+        self.written = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._round = 0
+        self._round_started = None
+        self._next_round = 0
+        self._calls = 0
+        self._running = 0
+        self._profiles = []
+        self._closed = False
+
+    def runcall(self, func, *args, **kwargs):
+        """Call ``func``, and profile it, if a profile is being taken.
+        """
+        self._lock.acquire()
+        try:
+            profile = self._begin_call()
+        finally:
+            self._lock.release()
+        if profile is None:
+            return func(*args, **kwargs)
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._lock.acquire()
+            try:
+                self._running -= 1
+                if not self._running and (self._closed or
+                                          self._round_over()):
+                    self._write()
+            finally:
+                self._lock.release()
+
+    def close(self):
+        """Stop profiling, and write what has been profiled so far,
+        once the calls still running are done.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            self._next_round = None
+            if self._round_started is not None and not self._running:
+                self._write()
+        finally:
+            self._lock.release()
+
+    def _begin_call(self):
+        # with the lock held; returns the profile to use, if any
+        now = time.time()
+        if self._round_started is None:
+            if self._closed or self._next_round is None or \
+               now < self._next_round:
+                return None
+            self._round += 1
+            self._round_started = now
+            self._calls = 0
+        if self._closed or self._round_over():
+            # waiting for the calls still running to finish
+            if not self._running:
+                self._write()
+            return None
+        self._calls += 1
+        self._running += 1
+        # Profiles are per thread, since each profiles only the
+        # thread it was enabled in. They are combined in ``_write``.
+        if getattr(self._local, 'round', None) != self._round:
+            self._local.round = self._round
+            self._local.profile = cProfile.Profile()
+            self._profiles.append(self._local.profile)
+        return self._local.profile
+
+    def _round_over(self):
+        if self.feeds is not None and self._calls >= self.feeds:
+            return True
+        if self.seconds is not None and \
+           time.time() - self._round_started >= self.seconds:
+            return True
+        return False
+
+    def _write(self):
+        # with the lock held, and none of the profiles running
+        profiles, calls = self._profiles, self._calls
+        started = self._round_started
+        self._profiles, self._round_started = [], None
+        if self.interval is not None and not self._closed:
+            self._next_round = started + self.interval
+        else:
+            self._next_round = None
+        if not profiles:
+            return
+
+        filename = self.filename
+        if self.interval is not None:
+            base, ext = os.path.splitext(filename)
+            filename = '%s-%s%s' % (base, time.strftime(
+                '%Y%m%d-%H%M%S', time.localtime(started)), ext)
+        stats = pstats.Stats(*profiles)
+        label_hooks(stats)
+        name = os.path.basename(filename)
+        if name.endswith('.callgrind') or name.startswith('callgrind.out'):
+            f = open(filename, 'w')
+            try:
+                write_callgrind(stats, f)
+            finally:
+                f.close()
+        else:
+            stats.dump_stats(filename)
+        self.written.append(filename)
+
+        if self.log:
+            self.log.info('Wrote profile of %d call(s) to %s' % (
+                calls, filename))
+            summary = hook_summary(stats)[:10]
+            if summary:
+                self.log.info('Time spent in addin hooks: %s' % ', '.join(
+                    ['%s=%.3fs (%d calls)' % (hook, cumtime, ncalls)
+                     for hook, ncalls, tottime, cumtime in summary]))
+
+
+def label_hooks(stats, addin_list=None):
+    """Rename the hook methods (``on_*``) of the addins in ``stats``,
+    a ``pstats.Stats`` instance, to include the class they are defined
+    in, e.g. "handle_feed_images.on_after_parse", so that the time
+    spent in them can be told apart.
+
+    By default, the installed addins are considered.
+    """
+    if addin_list is None:
+        addin_list = addins.get_addins()
+    names = {}
+    for addin in addin_list:
+        for klass in type(addin).__mro__:
+            for name, value in klass.__dict__.items():
+                code = getattr(value, 'func_code', None)
+                if name.startswith('on_') and code is not None:
+                    key = (code.co_filename, code.co_firstlineno,
+                           code.co_name)
+                    names[key] = '%s.%s' % (klass.__name__, name)
+
+    def rename(func):
+        if func in names:
+            return func[:2] + (names[func],)
+        return func
+    stats.stats = dict([
+        (rename(func), (cc, nc, tt, ct, dict([(rename(caller), value)
+                                              for caller, value
+                                              in callers.items()])))
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items()])
+
+
+def hook_summary(stats):
+    """Return a list of (name, calls, tottime, cumtime) tuples for the
+    addin hooks in ``stats``, as labeled by ``label_hooks``, those
+    that took the most time first.
+    """
+    result = [(func[2], nc, tt, ct)
+              for func, (cc, nc, tt, ct, callers) in stats.stats.items()
+              if '.on_' in func[2]]
+    result.sort(key=lambda item: item[3], reverse=True)
+    return result
+
+
+def write_callgrind(stats, f):
+    """Write ``stats``, a ``pstats.Stats`` instance, to the file
+    ``f`` in the callgrind format. Times are in microseconds.
+    """
+    def name(func):
+        filename, line, funcname = func
+        if line:
+            return '%s (%s:%d)' % (funcname, os.path.basename(filename),
+                                   line)
+        return funcname
+
+    # pstats knows who called a function, callgrind wants to know who
+    # a function called
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, (c_cc, c_nc, c_tt, c_ct) in callers.items():
+            callees.setdefault(caller, []).append((func, c_nc, c_ct))
+
+    f.write('version: 1\ncreator: feedplatform\nevents: Microseconds\n\n')
+    for func, (cc, nc, tt, ct, callers) in sorted(stats.stats.items()):
+        filename, line, funcname = func
+        f.write('fl=%s\nfn=%s\n%d %d\n' % (filename, name(func), line,
+                                           tt * 1000000))
+        for callee, calls, cumtime in sorted(callees.get(func, [])):
+            f.write('cfl=%s\ncfn=%s\ncalls=%d %d\n%d %d\n' % (
+                callee[0], name(callee), calls, callee[1], line,
+                cumtime * 1000000))
+        f.write('\n')
@@ -0,0 +1,544 @@
+"""Queues of feeds to update, as processed by ``provide_queue_daemon``.
+
+Those hold feed ids rather than model instances: the instances belong
+to the store of the thread that loaded them, and keeping them alive in
+a queue would keep them in that store's cache as well. The consuming
+side looks the feeds up again, and has to deal with feeds that have
+since been deleted.
+
+``FeedQueue`` keeps the queue in memory, as does
+``PriorityFeedQueue``, which doesn't work on a first come, first
+served basis; ``SQLiteFeedQueue`` keeps it in a file, so that nothing
+is lost on a restart.
+
+A plain ``Queue.Queue`` holding model instances continues to work
+with the daemons, but can only detect duplicates by searching through
+the whole queue.
+"""
+
+import heapq
+import Queue
+import threading
+from time import time as _time
+
+
+__all__ = ('FeedQueue', 'PriorityFeedQueue', 'SQLiteFeedQueue',)
+
+
+def get_feed_id(feed_or_id):
+    """Return the id of what may be either a feed or its id.
+    """
+    return getattr(feed_or_id, 'id', feed_or_id)
+
+
+class FeedQueue(Queue.Queue):
+    """A FIFO queue of feed ids, which will contain each feed only
+    once.
+
+    Feeds may be given as model instances or ids; ``get`` always
+    returns an id. Once it has been taken from the queue, the feed may
+    be added again.
+
+    Example:
+
+        queue = FeedQueue()
+        [...
+         provide_queue_daemon(queue),
+        ...]
+    """
+
+    def _init(self, maxsize):
+        Queue.Queue._init(self, maxsize)
+        self.ids = set()
+
+    def _put(self, item):
+        feed_id = get_feed_id(item)
+        self.ids.add(feed_id)
+        self.queue.append(feed_id)
+
+    def _get(self):
+        feed_id = self.queue.popleft()
+        self.ids.discard(feed_id)
+        return feed_id
+
+    def __contains__(self, feed_or_id):
+        self.mutex.acquire()
+        try:
+            return get_feed_id(feed_or_id) in self.ids
+        finally:
+            self.mutex.release()
+
+    def _requeue(self, item):
+        """Called with ``item`` for a feed that is already queued.
+        Subclasses may update the queued entry, and return ``True`` if
+        they did.
+        """
+        return False
+
+    def add(self, feed_or_id, block=True, timeout=None):
+        """Put the feed on the queue, unless it is already queued.
+        Returns ``True`` if it was added, ``False`` if not.
+
+        Blocks if the queue is full, just like ``put``.
+        """
+        feed_id = get_feed_id(feed_or_id)
+        return self._add(feed_id, feed_id, block, timeout)
+
+    def _add(self, feed_id, item, block, timeout):
+        self.not_full.acquire()
+        try:
+            if feed_id in self.ids:
+                return self._requeue(item)
+            if self.maxsize > 0:
+                if not block:
+                    if self._qsize() >= self.maxsize:
+                        raise Queue.Full
+                elif timeout is None:
+                    while self._qsize() >= self.maxsize:
+                        self.not_full.wait()
+                elif timeout < 0:
+                    raise ValueError("'timeout' must be a positive number")
+                else:
+                    endtime = _time() + timeout
+                    while self._qsize() >= self.maxsize:
+                        remaining = endtime - _time()
+                        if remaining <= 0.0:
+                            raise Queue.Full
+                        self.not_full.wait(remaining)
+                # might have been added by someone else while we waited
+                if feed_id in self.ids:
+                    return self._requeue(item)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+        finally:
+            self.not_full.release()
+
+    def put(self, item, block=True, timeout=None):
+        self.add(item, block, timeout)
+
+    def get(self, block=True, timeout=None, cancel=None):
+        """Like ``Queue.get``, but if ``cancel``, a function, returns
+        ``True`` while waiting, ``Queue.Empty`` is raised. Call
+        ``wakeup`` to have it checked.
+
+        This allows a consumer to block without a timeout, which in
+        Python 2 means without polling, and still be stopped.
+        """
+        self.not_empty.acquire()
+        try:
+            if not block:
+                if not self._qsize():
+                    raise Queue.Empty
+            elif timeout is not None and timeout < 0:
+                raise ValueError("'timeout' must be a positive number")
+            else:
+                if timeout is not None:
+                    endtime = _time() + timeout
+                while not self._qsize():
+                    if cancel is not None and cancel():
+                        raise Queue.Empty
+                    if timeout is None:
+                        self.not_empty.wait()
+                    else:
+                        remaining = endtime - _time()
+                        if remaining <= 0.0:
+                            raise Queue.Empty
+                        self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            return item
+        finally:
+            self.not_empty.release()
+
+    def wakeup(self):
+        """Have the threads waiting in ``get`` check their ``cancel``
+        function.
+        """
+        self.not_empty.acquire()
+        try:
+            self.not_empty.notifyAll()
+        finally:
+            self.not_empty.release()
+
+    def ack(self, feed_id):
+        """Called once a feed taken from the queue has been processed;
+        there is nothing to do for an in-memory queue.
+        """
+
+    def get_stats(self):
+        return {'queue_depth': self.qsize()}
+
+
+class PriorityFeedQueue(FeedQueue):
+    """A queue of feed ids that returns feeds by priority, and then by
+    deadline, rather than in the order they were added.
+
+    Priorities are numbers, lower ones going first, or one of the
+    names in ``PRIORITIES``; the default is "normal". A deadline is
+    given in seconds from now; within a priority, the feeds with the
+    earliest deadlines go first, then those without a deadline, in
+    the order they were added. Feeds are still returned once their
+    deadline has passed, but that is counted as a missed deadline.
+
+    If a feed that is already queued is added again with a higher
+    priority or an earlier deadline, it moves up accordingly.
+
+    So that a user asking for a feed to be refreshed doesn't have to
+    wait for a backlog of feeds queued by an import:
+
+        queue.add(feed, priority='interactive')
+        queue.add_many(imported_feeds, priority='background')
+
+    ``get_stats`` reports the number of feeds waiting, and the time
+    they have waited once taken, for each priority.
+    """
+
+    PRIORITIES = {'interactive': 0, 'normal': 10, 'background': 20}
+
+    def _init(self, maxsize):
+        self.queue = []
+        # feed id -> heap entry; entries that are no longer in here
+        # are stale and skipped when they come up
+        self.ids = {}
+        self.seq = 0
+        self.waits = {}
+        self.deadlines_missed = 0
+
+    def _qsize(self, len=len):
+        return len(self.ids)
+
+    def _put(self, entry):
+        self.ids[entry[3]] = entry
+        heapq.heappush(self.queue, entry)
+
+    def _get(self):
+        while True:
+            entry = heapq.heappop(self.queue)
+            priority, _, _, feed_id, added, deadline = entry
+            if self.ids.get(feed_id) is entry:
+                break
+        del self.ids[feed_id]
+        now = _time()
+        count, total, longest = self.waits.get(priority, (0, 0, 0))
+        self.waits[priority] = (count + 1, total + now - added,
+                                max(longest, now - added))
+        if deadline is not None and deadline < now:
+            self.deadlines_missed += 1
+        return feed_id
+
+    def _requeue(self, entry):
+        queued = self.ids[entry[3]]
+        if entry[:2] >= queued[:2]:
+            return False
+        # keep the place in line and the time waited so far
+        entry[2], entry[4] = queued[2], queued[4]
+        self._put(entry)
+        return True
+
+    def _make_entry(self, feed_or_id, priority, deadline):
+        if priority is None:
+            priority = 'normal'
+        priority = self.PRIORITIES.get(priority, priority)
+        if not isinstance(priority, (int, long)):
+            raise ValueError('Unknown priority: %s' % priority)
+        now = _time()
+        if deadline is not None:
+            deadline = now + deadline
+        self.seq += 1
+        # the deadline sort key puts feeds without one last
+        return [priority, deadline is None and float('inf') or deadline,
+                self.seq, get_feed_id(feed_or_id), now, deadline]
+
+    def add(self, feed_or_id, block=True, timeout=None, priority=None,
+            deadline=None):
+        """Like ``FeedQueue.add``, but with an optional ``priority``
+        and ``deadline``. Also returns ``True`` if an already queued
+        feed was moved up.
+        """
+        entry = self._make_entry(feed_or_id, priority, deadline)
+        return self._add(entry[3], entry, block, timeout)
+
+    def add_many(self, feeds, block=True, timeout=None, priority=None,
+                 deadline=None):
+        """Add all of ``feeds`` with the same priority and deadline.
+        Returns the number of feeds added.
+        """
+        return len([f for f in feeds
+                    if self.add(f, block, timeout, priority, deadline)])
+
+    def get_stats(self):
+        names = dict([(v, k) for k, v in self.PRIORITIES.items()])
+        self.mutex.acquire()
+        try:
+            depths = {}
+            for priority, _, _, _, _, _ in self.ids.itervalues():
+                depths[priority] = depths.get(priority, 0) + 1
+            stats = {'queue_depth': self._qsize(),
+                     'queue_deadlines_missed': self.deadlines_missed}
+            for priority in set(depths.keys() + self.waits.keys()):
+                name = names.get(priority, priority)
+                count, total, longest = self.waits.get(priority, (0, 0, 0))
+                stats['queue_depth_%s' % name] = depths.get(priority, 0)
+                stats['queue_wait_avg_%s' % name] = \
+                    round(count and total / count or 0, 3)
+                stats['queue_wait_max_%s' % name] = round(longest, 3)
+            return stats
+        finally:
+            self.mutex.release()
+
+
+class SQLiteFeedQueue(object):
+    """A queue of feed ids kept in an SQLite database at ``filename``,
+    so that it survives restarts and crashes.
+
+    It can be used instead of a ``FeedQueue``, and similarly contains
+    each feed only once. However, a feed that is taken from the queue
+    is not removed right away, but only once it is acknowledged via
+    ``ack`` - ``provide_queue_daemon`` does this after it has updated
+    the feed. If that doesn't happen within ``visibility_timeout``
+    seconds, say because the process died, the feed is returned by
+    ``get`` again. A feed that is added again while it is being
+    processed is queued again once acknowledged.
+
+    When the queue is opened, feeds that were taken by a previous
+    process, but never acknowledged, are made available right away,
+    unless ``release_leases`` is ``False``, as it should be if there
+    are multiple processes using the same file.
+
+    To be fast enough for thousands of additions per second, changes
+    are not synced to disk on every commit. They survive the process
+    crashing, but not necessarily the system doing so.
+    """
+
+    def __init__(self, filename, maxsize=0, visibility_timeout=300,
+                 release_leases=True):
+        import sqlite3
+        self.filename = filename
+        self.maxsize = maxsize
+        self.visibility_timeout = visibility_timeout
+        self.mutex = threading.Lock()
+        self.changed = threading.Condition(self.mutex)
+        # we serialize access ourselves
+        self.db = sqlite3.connect(filename, check_same_thread=False,
+                                  timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS feed_queue (
+            feed_id INTEGER PRIMARY KEY,
+            seq INTEGER NOT NULL,
+            leased_until REAL,
+            again INTEGER NOT NULL DEFAULT 0)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS feed_queue_seq '
+                        'ON feed_queue (seq)')
+        if release_leases:
+            self.db.execute('UPDATE feed_queue SET leased_until = NULL')
+
+    def close(self):
+        self.mutex.acquire()
+        try:
+            self.db.close()
+        finally:
+            self.mutex.release()
+
+    def _next_seq(self):
+        return (self.db.execute('SELECT MAX(seq) FROM feed_queue')
+                .fetchone()[0] or 0) + 1
+
+    def _qsize(self, now=None):
+        return self.db.execute('SELECT COUNT(*) FROM feed_queue WHERE '
+                               'leased_until IS NULL OR leased_until <= ?',
+                               (now or _time(),)).fetchone()[0]
+
+    def _wait(self, block, timeout, ready, exception, cancel=None):
+        """Wait, with the mutex held, until ``ready()``. As leases
+        expire without us being notified, we check every now and then.
+        """
+        if not block:
+            if not ready():
+                raise exception
+            return
+        if timeout is not None:
+            if timeout < 0:
+                raise ValueError("'timeout' must be a positive number")
+            endtime = _time() + timeout
+        while not ready():
+            if cancel is not None and cancel():
+                raise exception
+            now = _time()
+            wait = 1
+            expires = self.db.execute('SELECT MIN(leased_until) FROM '
+                                      'feed_queue WHERE leased_until > ?',
+                                      (now,)).fetchone()[0]
+            if expires:
+                wait = min(wait, expires - now + 0.001)
+            if timeout is not None:
+                remaining = endtime - now
+                if remaining <= 0.0:
+                    raise exception
+                wait = min(wait, remaining)
+            self.changed.wait(wait)
+
+    def qsize(self):
+        """Return the number of feeds waiting to be taken from the
+        queue.
+        """
+        self.mutex.acquire()
+        try:
+            return self._qsize()
+        finally:
+            self.mutex.release()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def get_stats(self):
+        return {'queue_depth': self.qsize()}
+
+    def full(self):
+        return 0 < self.maxsize <= self.qsize()
+
+    def _contains(self, feed_id):
+        return self.db.execute('SELECT 1 FROM feed_queue WHERE feed_id = ?',
+                               (feed_id,)).fetchone() is not None
+
+    def __contains__(self, feed_or_id):
+        self.mutex.acquire()
+        try:
+            return self._contains(get_feed_id(feed_or_id))
+        finally:
+            self.mutex.release()
+
+    def add(self, feed_or_id, block=True, timeout=None):
+        """Put the feed on the queue, unless it is already queued.
+        Returns ``True`` if it was added, ``False`` if not.
+        """
+        return self.add_many([feed_or_id], block, timeout) == 1
+
+    def add_many(self, feeds, block=True, timeout=None):
+        """Put all of ``feeds`` on the queue at once, in a single
+        transaction. Returns the number of feeds added.
+        """
+        feed_ids = [get_feed_id(f) for f in feeds]
+        self.mutex.acquire()
+        try:
+            # there's no need to wait for room if we won't need it
+            if self.maxsize > 0 and [f for f in feed_ids
+                                     if not self._contains(f)]:
+                self._wait(block, timeout,
+                           lambda: self._qsize() < self.maxsize, Queue.Full)
+            added = 0
+            now, seq = _time(), self._next_seq()
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for feed_id in feed_ids:
+                    cursor = self.db.execute(
+                        'INSERT OR IGNORE INTO feed_queue (feed_id, seq) '
+                        'VALUES (?, ?)', (feed_id, seq))
+                    if not cursor.rowcount:
+                        # if it's currently being processed, it needs
+                        # to be done again afterwards
+                        cursor = self.db.execute(
+                            'UPDATE feed_queue SET again = 1 WHERE '
+                            'feed_id = ? AND leased_until > ? '
+                            'AND again = 0', (feed_id, now))
+                    added += cursor.rowcount
+                    seq += 1
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            if added:
+                self.changed.notifyAll()
+            return added
+        finally:
+            self.mutex.release()
+
+    def put(self, item, block=True, timeout=None):
+        self.add(item, block, timeout)
+
+    def put_nowait(self, item):
+        self.add(item, False)
+
+    def get(self, block=True, timeout=None, cancel=None):
+        """Take the next feed from the queue and return its id.
+        ``cancel`` works as with ``FeedQueue.get``.
+        """
+        return self.get_many(1, block, timeout, cancel)[0]
+
+    def wakeup(self):
+        self.mutex.acquire()
+        try:
+            self.changed.notifyAll()
+        finally:
+            self.mutex.release()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_many(self, count, block=True, timeout=None, cancel=None):
+        """Take up to ``count`` feeds from the queue at once. Waits
+        for at least one to become available, like ``get``.
+        """
+        if timeout is not None:
+            endtime = _time() + timeout
+        self.mutex.acquire()
+        try:
+            while True:
+                if timeout is not None:
+                    timeout = max(endtime - _time(), 0)
+                self._wait(block, timeout, lambda: self._qsize() > 0,
+                           Queue.Empty, cancel)
+                feed_ids = self._take(count)
+                if feed_ids:
+                    self.changed.notifyAll()
+                    return feed_ids
+                # Another process using the same file took them after
+                # we were done waiting; wait for the next ones.
+                if not block:
+                    raise Queue.Empty
+        finally:
+            self.mutex.release()
+
+    def _take(self, count):
+        # with the mutex held
+        now = _time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            feed_ids = [row[0] for row in self.db.execute(
+                'SELECT feed_id FROM feed_queue WHERE leased_until IS '
+                'NULL OR leased_until <= ? ORDER BY seq LIMIT ?',
+                (now, count))]
+            self.db.executemany(
+                'UPDATE feed_queue SET leased_until = ? '
+                'WHERE feed_id = ?',
+                [(now + self.visibility_timeout, feed_id)
+                 for feed_id in feed_ids])
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        return feed_ids
+
+    def ack(self, feed_id):
+        """Remove a feed taken from the queue for good, or queue it
+        again if it was added again in the meantime.
+        """
+        self.mutex.acquire()
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('DELETE FROM feed_queue WHERE feed_id = ? '
+                                'AND again = 0', (feed_id,))
+                self.db.execute('UPDATE feed_queue SET again = 0, '
+                                'leased_until = NULL, seq = ? '
+                                'WHERE feed_id = ?',
+                                (self._next_seq(), feed_id))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.changed.notifyAll()
+        finally:
+            self.mutex.release()
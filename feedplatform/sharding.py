@@ -0,0 +1,68 @@
+"""Splitting the feeds between multiple daemons that share the work,
+be it separate instances (see the ``start`` command's ``--shard``
+option), or the processes of a ``supervisor.ProcessSupervisor``.
+"""
+
+from feedplatform import net
+from feedplatform import util
+
+
+__all__ = ('Shard',)
+
+
+class Shard(object):
+    """Selects part ``index`` of ``count`` equal parts of all feeds,
+    so that multiple daemons can share the work without coordinating;
+    ``index`` counts from 0.
+
+    Feeds are assigned to shards using a consistent hash of either
+    their id, or, if ``by`` is "host", the host of their url. The
+    latter keeps all feeds of a host in one shard, so that the host
+    limits (see the HOST_* settings) still work as intended.
+
+    To change the number of shards, simply restart all daemons with
+    the new count. All state is kept in the database, so there's
+    nothing to move around; and thanks to the hash used
+    (``util.jump_hash``), going from n to n+1 shards only moves 1/(n+1)
+    of the feeds, all of them to the new shard. Everything else stays
+    where it was, including, say, HTTP caches and connections that are
+    kept per process. Removing the last shard likewise only moves the
+    feeds that were in it.
+
+    A shard can be passed to ``db.backend.iter_feeds``.
+    """
+
+    def __init__(self, index, count, by='id'):
+        if not 0 <= index < count:
+            raise ValueError('shard %d does not exist, needs to be between '
+                             '0 and %d' % (index, count - 1))
+        if not by in ('id', 'host'):
+            raise ValueError('cannot shard by "%s"' % by)
+        self.index, self.count, self.by = index, count, by
+
+    @classmethod
+    def parse(cls, value, by='id'):
+        """Create a shard from a string in the form "index/count".
+        """
+        try:
+            index, count = [int(v) for v in value.split('/')]
+        except ValueError:
+            raise ValueError('expected "index/count", got "%s"' % value)
+        return cls(index, count, by or 'id')
+
+    def __call__(self, feed_id, url):
+        if self.by == 'host':
+            key = net.get_host(url)
+            if isinstance(key, unicode):
+                # International domain names are hashed in their ASCII
+                # form, so that both spellings end up in the same shard.
+                try:
+                    key = key.encode('idna')
+                except UnicodeError:
+                    key = key.encode('utf-8')
+        else:
+            key = feed_id
+        return util.jump_hash(key, self.count) == self.index
+
+    def __str__(self):
+        return '%d/%d' % (self.index, self.count)
@@ -0,0 +1,232 @@
+"""Running a daemon in multiple processes, as done by the ``start``
+command's ``--processes`` option.
+"""
+
+import os
+import time
+import threading
+
+from feedplatform import db
+from feedplatform import net
+from feedplatform import util
+from feedplatform import metrics
+from feedplatform.conf import config
+
+
+__all__ = ('ProcessSupervisor',)
+
+
+class ProcessSupervisor(object):
+    """Runs ``daemon`` in ``count`` processes forked off from this
+    one, as used by the ``start`` command's ``--processes`` option.
+
+    Each process has its own database connection and interpreter, so
+    together they can make use of all cores. How they split the work
+    is up to the daemon (see ``base_daemon.setup_process``); daemons
+    that shard run each process on a shard of its own.
+
+    Processes that crash are restarted, after ``restart_delay``
+    seconds. Those that end normally, e.g. because the daemon only
+    runs once, are not. On SIGTERM or SIGINT, all processes are asked
+    to stop, and the supervisor waits for them to do so.
+
+    Each process reports its statistics every ``report_interval``
+    seconds; ``get_stats`` sums them up, and they are logged every
+    DAEMON_STATS_INTERVAL seconds.
+
+    ``servers`` are servers running in this process, like the
+    ``metrics.MetricsServer``, whose sockets the processes would
+    otherwise inherit, and keep open should they outlive us. They are
+    closed in the processes via their ``close_after_fork`` method.
+    """
+
+    restart_delay = 1
+    report_interval = 5
+
+    def __init__(self, daemon, count, servers=()):
+        self.daemon = daemon
+        self.count = count
+        self.servers = list(servers)
+        self.log = daemon.log
+        self.stop_event = util.Event()
+        self.children = {}      # pid -> (index, stats pipe)
+        self.buffers = {}       # stats pipe -> unfinished line
+        self.stats = {}         # index -> last reported stats
+        self.metrics = {}       # index -> last reported metrics
+        self.restarts = 0
+        self.started = time.time()
+
+    @property
+    def stop_requested(self):
+        return self.stop_event.isSet()
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def get_stats(self):
+        stats = {'processes': len(self.children),
+                 'process_restarts': self.restarts}
+        for child_stats in self.stats.values():
+            for key, value in child_stats.items():
+                if isinstance(value, (int, long, float)):
+                    stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def render_metrics(self):
+        """Return the metrics of all processes, added up, in the
+        Prometheus text format.
+        """
+        stats = self.get_stats()
+        stats['uptime_seconds'] = time.time() - self.started
+        return metrics.render(metrics.merge(self.metrics.values()), stats)
+
+    def run(self):
+        import signal
+        old_handlers = [(s, signal.signal(s, self.stop))
+                        for s in (signal.SIGTERM, signal.SIGINT)]
+        try:
+            self._supervise()
+        finally:
+            for s, handler in old_handlers:
+                signal.signal(s, handler)
+
+    def _supervise(self):
+        import signal
+        pending = dict([(i, 0) for i in range(self.count)])
+        stopping = False
+        stats_logged = time.time()
+        while self.children or (pending and not stopping):
+            if self.stop_requested and not stopping:
+                stopping = True
+                self.log.info('Stopping %d processes' % len(self.children))
+                for pid in self.children:
+                    os.kill(pid, signal.SIGTERM)
+
+            # Sleep until a process reports or ends (which closes its
+            # pipe), we are asked to stop, or something else is due.
+            timeout = None
+            if not stopping:
+                for index, when in pending.items():
+                    if when <= time.time():
+                        del pending[index]
+                        self._spawn(index)
+                    else:
+                        timeout = min(timeout or when, when)
+            interval = config.DAEMON_STATS_INTERVAL
+            if interval is not None:
+                timeout = min(timeout or stats_logged + interval,
+                              stats_logged + interval)
+            if timeout is not None:
+                timeout = max(0, timeout - time.time())
+            self._read_stats(timeout, wakeup=not stopping)
+
+            for pid, index, crashed in self._reap():
+                if crashed and not stopping:
+                    self.log.error('Process %d (pid %d) died, restarting' % (
+                        index, pid))
+                    self.restarts += 1
+                    pending[index] = time.time() + self.restart_delay
+
+            if interval is not None and time.time() - stats_logged >= interval:
+                stats_logged = time.time()
+                self.log.info('Stats: %s' % ', '.join(['%s=%s' % item
+                    for item in sorted(self.get_stats().items())]))
+
+    def _spawn(self, index):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                try:
+                    os.close(r)
+                    for other_index, other in self.children.values():
+                        os.close(other)
+                    code = self._run_child(index, w)
+                except:
+                    self.log.exception('Process %d failed' % index)
+            finally:
+                os._exit(code)
+        os.close(w)
+        self.children[pid] = (index, r)
+        self.buffers[r] = ''
+        self.log.info('Started process %d (pid %d)' % (index, pid))
+
+    def _reap(self):
+        """Return (pid, index, crashed) for each process that ended.
+        """
+        result = []
+        for pid in self.children.keys():
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if wpid == 0:
+                continue
+            index, r = self.children.pop(pid)
+            # get what it last told us
+            self._read_stats(0, [r])
+            os.close(r)
+            del self.buffers[r]
+            crashed = not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0
+            result.append((pid, index, crashed))
+        return result
+
+    def _read_stats(self, timeout, pipes=None, wakeup=False):
+        import select, json
+        if pipes is None:
+            pipes = [r for index, r in self.children.values()]
+        try:
+            ready = select.select(
+                pipes + (wakeup and [self.stop_event] or []), [], [],
+                timeout)[0]
+        except select.error:
+            # interrupted by a signal
+            return
+        indexes = dict([(r, index) for index, r in self.children.values()])
+        for r in ready:
+            if r is self.stop_event:
+                continue
+            data = os.read(r, 65536)
+            lines = (self.buffers[r] + data).split('\n')
+            self.buffers[r] = lines.pop()
+            for line in lines:
+                if r in indexes:
+                    report = json.loads(line)
+                    self.stats[indexes[r]] = report['stats']
+                    self.metrics[indexes[r]] = report['metrics']
+
+    def _run_child(self, index, stats_pipe):
+        import signal, json
+        signal.signal(signal.SIGTERM, lambda *a: self.daemon.stop())
+        signal.signal(signal.SIGINT, lambda *a: self.daemon.stop())
+        for server in self.servers:
+            server.close_after_fork()
+        db.reset_after_fork()
+        net.reset()
+        metrics.registry.reset()
+        self.daemon.setup_process(index, self.count)
+
+        failed = []
+        done = util.Event()
+        def run():
+            try:
+                try:
+                    self.daemon.run()
+                except:
+                    failed.append(True)
+                    self.log.exception('Process %d: daemon failed' % index)
+            finally:
+                done.set()
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+
+        def report():
+            try:
+                os.write(stats_pipe, json.dumps({
+                    'stats': self.daemon.get_stats(),
+                    'metrics': metrics.registry.snapshot()}) + '\n')
+            except (OSError, TypeError, ValueError):
+                pass
+        while not done.wait(self.report_interval):
+            report()
+        report()
+        return failed and 1 or 0
@@ -6,8 +6,15 @@ import urllib, urllib2
 import urlparse
 import datetime
 import calendar
+import hashlib
+import os
+import time
+import errno
+import select
+import threading
 
 from feedplatform.conf import config
+from feedplatform import net
 
 
 __all__ = (
@@ -17,6 +24,8 @@ __all__ = (
     'asciify_url',
     'urlopen', 'UrlOpenError',
     'with_socket_timeout',
+    'jump_hash',
+    'Event',
 )
 
 
@@ -186,6 +195,45 @@ def asciify_url(url, force_quote=False):
 class UrlOpenError(Exception):
     pass
 
+
+class _LimitedResponse(object):
+    """Wraps a response returned by ``urlopen``, and releases the
+    host limiter once the response has been read completely, or is
+    closed or garbage collected; the download counts as part of the
+    request.
+    """
+
+    def __init__(self, response, limiter, host):
+        self._response = response
+        self._limiter, self._host = limiter, host
+
+    def _release(self):
+        limiter, self._limiter = self._limiter, None
+        if limiter is not None:
+            limiter.release(self._host)
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        if not args or not data:
+            self._release()
+        return data
+
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            self._release()
+
+    def __iter__(self):
+        return iter(self._response)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __del__(self):
+        self._release()
+
+
 def urlopen(url, *args, **kwargs):
     """Wrapper around ``urllib2.urlopen`` that uses the handlers and the
     user agent string defined in the feedplatform configuration.
@@ -194,20 +242,36 @@ def urlopen(url, *args, **kwargs):
     in both domain name and path.
 
     This should be used whenever network access is required as part of the
-    aggregator functionality.
+    aggregator functionality. Connections are reused and known redirects
+    skipped where possible, see ``feedplatform.net``.
 
     It also normalizes exception handling, which is slightly challenging,
     and reraises ``UrlOpenError``s for exceptions that you likely want to
     handle was potentially expected.
+
+    The request counts against the host limits (see the HOST_* settings)
+    until the response has been read completely, or is closed.
     """
-    opener = urllib2.build_opener(*config.URLLIB2_HANDLERS)
+    opener = urllib2.build_opener(*(list(config.URLLIB2_HANDLERS) +
+                                    net.get_handlers(config.URLLIB2_HANDLERS)))
     try:
         url = asciify_url(url)
-        request = urllib2.Request(url, *args, **kwargs)
+        # skip the redirects we already know about; they only apply
+        # to GET requests, not when posting ``data``.
+        if args or kwargs.get('data') is not None:
+            target, redirect_status = url, None
+        else:
+            target, redirect_status = net.resolve_redirects(url)
+        request = urllib2.Request(target, *args, **kwargs)
         request.add_header('User-Agent', config.USER_AGENT)
+        host, limiter = net.get_host(target), net.get_limiter()
+        limiter.acquire(host)
         try:
-            return opener.open(request)
+            response = opener.open(request)
         except Exception, e:
+            limiter.release(host)
+            if redirect_status:
+                net.forget_redirects(url)
             # At least five different exceptions may occur here:
             #    - urllib2.URLError
             #    - httplib.HTTPException, e.g. "nun-numeric port"
@@ -217,6 +281,7 @@ def urlopen(url, *args, **kwargs):
             # There are likely more. Instead of listing them explicitely,
             # we simple allow ourselves to capture everything.
             raise UrlOpenError("%s" % e)
+        return _LimitedResponse(response, limiter, host)
     finally:
         opener.close()
 
@@ -237,6 +302,154 @@ def with_socket_timeout(func):
     return wrapper
 
 
+def jump_hash(key, num_buckets):
+    """Map ``key``, a string or a number, to one of ``num_buckets``
+    buckets, using the "jump consistent hash" by Lamping and Veach
+    (http://arxiv.org/abs/1406.2294). Unicode strings are hashed in
+    their UTF-8 encoding.
+
+    The result is stable across processes and machines, and when the
+    number of buckets grows from n to n+1, only 1/(n+1) of the keys
+    move, all of them to the new bucket.
+
+    >>> [jump_hash(key, 1) for key in (1, 2, 'example.org')]
+    [0, 0, 0]
+    >>> jump_hash('example.org', 10) == jump_hash('example.org', 10)
+    True
+    """
+    # Python's own ``hash`` is not stable, and the algorithm needs
+    # well distributed 64-bit keys anyway.
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    key = long(hashlib.md5(str(key)).hexdigest()[:16], 16)
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+class Event(object):
+    """Like ``threading.Event``, but waits in the kernel rather than
+    polling.
+
+    In Python 2, ``threading.Event.wait`` with a timeout, and thus
+    everything built on it like ``Queue.get``, wakes up every few
+    milliseconds to check whether it is done yet. Here, a pipe is used
+    instead, which is readable once the event is set. The event can
+    also be passed to ``select`` along with sockets, via ``fileno``,
+    so that a server can wait for a request and for the event at the
+    same time.
+
+    The pipe is only created once something waits for the event, or
+    asks for ``fileno``, and closed along with the event (or with
+    ``close``). Each process has its own pipe, so that an event set in
+    a forked process isn't set in the others; the one inherited from
+    the parent is closed in the child when it first uses the event.
+    """
+
+    def __init__(self):
+        self._flag = False
+        # reentrant, as it may be set by a signal handler
+        self._lock = threading.RLock()
+        self._pid = None
+        self._pipe = None
+
+    def __del__(self):
+        try:
+            self._close_pipe()
+        except (OSError, TypeError, AttributeError):
+            # e.g. modules already torn down at interpreter exit
+            pass
+
+    def _has_pipe(self):
+        return self._pipe is not None and self._pid == os.getpid()
+
+    def _get_pipe(self):
+        # with the lock held
+        if not self._has_pipe():
+            self._close_pipe()
+            self._pipe = os.pipe()
+            self._pid = os.getpid()
+            if self._flag:
+                os.write(self._pipe[1], 'x')
+        return self._pipe
+
+    def _close_pipe(self):
+        # Also closes a pipe inherited from the parent process; the
+        # child has its own copies of the descriptors.
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = self._pid = None
+
+    def close(self):
+        """Close the pipe, if any. Only needed to release it before
+        the event is garbage collected; if it is used again, a new one
+        is created.
+        """
+        self._lock.acquire()
+        try:
+            self._close_pipe()
+        finally:
+            self._lock.release()
+
+    def fileno(self):
+        self._lock.acquire()
+        try:
+            return self._get_pipe()[0]
+        finally:
+            self._lock.release()
+
+    def isSet(self):
+        return self._flag
+    is_set = isSet
+
+    def set(self):
+        self._lock.acquire()
+        try:
+            if not self._flag:
+                self._flag = True
+                # without a pipe, there is no one to wake up
+                if self._has_pipe():
+                    os.write(self._pipe[1], 'x')
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            if self._flag:
+                self._flag = False
+                if self._has_pipe():
+                    os.read(self._pipe[0], 1)
+        finally:
+            self._lock.release()
+
+    def wait(self, timeout=None):
+        """Wait until the event is set, or ``timeout`` seconds have
+        passed. Returns whether the event is set.
+        """
+        if self._flag:
+            return True
+        if timeout is not None:
+            endtime = time.time() + timeout
+        fd = self.fileno()
+        while not self._flag:
+            if timeout is not None:
+                timeout = endtime - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                select.select([fd], [], [], timeout)
+            except select.error, e:
+                # interrupted by a signal; the handler may have set us
+                if e.args[0] != errno.EINTR:
+                    raise
+        return self._flag
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
\ No newline at end of file
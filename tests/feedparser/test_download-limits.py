@@ -0,0 +1,68 @@
+"""Feedparser reads responses in chunks, and gives up if they exceed
+the configured size or take too long to download.
+"""
+
+import time
+import zlib
+from feedplatform.deps import feedparser
+from feedplatform.test import MockHTTPResponse
+
+
+FEED = '<rss><channel><title>%s</title></channel></rss>' % ('x' * 100000)
+
+
+def response(data, headers={}):
+    return MockHTTPResponse(200, 'OK', headers, data, 'http://feeds/test')
+
+def gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def test_limits():
+    # no limits
+    assert not feedparser.parse(response(FEED)).bozo
+
+    # too large, detected while reading or upfront
+    f = feedparser.parse(response(FEED), max_size=50000)
+    assert isinstance(f.bozo_exception, feedparser.ResponseTooLarge)
+    f = feedparser.parse(response('', {'Content-Length': len(FEED)}),
+                         max_size=50000)
+    assert isinstance(f.bozo_exception, feedparser.ResponseTooLarge)
+    # we still know about the response, though
+    assert f.status == 200
+
+    # compressed data is small, but decompresses to too much
+    data = gzip(FEED)
+    headers = {'Content-Encoding': 'gzip',
+               'Content-Type': 'application/rss+xml'}
+    f = feedparser.parse(response(data, headers), max_size=len(data),
+                         max_decompressed_size=len(FEED))
+    assert not f.bozo
+    assert f.feed.title
+    # (the content type check does not hide the actual problem)
+    headers['Content-Type'] = 'text/html'
+    f = feedparser.parse(response(data, headers), max_size=len(data),
+                         max_decompressed_size=50000)
+    assert isinstance(f.bozo_exception, feedparser.ResponseTooLarge)
+    assert not f.feed
+
+    # the same for deflate
+    data = zlib.compress(FEED)[2:-4]
+    headers = {'Content-Encoding': 'deflate'}
+    f = feedparser.parse(response(data, headers))
+    assert f.feed.title
+    f = feedparser.parse(response(data, headers), max_decompressed_size=50000)
+    assert isinstance(f.bozo_exception, feedparser.ResponseTooLarge)
+
+
+def test_timeout():
+    class SlowStream(object):
+        def read(self, size):
+            time.sleep(0.05)
+            return 'x' * size
+
+    f = feedparser.parse(SlowStream(), timeout=0.01)
+    assert isinstance(f.bozo_exception, feedparser.DownloadTimeout)
+    # counts as a download error
+    assert isinstance(f.bozo_exception, IOError)
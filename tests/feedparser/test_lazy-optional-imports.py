@@ -0,0 +1,20 @@
+"""Optional modules are imported by feedparser on first use.
+"""
+
+import sys
+from feedplatform.deps import feedparser
+from feedplatform.deps.feedparser import _feedparser
+
+
+def test_lazy_imports():
+    # unavailable modules are reported as such, and remembered
+    assert _feedparser._import_optional('no_such_module_exists') is None
+    assert 'no_such_module_exists' in _feedparser._optional_modules
+
+    # available modules are imported
+    assert _feedparser._import_optional('zlib') is sys.modules['zlib']
+
+    # parsing still works fine with the lazy imports (the encoding
+    # is unknown, so chardet would be used, if available)
+    f = feedparser.parse('<rss><channel><title>\xe4</title></channel></rss>')
+    assert f.feed.title
@@ -0,0 +1,55 @@
+"""Compressed responses are decompressed while they are read, and utf-8
+documents are no longer converted through unicode.
+"""
+
+import zlib
+from feedplatform.deps import feedparser
+from feedplatform.deps.feedparser import _feedparser
+from feedplatform.test import MockHTTPResponse
+
+
+def response(data, encoding):
+    headers = {'Content-Encoding': encoding,
+               'Content-Type': 'application/rss+xml'}
+    return MockHTTPResponse(200, 'OK', headers, data, 'http://feeds/test')
+
+def gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def test_decompression():
+    # spans multiple chunks
+    feed = '<rss><channel><title>%s</title></channel></rss>' % (
+        ''.join([str(i) for i in xrange(50000)]))
+    data = gzip(feed)
+    assert len(data) > _feedparser._READ_CHUNK_SIZE
+    f = feedparser.parse(response(data, 'gzip'))
+    assert not f.bozo
+    assert f.data == feed
+
+    # we stop decompressing as soon as the limit is reached
+    data = gzip('<rss>' + ' ' * 5000000)
+    f = feedparser.parse(response(data, 'gzip'), max_decompressed_size=1000)
+    assert isinstance(f.bozo_exception, feedparser.ResponseTooLarge)
+
+    # data that isn't actually compressed
+    f = feedparser.parse(response(feed, 'gzip'))
+    assert f.bozo
+    assert f.status == 200
+
+
+def test_utf8():
+    data = '<?xml version="1.0" encoding="ascii"?><rss>\xc3\xa4</rss>'
+    converted = _feedparser._toUTF8(data, 'utf-8')
+    assert converted == "<?xml version='1.0' encoding='utf-8'?><rss>\xc3\xa4</rss>"
+    assert _feedparser._toUTF8('<rss/>', 'utf8') == \
+        "<?xml version='1.0' encoding='utf-8'?>\n<rss/>"
+
+    # the data is still validated
+    try:
+        _feedparser._toUTF8(data, 'ascii')
+    except UnicodeDecodeError:
+        pass
+    else:
+        assert False, 'data is not ascii'
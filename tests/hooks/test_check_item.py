@@ -0,0 +1,56 @@
+from feedplatform import test as feedev
+from feedplatform import addins
+from feedplatform import parse
+
+class test_addin(addins.base):
+    check_item = 0
+    found_item = 0
+    process_item = 0
+    unchanged = False
+    def on_check_item(self, feed, item, entry_dict):
+        self.check_item += 1
+        if self.unchanged:
+            return True
+    def on_found_item(self, feed, item, entry_dict):
+        self.found_item += 1
+    def on_process_item(self, feed, item, entry_dict, created):
+        self.process_item += 1
+
+ADDINS = [test_addin()]
+
+class TestFeed(feedev.Feed):
+    content = """
+    <rss><channel>
+        <item><guid>i-1</guid></item>
+    </channel></rss>
+    """
+
+    def pass1(feed):
+        # not called for a new item
+        assert ADDINS[0].check_item == 0
+        assert ADDINS[0].process_item == 1
+
+    def pass2(feed):
+        # but for an existing one, followed by the usual hooks
+        assert ADDINS[0].check_item == 1
+        assert ADDINS[0].found_item == 1
+        assert ADDINS[0].process_item == 2
+
+        # report the item as unchanged from now on
+        ADDINS[0].unchanged = True
+
+    def pass3(feed):
+        # the follow-up hooks are skipped
+        assert ADDINS[0].check_item == 2
+        assert ADDINS[0].found_item == 1
+        assert ADDINS[0].process_item == 2
+
+        # unless a full update is requested, in which case the hook
+        # isn't even called.
+        parse.update_feed(feed, {'full': True})
+        assert ADDINS[0].check_item == 2
+        assert ADDINS[0].found_item == 2
+        assert ADDINS[0].process_item == 3
+
+def test():
+    feedev.testmod()
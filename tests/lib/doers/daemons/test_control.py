@@ -0,0 +1,169 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+from feedplatform.lib import provide_queue_daemon, WorkerPool, SlowFeeds
+from feedplatform.control import ControlServer, send_command
+from feedplatform.queues import FeedQueue
+from feedplatform import addins
+from feedplatform import db
+from feedplatform import test as feedev
+from feedplatform.conf import config
+
+
+class block_updates(addins.base):
+    """Holds up the update of ``url`` until ``release`` is set."""
+    def __init__(self):
+        self.url = None
+        self.entered = threading.Event()
+        self.release = threading.Event()
+    def on_after_parse(self, feed, data_dict):
+        if feed.url == self.url:
+            self.entered.set()
+            self.release.wait()
+
+
+def _wait_for(condition):
+    timeout = time.time() + 10
+    while not condition():
+        assert time.time() < timeout
+        time.sleep(0.01)
+
+
+def test_control():
+    """A running daemon can be inspected and controlled through a
+    ``ControlServer``."""
+
+    blocker = block_updates()
+    daemon = provide_queue_daemon(FeedQueue())
+    tempdir = tempfile.mkdtemp()
+    address = os.path.join(tempdir, 'control')
+
+    class Feed1(feedev.Feed):
+        def pass1(feed):
+            # the server updates feeds using connections of its own
+            db.store.commit()
+            server = ControlServer(daemon, address)
+            server.start()
+            server.ready.wait()
+            try:
+                _test_commands(feed)
+            finally:
+                server.stop()
+                server.join()
+            assert not os.path.exists(address)
+
+    class Feed2(feedev.Feed):
+        content = """<rss><channel>
+            <item><guid>http://example.org/1</guid></item>
+        </channel></rss>"""
+
+    def _test_commands(feed):
+        assert send_command(address, 'status') == \
+            (200, 'running, workers=1, in flight=0', [])
+        assert send_command(address, 'pause')[0] == 200
+        assert send_command(address, 'pause')[0] == 304
+        assert daemon.paused
+        assert send_command(address, 'status')[1].startswith('paused')
+
+        # invalid requests
+        assert send_command(address, 'foo')[0] == 400
+        assert send_command(address, 'update')[0] == 400
+        assert send_command(address, 'workers x')[0] == 400
+        assert send_command(address, 'workers 2') == \
+            (400, 'the daemon is not running multiple workers', [])
+        assert send_command(address, 'update 9999')[0] == 404
+        assert send_command(address, 'slowest')[0] == 304
+
+        # feeds are updated even when paused, and can be watched while
+        # they are
+        feed_id = db.get_one(db.backend.find_feeds(Feed2.url)).id
+        db.store.commit()
+        blocker.url = Feed2.url
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            send_command(address, 'update %s' % Feed2.url)))
+        thread.start()
+        blocker.entered.wait()
+        code, message, lines = send_command(address, 'in-flight')
+        assert (code, message) == (200, '1 feeds in flight')
+        assert lines[0].startswith('#%d after_parse ' % feed_id)
+        assert lines[0].endswith(' %s' % Feed2.url)
+        blocker.release.set()
+        thread.join()
+        code, message, lines = result[0]
+        assert code == 200
+        assert message.startswith('Updated feed #%d' % feed_id)
+        assert message.endswith(': status 200, 1 new item(s)')
+        assert not daemon.get_in_flight()
+
+        code, message, lines = send_command(address, 'slowest')
+        assert (code, message) == (200, '1 slowest updates')
+        assert lines[0].startswith('#%d ' % feed_id)
+        assert lines[0].endswith(', status 200, 1 new item(s), %s' %
+                                 Feed2.url)
+
+        assert send_command(address, 'resume')[0] == 200
+        assert not daemon.paused
+
+    if not config.configured:
+        config.configure()
+    old_settings = config.DATABASE, config.DAEMON_SLOWEST_FEEDS
+    config.DATABASE = 'sqlite:%s' % os.path.join(tempdir, 'test.db')
+    config.DAEMON_SLOWEST_FEEDS = 5
+    try:
+        feedev.testcustom([Feed1, Feed2], addins=[blocker])
+    finally:
+        config.DATABASE, config.DAEMON_SLOWEST_FEEDS = old_settings
+        db.reconfigure()
+        shutil.rmtree(tempdir)
+
+
+def test_worker_pool():
+    """Workers can be added and retired while the pool runs."""
+
+    running = {}
+    stop = threading.Event()
+    def work(index):
+        running[index] = True
+        try:
+            while not stop.isSet() and not pool.retire(index):
+                time.sleep(0.01)
+        finally:
+            del running[index]
+    pool = WorkerPool(work, 3)
+    pool.start()
+    _wait_for(lambda: sorted(running) == [0, 1, 2])
+    pool.resize(1)
+    _wait_for(lambda: sorted(running) == [0])
+    pool.resize(2)
+    _wait_for(lambda: sorted(running) == [0, 1])
+    stop.set()
+    pool.join()
+    assert not running
+
+
+def test_slow_feeds():
+    """The slowest updates of the current and the last window are
+    kept."""
+
+    class Progress(object):
+        def __init__(self, elapsed):
+            self.elapsed = elapsed
+
+    slowest = SlowFeeds(2, window=60)
+    for elapsed in (3, 1, 5, 2):
+        slowest.add(Progress(elapsed))
+    assert [p.elapsed for p in slowest.get()] == [5, 3]
+
+    # a new window starts; the old one is still taken into account
+    slowest._window_started -= 60
+    slowest.add(Progress(4))
+    assert [p.elapsed for p in slowest.get()] == [5, 4]
+    # until it is over as well
+    slowest._window_started -= 60
+    assert [p.elapsed for p in slowest.get()] == [4]
+    slowest._window_started -= 120
+    assert slowest.get() == []
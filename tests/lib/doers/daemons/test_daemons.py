@@ -1,12 +1,24 @@
 """Test the general daemon infrastructure, daemon base classes etc.
 """
 
+import os
 import sys
+import time
+import shutil
+import tempfile
+import threading
 import StringIO
 from nose.tools import assert_raises
-from feedplatform.lib import base_daemon
+from feedplatform.lib import base_daemon, provide_loop_daemon, \
+    provide_queue_daemon, provide_multi_daemon
+from feedplatform.lib.addins.doers.daemons import StatsCommand
+from feedplatform.queues import FeedQueue
 from feedplatform import addins
+from feedplatform import metrics
 from feedplatform import management
+from feedplatform import db
+from feedplatform import test as feedev
+from feedplatform.conf import config
 
 
 class dummy_daemon(base_daemon):
@@ -70,4 +82,215 @@ def test_start_cmd():
     # if an invalid name is given, an error is raised
     assert "not a known daemon" in \
                 _call_start([dummy_daemon('1', name="foo"),
-                             dummy_daemon('2', name="bar")], "python-rocks")
\ No newline at end of file
+                             dummy_daemon('2', name="bar")], "python-rocks")
+
+    # only some daemons can be sharded
+    assert "does not support --shard" in \
+                _call_start([dummy_daemon('1')], shard='0/2')
+    daemon = dummy_daemon('1')
+    daemon.can_shard = True
+    assert "invalid value for --shard" in \
+                _call_start([daemon], shard='2/2')
+    assert _call_start([daemon], shard='1/2', shard_by='host') == '1'
+    assert str(daemon.shard) == '1/2' and daemon.shard.by == 'host'
+
+    # same for multiple processes
+    assert "does not support --processes" in \
+                _call_start([dummy_daemon('1')], processes=2)
+    daemon.can_multiprocess = True
+    assert "cannot be combined" in \
+                _call_start([daemon], processes=2, shard='1/2')
+
+    # profiling needs a limit to be repeated
+    assert "--profile-interval requires" in \
+                _call_start([dummy_daemon('1')], profile='out.prof',
+                            profile_interval=60)
+    assert "cannot be combined" in \
+                _call_start([daemon], processes=2, profile='out.prof')
+
+class waiting_daemon(base_daemon):
+    def run(self):
+        self.wait_for_stop()
+
+
+def test_stop():
+    """Idle daemons block rather than poll, but still stop right
+    away when asked to."""
+
+    daemon = waiting_daemon()
+    assert not daemon.wait_for_stop(0.01)
+    daemon.stop()
+    assert daemon.wait_for_stop()
+
+    daemon = provide_multi_daemon(provide_queue_daemon(FeedQueue()),
+                                  [waiting_daemon()])
+    daemon.start()
+    time.sleep(0.05)
+    daemon.stop()
+    assert daemon.finished.wait(5)
+    daemon.join()
+    assert not [d for d in daemon.all_daemons if d.isAlive()]
+
+
+class flag_daemon(waiting_daemon):
+    """Stops the way daemons did before ``stop_event``."""
+    def stop(self):
+        self.stop_requested = True
+
+
+class extended_daemon(waiting_daemon):
+    def run(self):
+        super(extended_daemon, self).run()
+        self.after_run = self.finished.isSet()
+
+
+def test_stop_requested():
+    """``stop_requested`` can still be set directly."""
+    daemon = flag_daemon()
+    daemon.start()
+    daemon.stop()
+    assert daemon.stop_requested
+    assert daemon.finished.wait(5)
+    daemon.join()
+
+    daemon.stop_requested = False
+    assert not daemon.stop_requested
+    assert not daemon.wait_for_stop(0.01)
+
+
+def test_finished():
+    """``finished`` is set once the outermost ``run`` returns, not
+    when a subclass calls the one of its base class."""
+    daemon = extended_daemon()
+    daemon.start()
+    assert not daemon.finished.wait(0.01)
+    daemon.stop()
+    assert daemon.finished.wait(5)
+    daemon.join()
+    assert daemon.after_run is False
+    assert 'run' not in daemon.__dict__
+
+
+def test_event_pipe():
+    """The pipe of an event is only opened when needed, and closed
+    again, also after a fork."""
+    from feedplatform.util import Event
+
+    def is_open(fd):
+        try:
+            os.fstat(fd)
+        except OSError:
+            return False
+        return True
+
+    event = Event()
+    event.set()
+    event.clear()
+    assert event._pipe is None
+    assert not event.wait(0.01)
+    read, write = event._pipe
+    event.set()
+    assert event.wait()
+
+    pid = os.fork()
+    if not pid:
+        # The child replaces the inherited pipe with one of its own,
+        # which is readable, as the event is set.
+        import select
+        fds = len(os.listdir('/dev/fd'))
+        ok = select.select([event.fileno()], [], [], 0)[0] and \
+            len(os.listdir('/dev/fd')) == fds
+        os._exit(not ok)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    event.close()
+    assert not is_open(read) and not is_open(write)
+    assert event.wait()
+
+
+def test_stats_cmd():
+    """A running daemon serves its statistics to the "stats" command."""
+
+    def call(command, **options):
+        old_stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            management.call_command(command, **options)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+
+    daemon = waiting_daemon()
+    old_settings = config.STORAGE_BACKEND, config.DAEMON_STATS_ADDRESS
+    tempdir = tempfile.mkdtemp()
+    config.STORAGE_BACKEND = db.MemoryBackend
+    config.DAEMON_STATS_ADDRESS = os.path.join(tempdir, 'stats')
+    addins.reinstall(addins=[daemon])
+    db.reconfigure()
+    management.reload_commands()
+    thread = threading.Thread(target=call, args=('start',))
+    thread.start()
+    try:
+        while not os.path.exists(config.DAEMON_STATS_ADDRESS):
+            time.sleep(0.01)
+        assert 'feedplatform_feeds_updated 0' in call('stats', raw=True)
+        daemon.stop()
+        thread.join()
+        # the server is gone with the daemon
+        assert not os.path.exists(config.DAEMON_STATS_ADDRESS)
+    finally:
+        daemon.stop()
+        thread.join()
+        config.STORAGE_BACKEND, config.DAEMON_STATS_ADDRESS = old_settings
+        db.reconfigure()
+        shutil.rmtree(tempdir)
+
+
+def test_stats_summary():
+    """The "stats" command summarizes the metrics of a daemon."""
+
+    text = """
+feedplatform_uptime_seconds 100
+feedplatform_updates_total{status="200"} 30
+feedplatform_updates_total{status="304"} 10
+feedplatform_downloaded_bytes_total 2048
+feedplatform_stage_seconds_bucket{stage="fetch",le="1.0"} 40
+feedplatform_stage_seconds_bucket{stage="fetch",le="+Inf"} 40
+feedplatform_errors_total{error="IOError"} 2
+feedplatform_queue_depth 5
+"""
+    summary = dict(StatsCommand().summarize(metrics.parse_text(text)))
+    assert summary['feeds updated'] == '40 (0.40/s)'
+    assert summary['not modified (304)'] == '25.0%'
+    assert summary['downloaded'] == '2.0 kB'
+    assert summary['fetch time'] == 'p50=0.500s p90=0.900s p99=0.990s'
+    assert summary['errors'] == 'IOError=2'
+    assert summary['queue depth'] == '5'
+
+    # with an earlier query, rates are over the interval in between
+    before = metrics.parse_text(text.replace('30', '20'))
+    summary = dict(StatsCommand().summarize(metrics.parse_text(text),
+                                            before, 5))
+    assert summary['feeds updated'] == '10 (2.00/s)'
+
+
+def test_update_feed():
+    """Daemons update feeds through ``base_daemon.update_feed``, which
+    keeps statistics and has the backend release objects afterwards."""
+
+    class TestFeed(feedev.Feed):
+        content = """<rss><channel>
+            <item><guid>http://example.org/1</guid></item>
+            <item><guid>http://example.org/2</guid></item>
+        </channel></rss>"""
+
+        def pass1(feed):
+            daemon = provide_loop_daemon(once=True)
+            daemon.run()
+            stats = daemon.get_stats()
+            assert stats['feeds_updated'] == 1
+            assert stats['store_cache_size'] == 0
+
+            # objects that are still referenced remain usable
+            assert db.backend.get_feed(feed.id) is feed
+
+    feedev.testcustom([TestFeed])
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import datetime
+
+from feedplatform.lib import provide_lease_daemon
+from feedplatform import addins
+from feedplatform import db
+from feedplatform import test as feedev
+from feedplatform.conf import config
+
+
+class record_updates(addins.base):
+    def __init__(self):
+        self.updates = []
+    def on_after_parse(self, feed, data_dict):
+        self.updates.append((feed.url, feed.claimed_by))
+
+
+def test_leases():
+    """Feeds are claimed before they are updated, and released
+    afterwards."""
+
+    recorder = record_updates()
+    daemon = provide_lease_daemon(node=u'a', batch_size=2, interval=3600,
+                                  once=True)
+
+    class Feed1(feedev.Feed):
+        def pass1(feed):
+            del recorder.updates[:]
+            now = datetime.datetime.utcnow()
+            # Feed2 is claimed by someone else, Feed3 was claimed by a
+            # node that died, and needs to be picked up.
+            other = db.get_one(db.backend.find_feeds(Feed2.url))
+            other.claimed_by = u'b'
+            other.lease_expires = now + datetime.timedelta(seconds=60)
+            dead = db.get_one(db.backend.find_feeds(Feed3.url))
+            dead.claimed_by = u'c'
+            dead.lease_expires = now - datetime.timedelta(seconds=60)
+            db.backend.commit()
+
+            daemon.run()
+            assert sorted(recorder.updates) == [(Feed1.url, u'a/0'),
+                                                (Feed3.url, u'a/0')]
+            assert daemon.get_stats()['feeds_updated'] == 2
+
+            db.backend.rollback()
+            assert feed.claimed_by is None
+            assert feed.lease_expires > now + datetime.timedelta(seconds=3000)
+            assert other.claimed_by == u'b'
+
+            # nothing is due anymore
+            del recorder.updates[:]
+            daemon.run()
+            assert recorder.updates == []
+
+    class Feed2(feedev.Feed):
+        pass
+
+    class Feed3(feedev.Feed):
+        pass
+
+    feedev.testcustom([Feed1, Feed2, Feed3], addins=[recorder, daemon])
+
+
+def test_nodes():
+    """Multiple nodes with multiple workers each update every feed
+    exactly once."""
+
+    recorder = record_updates()
+    daemons = [provide_lease_daemon(node=u'a', batch_size=2, interval=3600,
+                                    workers=2, once=True),
+               provide_lease_daemon(node=u'b', batch_size=2, interval=3600,
+                                    workers=2, once=True)]
+
+    class Feed1(feedev.Feed):
+        def pass1(feed):
+            del recorder.updates[:]
+            db.backend.commit()
+            for daemon in daemons:
+                daemon.start()
+            for daemon in daemons:
+                daemon.join()
+            assert sorted([url for url, node in recorder.updates]) == \
+                sorted([f.url for f in feeds])
+
+    feeds = [Feed1] + [type('Feed%d' % i, (feedev.Feed,), {})
+                       for i in range(2, 7)]
+
+    fd, filename = tempfile.mkstemp('.db')
+    os.close(fd)
+    if not config.configured:
+        config.configure()
+    old_database = config.DATABASE
+    config.DATABASE = 'sqlite:%s' % filename
+    try:
+        feedev.testcustom(feeds, addins=[recorder] + daemons)
+    finally:
+        config.DATABASE = old_database
+        db.reconfigure()
+        os.unlink(filename)
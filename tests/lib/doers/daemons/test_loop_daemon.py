@@ -1,3 +1,14 @@
+import os
+import tempfile
+import threading
+
+from nose.tools import assert_raises
+from feedplatform.lib import provide_loop_daemon
+from feedplatform.sharding import Shard
+from feedplatform import addins
+from feedplatform import db
+from feedplatform import test as feedev
+from feedplatform.conf import config
 
 
 def test_loop_daemon():
@@ -18,4 +29,115 @@ def test_loop_daemon():
     #
     # (in 2.6): with feedev.environment: ...
 
-    pass
\ No newline at end of file
+    pass
+
+
+def test_workers():
+    """Feeds can be updated by multiple worker threads, each with its
+    own database connection - which rules out an in-memory database."""
+
+    class record_updates(addins.base):
+        def __init__(self):
+            self.updates = []
+        def on_after_parse(self, feed, data_dict):
+            self.updates.append((feed.id, threading.currentThread()))
+    recorder = record_updates()
+
+    class Feed1(feedev.Feed):
+        def pass1(feed):
+            del recorder.updates[:]
+            # don't hold a lock on the database
+            db.store.commit()
+
+            daemon = provide_loop_daemon(once=True, workers=3)
+            daemon.run()
+            assert daemon.get_stats()['feeds_updated'] == 3
+            assert sorted([id for id, t in recorder.updates]) == [1, 2, 3]
+            assert not threading.currentThread() in \
+                [t for id, t in recorder.updates]
+
+            # the number of workers can be changed as they go
+            del recorder.updates[:]
+            def callback(count):
+                if daemon.workers > 1:
+                    daemon.set_workers(1)
+            daemon = provide_loop_daemon(once=True, workers=3,
+                                         callback=callback)
+            assert_raises(ValueError, daemon.set_workers, 2)
+            daemon.run()
+            assert sorted([id for id, t in recorder.updates]) == [1, 2, 3]
+            assert daemon.workers == 1
+
+    class Feed2(feedev.Feed):
+        pass
+
+    class Feed3(feedev.Feed):
+        pass
+
+    fd, filename = tempfile.mkstemp('.db')
+    os.close(fd)
+    if not config.configured:
+        config.configure()
+    old_database = config.DATABASE
+    config.DATABASE = 'sqlite:%s' % filename
+    try:
+        feedev.testcustom([Feed1, Feed2, Feed3], addins=[recorder])
+    finally:
+        config.DATABASE = old_database
+        db.reconfigure()
+        os.unlink(filename)
+
+
+def test_shards():
+    """Multiple daemons can split the feeds between them."""
+
+    class record_updates(addins.base):
+        def __init__(self):
+            self.updates = []
+        def on_before_parse(self, feed, parser_args):
+            self.updates.append(feed.id)
+            return True
+    recorder = record_updates()
+
+    old_settings = config.STORAGE_BACKEND, config.ADDINS
+    config.STORAGE_BACKEND, config.ADDINS = db.MemoryBackend, [recorder]
+    addins.reinstall()
+    db.reconfigure()
+    try:
+        for i in range(40):
+            feed = db.models.Feed()
+            feed.url = u'http://host%d.example.org/feed' % (i % 10)
+            db.backend.add(feed)
+        db.backend.flush()
+
+        for by in ('id', 'host'):
+            shards = []
+            for i in range(3):
+                del recorder.updates[:]
+                provide_loop_daemon(once=True,
+                                    shard=Shard(i, 3, by=by)).run()
+                shards.append(set(recorder.updates))
+            assert sum([len(s) for s in shards]) == 40
+            assert len(reduce(set.union, shards)) == 40
+            if by == 'host':
+                hosts = [set([db.backend.get_feed(id).url for id in s])
+                         for s in shards]
+                assert sum([len(h) for h in hosts]) == 10
+
+        # a shard can be given as a string
+        del recorder.updates[:]
+        provide_loop_daemon(once=True, shard='0/1').run()
+        assert len(recorder.updates) == 40
+        assert_raises(ValueError, Shard.parse, '3/3')
+        assert_raises(ValueError, Shard.parse, '3')
+
+        # international domain names are sharded by their ASCII form
+        shard = Shard(0, 4, by='host')
+        for i in range(4):
+            shard.index = i
+            assert shard(1, u'http://b\xfccher.example/feed') == \
+                shard(2, u'http://xn--bcher-kva.example/feed')
+    finally:
+        config.STORAGE_BACKEND, config.ADDINS = old_settings
+        addins.reinstall()
+        db.reconfigure()
@@ -0,0 +1,169 @@
+import os
+import time
+import Queue
+import shutil
+import socket
+import tempfile
+
+from feedplatform.lib import provide_socket_queue_controller
+from feedplatform.queues import FeedQueue, PriorityFeedQueue
+from feedplatform.contrib.queuecontrol import \
+    send_to_queue, send_many, QueueConnection, QueueUserError
+from feedplatform import addins
+from feedplatform import db
+from feedplatform import test as feedev
+from feedplatform.conf import config
+
+
+def _run_controller(queue, func, timeout=None):
+    old_settings = config.STORAGE_BACKEND, config.ADDINS
+    config.STORAGE_BACKEND, config.ADDINS = db.MemoryBackend, []
+    addins.reinstall()
+    db.reconfigure()
+    tempdir = tempfile.mkdtemp()
+    address = os.path.join(tempdir, 'ping')
+    daemon = provide_socket_queue_controller(queue, address, timeout)
+    try:
+        for url in (u'http://example.org/1', u'http://example.org/2'):
+            feed = db.models.Feed()
+            feed.url = url
+            db.backend.add(feed)
+        db.backend.commit()
+
+        daemon.start(daemon=True)
+        while not os.path.exists(address):
+            time.sleep(0.01)
+        func(address)
+    finally:
+        daemon.stop()
+        daemon.join()
+        shutil.rmtree(tempdir)
+        config.STORAGE_BACKEND, config.ADDINS = old_settings
+        addins.reinstall()
+        db.reconfigure()
+
+
+def test_protocol():
+    """Many requests can be sent over one connection."""
+
+    queue = Queue.Queue(maxsize=3)
+    def test(address):
+        send_to_queue(address, 1)
+        try:
+            send_to_queue(address, 5)
+        except QueueUserError, e:
+            assert e.code == 404
+        else:
+            assert False, 'feed does not exist'
+
+        # a connection can be reused; responses are in order
+        connection = QueueConnection(address, window=2)
+        errors = connection.send_many(
+            [1, 2, u'http://example.org/1', 3, 1, 2])
+        # (feeds already queued are not an error)
+        assert [e and e.code for e in errors] == \
+            [None, None, None, 404, None, None]
+        connection.send(u'http://example.org/2')
+        assert queue.qsize() == 2
+
+        # the connection is reestablished if necessary
+        connection.socket.close()
+        queue.get()
+        assert connection.send_many([1]) == [None]
+        connection.close()
+
+        assert send_many(address, []) == []
+    _run_controller(queue, test)
+
+
+def test_feed_queue():
+    """With a ``FeedQueue``, ids are queued."""
+
+    queue = FeedQueue(maxsize=1)
+    def test(address):
+        connection = QueueConnection(address)
+        errors = connection.send_many([1, u'http://example.org/1', 2])
+        assert [e and e.code for e in errors] == [None, None, 507]
+        assert list(queue.queue) == [1]
+        connection.close()
+    _run_controller(queue, test, timeout=0.01)
+
+
+def test_batches():
+    """Requests arriving together are handled as a batch, whichever
+    way they are split up."""
+
+    queue = FeedQueue()
+    def test(address):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        sock.sendall('1\n5\nhttp://example.org/2\n\n1 foo=bar\n1')
+        time.sleep(0.05)
+        sock.sendall('\n2\n')
+        sock.shutdown(socket.SHUT_WR)
+        f = sock.makefile('rb')
+        assert f.read().splitlines() == [
+            '200 Ok', '404 Feed not found', '200 Ok',
+            '400 Invalid option: foo=bar', '304 Feed already in queue',
+            '304 Feed already in queue']
+        sock.close()
+        assert list(queue.queue) == [1, 2]
+    _run_controller(queue, test)
+
+
+def test_database():
+    """With a database, each connection uses a store of its own."""
+
+    class Feed1(feedev.Feed):
+        def pass1(feed):
+            queue = FeedQueue()
+            tempdir = tempfile.mkdtemp()
+            address = os.path.join(tempdir, 'ping')
+            daemon = provide_socket_queue_controller(queue, address)
+            daemon.start(daemon=True)
+            try:
+                while not os.path.exists(address):
+                    time.sleep(0.01)
+                errors = send_many(address, [feed.id, feed.id + 1,
+                                             feed.url])
+                assert [e and e.code for e in errors] == [None, 404, None]
+                assert list(queue.queue) == [feed.id]
+            finally:
+                daemon.stop()
+                daemon.join()
+                shutil.rmtree(tempdir)
+
+    if not config.configured:
+        config.configure()
+    old_database = config.DATABASE
+    fd, filename = tempfile.mkstemp('.db')
+    os.close(fd)
+    config.DATABASE = 'sqlite:%s' % filename
+    try:
+        feedev.testcustom([Feed1])
+    finally:
+        config.DATABASE = old_database
+        db.reconfigure()
+        os.unlink(filename)
+
+
+def test_priorities():
+    """Priorities are passed along to queues that support them."""
+
+    queue = PriorityFeedQueue()
+    def test(address):
+        connection = QueueConnection(address)
+        connection.send(1, priority='background')
+        connection.send(2, priority='interactive', deadline=10)
+        errors = connection.send_many([1, 2], priority='urgent')
+        assert [e.code for e in errors] == [400, 400]
+        errors = connection.send_many(['1 deadline=soon', '1 foo=bar'])
+        assert [e.code for e in errors] == [400, 400]
+        assert [queue.get(), queue.get()] == [2, 1]
+
+        # priorities may also be given as numbers, 0 being the highest
+        connection.send(1, priority=20)
+        connection.send(2, priority=0)
+        assert [queue.get(), queue.get()] == [2, 1]
+        connection.close()
+    _run_controller(queue, test)
@@ -0,0 +1,167 @@
+import os
+import time
+import tempfile
+import threading
+
+from feedplatform.lib import provide_loop_daemon
+from feedplatform.supervisor import ProcessSupervisor
+from feedplatform import addins
+from feedplatform import metrics
+from feedplatform import db
+from feedplatform import test as feedev
+from feedplatform.conf import config
+
+
+class record_updates(addins.base):
+    """Processes don't share memory, so updates are recorded in a
+    file instead.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+    def on_after_parse(self, feed, data_dict):
+        f = open(self.filename, 'a')
+        try:
+            f.write('%d %d\n' % (feed.id, os.getpid()))
+        finally:
+            f.close()
+    def get_updates(self):
+        return [map(int, line.split()) for line in open(self.filename)]
+
+
+class crashing_daemon(provide_loop_daemon):
+    """Fails the first time it runs in any process."""
+    def __init__(self, marker, *args, **kwargs):
+        super(crashing_daemon, self).__init__(*args, **kwargs)
+        self.marker = marker
+    def run(self):
+        # only one process may succeed in creating the marker
+        try:
+            os.close(os.open(self.marker, os.O_CREAT | os.O_EXCL))
+        except OSError:
+            pass
+        else:
+            raise RuntimeError('crash')
+        super(crashing_daemon, self).run()
+
+
+class fd_checking_daemon(provide_loop_daemon):
+    """Records whether the file descriptor ``fd`` still refers to the
+    same file (the number may have been reused)."""
+    def __init__(self, fd, filename, *args, **kwargs):
+        super(fd_checking_daemon, self).__init__(*args, **kwargs)
+        self.fd, self.filename = fd, filename
+        self.inode = os.fstat(fd).st_ino
+    def run(self):
+        try:
+            is_open = int(os.fstat(self.fd).st_ino == self.inode)
+        except OSError:
+            is_open = 0
+        f = open(self.filename, 'a')
+        try:
+            f.write('%d\n' % is_open)
+        finally:
+            f.close()
+
+
+class waiting_daemon(provide_loop_daemon):
+    """Runs until asked to stop."""
+    def run(self):
+        super(waiting_daemon, self).run()
+        while not self.stop_requested:
+            time.sleep(0.01)
+
+
+def _test_supervisor(func):
+    tempdir = tempfile.mkdtemp()
+    filename = os.path.join(tempdir, 'test.db')
+    recorder = record_updates(os.path.join(tempdir, 'updates'))
+
+    class Feed1(feedev.Feed):
+        def pass1(feed):
+            open(recorder.filename, 'w').close()
+            db.store.commit()
+            func(recorder, tempdir)
+
+    feeds = [Feed1] + [type('Feed%d' % i, (feedev.Feed,), {})
+                       for i in range(2, 7)]
+
+    if not config.configured:
+        config.configure()
+    old_database = config.DATABASE
+    config.DATABASE = 'sqlite:%s' % filename
+    try:
+        feedev.testcustom(feeds, addins=[recorder])
+    finally:
+        config.DATABASE = old_database
+        db.reconfigure()
+        for name in os.listdir(tempdir):
+            os.unlink(os.path.join(tempdir, name))
+        os.rmdir(tempdir)
+
+
+def test_processes():
+    """Each process works on its own share of the feeds."""
+
+    def test(recorder, tempdir):
+        supervisor = ProcessSupervisor(provide_loop_daemon(once=True), 2)
+        supervisor.run()
+        updates = recorder.get_updates()
+        assert sorted([id for id, pid in updates]) == range(1, 7)
+        assert len(set([pid for id, pid in updates])) == 2
+        assert not supervisor.children
+        assert supervisor.get_stats()['feeds_updated'] == 6
+        assert supervisor.get_stats()['process_restarts'] == 0
+        # the parent's connection still works
+        assert db.store.find(db.models.Feed).count() == 6
+    _test_supervisor(test)
+
+
+def test_restart():
+    """Processes that crash are restarted."""
+
+    def test(recorder, tempdir):
+        daemon = crashing_daemon(os.path.join(tempdir, 'crashed'), once=True)
+        supervisor = ProcessSupervisor(daemon, 2)
+        supervisor.restart_delay = 0
+        supervisor.run()
+        assert sorted([id for id, pid in recorder.get_updates()]) == \
+            range(1, 7)
+        assert supervisor.get_stats()['process_restarts'] == 1
+    _test_supervisor(test)
+
+
+def test_servers():
+    """Processes don't inherit the sockets of the given servers."""
+
+    def test(recorder, tempdir):
+        server = metrics.MetricsServer(('localhost', 0), lambda: '')
+        server.start()
+        server.ready.wait()
+        try:
+            filename = os.path.join(tempdir, 'fds')
+            daemon = fd_checking_daemon(server.server.socket.fileno(),
+                                        filename, once=True)
+            ProcessSupervisor(daemon, 2, servers=[server]).run()
+            assert open(filename).read() == '0\n0\n'
+            # still works here
+            assert metrics.fetch(server.server.server_address) == ''
+        finally:
+            server.stop()
+            server.join()
+    _test_supervisor(test)
+
+
+def test_stop():
+    """Stopping the supervisor stops all processes."""
+
+    def test(recorder, tempdir):
+        supervisor = ProcessSupervisor(waiting_daemon(once=True), 2)
+        def stop():
+            while len(recorder.get_updates()) < 6:
+                time.sleep(0.01)
+            supervisor.stop()
+        threading.Thread(target=stop).start()
+        supervisor.run()
+        assert not supervisor.children
+        assert supervisor.get_stats()['process_restarts'] == 0
+    _test_supervisor(test)
@@ -0,0 +1,116 @@
+import datetime
+from feedplatform import test as feedev
+from feedplatform.test.mock import MockDateTime
+from feedplatform.lib import backoff_failures
+
+
+def _run(feeds, addin):
+    MockDateTime.install()
+    try:
+        feedev.testcustom(feeds, addins=[addin])
+    finally:
+        MockDateTime.delta = None
+        MockDateTime.uninstall()
+
+
+def test_backoff():
+    class FailingFeed(feedev.Feed):
+        content = '<rss><channel><title>test</title></channel></rss>'
+
+        def status(p):
+            return {1: 500, 2: 500, 3: 503, 4: 503}.get(p, 200)
+
+        def headers(p):
+            if p == 3:
+                return {'Retry-After': '3600'}
+            return {}
+
+        def pass1(feed):
+            assert feed.failures == 1
+            assert feed.failure_class == u'http_500'
+            assert not feed.parked
+
+        def pass2(feed):
+            # we are not trying again just yet
+            assert feed.failures == 1
+            datetime.datetime.modify(seconds=61)
+
+        def pass3(feed):
+            # the server's Retry-After exceeds our own delay of 120s
+            assert feed.failures == 2
+            assert feed.failure_class == u'http_503'
+            assert feed.next_attempt - feed.failing_since > \
+                datetime.timedelta(seconds=3600)
+            datetime.datetime.modify(seconds=1000)
+
+        def pass4(feed):
+            assert feed.failures == 2
+            datetime.datetime.modify(seconds=7200)
+
+        def pass5(feed):
+            # the feed has recovered
+            assert feed.failures == 0
+            assert feed.failing_since is None
+            assert feed.next_attempt is None
+
+    _run([FailingFeed], backoff_failures(delay=60))
+
+
+def test_park():
+    class GoneFeed(feedev.Feed):
+        status = 410
+
+        def pass1(feed):
+            assert feed.parked
+            assert feed.failure_class == u'http_410'
+
+        def pass2(feed):
+            # parked feeds are no longer requested
+            assert feed.failures == 1
+
+    class DeadFeed(feedev.Feed):
+        status = 404
+
+        def pass1(feed):
+            assert not feed.parked
+            datetime.datetime.modify(hours=2)
+
+        def pass2(feed):
+            assert feed.failures == 2
+            assert feed.parked
+
+    _run([GoneFeed, DeadFeed], backoff_failures(delay=1, park_after=3600))
+
+
+def test_errors():
+    """Network errors count as failures, syntax errors don't."""
+    import socket, urllib2
+    from feedplatform.deps.feedparser import NonXMLContentType
+    addin = backoff_failures()
+    assert addin._get_error(
+        {'bozo_exception': urllib2.URLError(socket.timeout())}) == u'timeout'
+    assert addin._get_error({'bozo_exception': socket.error()}) == u'error'
+    assert addin._get_error({'status': 200, 'bozo_exception':
+        NonXMLContentType()}) is None
+    assert addin._get_error({'status': 304}) is None
+
+
+def test_many_failures():
+    """The delay doesn't overflow after many failures."""
+    class DeadFeed(feedev.Feed):
+        status = 500
+
+        def pass1(feed):
+            feed.failures = 5000
+            datetime.datetime.modify(seconds=61)
+
+        def pass2(feed):
+            assert feed.failures == 5001
+            assert feed.next_attempt - datetime.datetime.utcnow() <= \
+                datetime.timedelta(days=1)
+            datetime.datetime.modify(days=1, seconds=120)
+
+        def pass3(feed):
+            assert feed.failures == 5002
+
+    _run([DeadFeed], backoff_failures(delay=60, park_after=None))
@@ -0,0 +1,39 @@
+from feedplatform import test as feedev
+from feedplatform import net
+from feedplatform.lib import remember_redirects
+
+
+def test_remember():
+    class TargetFeed(feedev.File):
+        content = '<rss><channel><title>target</title></channel></rss>'
+
+        def status(p):
+            return p == 4 and 404 or 200
+
+    class RedirectedFeed(feedev.Feed):
+        content = '<rss><channel><title>old</title></channel></rss>'
+
+        def pass1(feed):
+            # the test framework serves the feed directly, so we need
+            # to tell the cache about the redirect ourselves
+            assert feed.redirect_url is None
+            net.get_redirect_cache().add(str(feed.url), str(TargetFeed.url), 302)
+
+        def pass2(feed):
+            assert feed.redirect_url == TargetFeed.url
+            assert feed.redirect_status == 302
+            assert feed.redirect_expires
+            # simulate a restart
+            net.reset()
+
+        def pass3(feed):
+            # the redirect was restored from the database
+            assert net.get_stats()['redirect_hops_saved'] == 1
+
+        def pass4(feed):
+            # the target failed, so the redirect is forgotten
+            assert feed.redirect_url is None
+
+    net.reset()
+    feedev.testcustom([TargetFeed, RedirectedFeed],
+                      addins=[remember_redirects()])
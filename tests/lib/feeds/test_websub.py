@@ -0,0 +1,126 @@
+import hmac
+import time
+import Queue
+import urllib
+import urllib2
+import hashlib
+import datetime
+
+from feedplatform import addins, db, parse
+from feedplatform.conf import config
+from feedplatform.lib import websub_subscribe, provide_websub_daemon
+
+
+FEED = '''<feed xmlns="http://www.w3.org/2005/Atom">
+    <title>%s</title>
+    <link rel="hub" href="http://hub.example.org/" />
+    <link rel="self" href="http://example.org/feed" />
+</feed>'''
+
+
+class subscriber(websub_subscribe):
+    def __init__(self, *args, **kwargs):
+        super(subscriber, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def _post(self, url, params):
+        self.requests.append((url, params))
+        return True
+
+
+def test_websub():
+    titles = []
+    class recorder(addins.base):
+        def on_after_parse(self, feed, data_dict):
+            titles.append(data_dict.feed.title)
+
+    sub = subscriber('http://localhost/callback/', secret='foo')
+    queue = Queue.Queue(1)
+    daemon = provide_websub_daemon(queue, ('localhost', 0), timeout=0.01)
+
+    old_settings = config.STORAGE_BACKEND, config.ADDINS
+    config.STORAGE_BACKEND, config.ADDINS = db.MemoryBackend, [sub, recorder()]
+    addins.reinstall()
+    db.reconfigure()
+    try:
+        feed = db.models.Feed()
+        feed.url = u'http://example.org/feed'
+        db.backend.add(feed)
+        db.backend.commit()
+
+        # the first update finds the hub and subscribes
+        sub.push(feed.id, FEED % 'first', 'application/atom+xml')
+        parse.update_feed(feed)
+        assert feed.websub_hub == u'http://hub.example.org/'
+        assert feed.websub_topic == u'http://example.org/feed'
+        assert feed.websub_requested
+        url, params = sub.requests.pop()
+        assert url == 'http://hub.example.org/'
+        assert params['hub.mode'] == 'subscribe'
+        assert params['hub.callback'] == \
+            'http://localhost/callback/%d' % feed.id
+        # while the hub hasn't answered, we don't ask again
+        sub.push(feed.id, FEED % 'first', 'application/atom+xml')
+        parse.update_feed(feed)
+        assert not sub.requests
+        db.backend.commit()
+
+        daemon.start(daemon=True)
+        while not daemon.server:
+            time.sleep(0.01)
+        callback = 'http://%s:%d/%d' % (
+            daemon.server.server_address + (feed.id,))
+
+        # the hub verifies our intent
+        response = urllib2.urlopen(callback + '?' + urllib.urlencode({
+            'hub.mode': 'subscribe', 'hub.topic': 'http://example.org/feed',
+            'hub.challenge': 'abc', 'hub.lease_seconds': '864000'}))
+        assert response.read() == 'abc'
+        try:
+            urllib2.urlopen(callback + '?' + urllib.urlencode({
+                'hub.mode': 'subscribe', 'hub.topic': 'http://other/',
+                'hub.challenge': 'abc'}))
+        except urllib2.HTTPError, e:
+            assert e.code == 404
+        else:
+            assert False, 'topic does not match'
+        db.backend.rollback()
+        assert sub.is_subscribed(feed)
+        assert not feed.websub_requested
+
+        # subscribed feeds are no longer polled
+        parse.update_feed(feed)
+        assert titles == ['first', 'first']
+
+        # content is pushed, but only accepted if signed correctly
+        def push(content, secret=sub.get_secret(feed), method='sha1'):
+            request = urllib2.Request(callback, content, {
+                'Content-Type': 'application/atom+xml',
+                'X-Hub-Signature': '%s=%s' % (method, hmac.new(
+                    secret, content, getattr(hashlib, method)).hexdigest())})
+            return urllib2.urlopen(request).code
+        assert push(FEED % 'forged', 'bar') == 202
+        assert push(FEED % 'forged', method='md5') == 202
+        assert queue.empty()
+        # if it can't be queued, the hub has to try again later
+        queue.put(None)
+        try:
+            push(FEED % 'stale')
+        except urllib2.HTTPError, e:
+            assert e.code == 503
+        else:
+            assert False, 'queue is full'
+        assert feed.id not in sub._pushed
+        assert queue.get_nowait() is None
+        assert push(FEED % 'pushed', method='sha256') == 202
+        assert queue.get(timeout=1) == feed.id
+
+        # the pushed content is used without fetching the feed
+        parse.update_feed(feed)
+        assert titles[-1] == 'pushed'
+        assert not sub.requests
+    finally:
+        daemon.stop()
+        config.STORAGE_BACKEND, config.ADDINS = old_settings
+        addins.reinstall()
+        db.reconfigure()
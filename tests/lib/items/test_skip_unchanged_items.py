@@ -0,0 +1,95 @@
+from storm.locals import Unicode
+from feedplatform import test as feedev
+from feedplatform import addins
+from feedplatform import parse
+from feedplatform.lib import skip_unchanged_items, collect_item_data
+
+
+class counter(addins.base):
+    """Counts found items; declares its interest in the title."""
+    found = 0
+    def get_entry_fields(self):
+        return ('title',)
+    def on_found_item(self, feed, item, entry_dict):
+        self.__class__.found += 1
+
+
+class undeclared_counter(addins.base):
+    """Counts found items, but doesn't say what it uses."""
+    found = 0
+    def on_found_item(self, feed, item, entry_dict):
+        self.__class__.found += 1
+
+
+def test_declared_fields():
+    ADDINS = [skip_unchanged_items, collect_item_data('title'), counter]
+    counter.found = 0
+
+    class TestFeed(feedev.Feed):
+        content = """
+        <rss><channel>
+            <item>
+                <guid>item-1</guid>
+                <title>{% <3 %}org title{% end %}{% >=3 %}new title{% end %}</title>
+                <link>{% <4 %}http://org{% end %}{% >=4 %}http://new{% end %}</link>
+            </item>
+            <item><guid>item-2</guid><title>other</title></item>
+        </channel></rss>
+        """
+
+        def pass1(feed):
+            # fingerprints are stored for new items
+            assert feed.items.count() == 2
+            for item in feed.items:
+                assert item.fingerprint
+            assert counter.found == 0
+
+        def pass2(feed):
+            # nothing changed, no item is processed
+            assert counter.found == 0
+
+        def pass3(feed):
+            # the first item changed
+            assert counter.found == 1
+            assert feed.items.find(guid=u'http://feeds/item-1').one().title == 'new title'
+
+        def pass4(feed):
+            # the link changed, but nobody uses the link
+            assert counter.found == 1
+
+        def pass5(feed):
+            # a full update processes all items regardless
+            parse.update_feed(feed, {'full': True})
+            assert counter.found == 3
+
+    feedev.testcaller()
+
+
+def test_undeclared_fields():
+    ADDINS = [skip_unchanged_items, undeclared_counter]
+    undeclared_counter.found = 0
+
+    class TestFeed(feedev.Feed):
+        content = """
+        <rss><channel>
+            <item>
+                <guid>item-1</guid>
+                <link>{% <3 %}http://org{% end %}{% >=3 %}http://new{% end %}</link>
+            </item>
+        </channel></rss>
+        """
+
+        def pass2(feed):
+            assert undeclared_counter.found == 0
+
+        def pass3(feed):
+            # Since the addin did not declare what it needs, any
+            # change causes the item to be reprocessed.
+            assert undeclared_counter.found == 1
+
+    feedev.testcaller()
+
+
+def test_custom_field():
+    addin = skip_unchanged_items(field='entry_hash')
+    assert 'entry_hash' in addin.get_fields()['item']
@@ -0,0 +1,66 @@
+"""Test how ``update_feed`` reports its progress, and where the time
+goes.
+"""
+
+import time
+import logging
+from feedplatform import test as feedev
+from feedplatform import addins
+from feedplatform import parse
+from feedplatform import log
+from feedplatform.conf import config
+
+
+class slow_after_parse(addins.base):
+    def on_after_parse(self, feed, data_dict):
+        time.sleep(0.05)
+
+
+class record_log(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_timings():
+    """The time spent in each stage is recorded, and updates that
+    take too long are logged."""
+
+    class TestFeed(feedev.Feed):
+        content = """<rss><channel>
+            <item><guid>http://example.org/1</guid></item>
+            <item><guid>http://example.org/2</guid></item>
+        </channel></rss>"""
+
+        def pass1(feed):
+            handler = record_log()
+            log.log.addHandler(handler)
+            old_threshold = config.SLOW_FEED_THRESHOLD
+            config.SLOW_FEED_THRESHOLD = 0.05
+            try:
+                progress = parse.UpdateProgress(feed)
+                parse.update_feed(feed, progress=progress)
+            finally:
+                config.SLOW_FEED_THRESHOLD = old_threshold
+                log.log.removeHandler(handler)
+
+            assert progress.stage is None
+            assert progress.finished is not None
+            assert progress.status == 200
+            assert set(progress.timings) == set([
+                'before_parse', 'wait_host', 'network', 'parse',
+                'after_parse', 'resolve', 'item_hooks', 'flush', 'commit'])
+            assert progress.timings['after_parse'] >= 0.05
+            assert abs(sum(progress.timings.values()) -
+                       progress.elapsed) < 0.001
+
+            slow = [m for m in handler.messages if 'is slow' in m]
+            assert len(slow) == 1
+            assert slow[0].startswith('Feed #%d is slow: ' % feed.id)
+            assert ' after_parse=' in slow[0]
+            assert slow[0].endswith(
+                ', status 200, 0 new item(s), %s' % feed.url)
+
+    feedev.testcustom([TestFeed], addins=[slow_after_parse])
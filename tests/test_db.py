@@ -0,0 +1,202 @@
+"""Test the storage backends.
+"""
+
+from feedplatform import db
+from feedplatform import parse
+from feedplatform import addins
+from feedplatform import test as feedev
+from feedplatform.conf import config
+
+
+FEED_CONTENT = u"""
+<rss><channel>
+    <item><guid>http://example.org/1</guid></item>
+    <item><guid>http://example.org/2</guid></item>
+</channel></rss>
+"""
+
+
+def setup_module(module):
+    if not config.configured:
+        config.configure()
+    module.old_settings = config.STORAGE_BACKEND, config.ADDINS
+
+def teardown_module(module):
+    config.STORAGE_BACKEND, config.ADDINS = module.old_settings
+    addins.reinstall()
+    db.reconfigure()
+
+
+def test_memory_backend():
+    config.STORAGE_BACKEND = db.MemoryBackend
+    config.ADDINS = []
+    addins.reinstall()
+    db.reconfigure()
+
+    # feeds are indexed and assigned a primary key on flush
+    feed = db.models.Feed()
+    feed.url = FEED_CONTENT
+    db.backend.add(feed)
+    assert db.backend.get_feed(1) is None
+    assert isinstance(db.backend.obj, db.MemoryBackend)
+    db.backend.flush()
+    assert feed.id == 1
+    assert db.backend.get_feed(1) is feed
+    assert db.backend.find_feeds(FEED_CONTENT) == [feed]
+    assert db.backend.find_feed_ids([1, 2]) == set([1])
+    assert list(db.backend.iter_feeds()) == [feed]
+
+    # Without a database, we can use the feed content as the url,
+    # which will be passed through to the parser.
+    parse.update_feed(feed)
+    items = db.backend.get_items(feed, [u'http://example.org/1',
+                                        u'http://example.org/2',
+                                        u'http://example.org/3'])
+    assert len(items) == 2
+    assert items[u'http://example.org/1'][0].feed is feed
+
+    # a second update doesn't create duplicates
+    parse.update_feed(feed)
+    assert len(db.backend.get_items(feed, [u'http://example.org/1'])
+                    [u'http://example.org/1']) == 1
+
+    # items can be removed
+    db.backend.remove(items[u'http://example.org/2'][0])
+    assert len(db.backend.get_items(feed, [u'http://example.org/2'])) == 0
+
+
+def test_storm_backend():
+    class TestFeed(feedev.Feed):
+        content = FEED_CONTENT
+
+        def pass1(feed):
+            assert isinstance(db.backend.obj, db.StormBackend)
+            # guids are resolved in bulk
+            items = db.backend.get_items(feed, [u'http://example.org/1',
+                                                u'http://example.org/2',
+                                                u'http://example.org/3'])
+            assert sorted(items.keys()) == [u'http://example.org/1',
+                                            u'http://example.org/2']
+            assert db.backend.find_feeds(feed.url) == [feed]
+            assert db.backend.get_feed(feed.id) is feed
+            assert list(db.backend.iter_feeds()) == [feed]
+            # ids are checked in chunks
+            backend = db.backend.obj
+            backend.max_query_params = 2
+            try:
+                assert db.backend.find_feed_ids([feed.id + 1, feed.id, 0]) \
+                    == set([feed.id])
+            finally:
+                del backend.max_query_params
+
+            # compiled statements are reused, also for a different
+            # number of guids, as long as it rounds to the same size
+            statements = dict(db.backend._statements)
+            items = db.backend.get_items(feed, [u'http://example.org/2',
+                                                u'http://example.org/4'])
+            assert items.keys() == [u'http://example.org/2']
+            items = db.backend.get_items(feed, [u'http://example.org/1'] * 4)
+            assert len(items[u'http://example.org/1']) == 1
+            assert db.backend._statements == statements
+
+            # should Storm's internals change, a regular find is used
+            backend = db.backend.obj
+            assert backend._can_compile()
+            backend._can_compile = lambda: False
+            backend._compiled_find = None
+            try:
+                items = db.backend.get_items(feed, [u'http://example.org/1'])
+                assert len(items[u'http://example.org/1']) == 1
+                assert backend._compiled_find is False
+            finally:
+                del backend._can_compile
+                backend._compiled_find = None
+
+            # objects that were loaded can be released
+            assert db.backend.get_stats()['store_cache_size'] > 0
+            db.backend.release()
+            assert db.backend.get_stats()['store_cache_size'] == 0
+            assert db.backend.get_feed(feed.id) is feed
+
+    config.STORAGE_BACKEND = None
+    feedev.testcustom([TestFeed])
+
+
+def test_model_cache():
+    """Models are reused if rebuilt from the same blueprints."""
+    from storm.locals import Unicode
+
+    class custom_field(addins.base):
+        def get_fields(self):
+            return {'feed': {'custom': (Unicode, (), {})}}
+
+    config.STORAGE_BACKEND = None
+    config.ADDINS = [custom_field()]
+    addins.reinstall()
+    db.reconfigure()
+    Feed = db.models.Feed
+
+    # a new, but equivalent addin instance
+    config.ADDINS = [custom_field()]
+    addins.reinstall()
+    db.reconfigure()
+    assert db.models.Feed is Feed
+    # references still work with the reused models
+    assert db.models.Item.feed_id is not None
+
+    # a change causes the models to be rebuilt
+    config.ADDINS = []
+    addins.reinstall()
+    db.reconfigure()
+    assert db.models.Feed is not Feed
+    assert not hasattr(db.models.Feed, 'custom')
+
+
+def test_claim_feeds():
+    """Feeds are claimed by id, and read back by a token unique to
+    the claim, not by the lease's expiry time."""
+    import datetime
+    from storm.tracer import install_tracer, remove_tracer
+    from feedplatform.lib import provide_lease_daemon
+
+    class record_statements(object):
+        def __init__(self):
+            self.statements = []
+        def connection_raw_execute(self, connection, raw_cursor,
+                                   statement, params):
+            self.statements.append(statement)
+
+    class Feed1(feedev.Feed):
+        def pass1(feed):
+            now = datetime.datetime.utcnow()
+            until = now + datetime.timedelta(seconds=60)
+            # already held by us, with the same expiry time
+            held = db.get_one(db.backend.find_feeds(Feed2.url))
+            held.claimed_by, held.lease_expires = u'a', until
+            db.backend.commit()
+
+            tracer = record_statements()
+            install_tracer(tracer)
+            try:
+                feeds = db.backend.claim_feeds(u'a', 5, now, until)
+            finally:
+                remove_tracer(tracer)
+            assert sorted([f.url for f in feeds]) == [Feed1.url, Feed3.url]
+            assert [f.claimed_by for f in feeds] == [u'a', u'a']
+            # no subqueries in UPDATE statements, which MySQL rejects
+            for statement in tracer.statements:
+                if statement.startswith('UPDATE'):
+                    assert not 'SELECT' in statement
+            db.backend.commit()
+            assert db.backend.claim_feeds(u'b', 5, now, until) == []
+            db.backend.rollback()
+
+    class Feed2(feedev.Feed):
+        pass
+
+    class Feed3(feedev.Feed):
+        pass
+
+    config.STORAGE_BACKEND = None
+    feedev.testcustom([Feed1, Feed2, Feed3],
+                      addins=[provide_lease_daemon(once=True)])
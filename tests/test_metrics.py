@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+from nose.tools import assert_raises
+
+from feedplatform import metrics
+from feedplatform import test as feedev
+
+
+def test_metrics():
+    registry = metrics.Registry()
+    requests = registry.add(metrics.Counter('requests_total', 'Requests',
+                                            labels=('host',)))
+    # adding the same metric again returns the existing one
+    assert registry.add(metrics.Counter('requests_total', '')) is requests
+    requests.inc(host='a')
+    requests.inc(2, host='b "quoted"')
+    assert_raises(ValueError, requests.inc)
+    latency = registry.add(metrics.Histogram('latency', 'Latency',
+                                             buckets=(1, 2, 4)))
+    for value in (0.5, 1.5, 1.5, 3, 10):
+        latency.observe(value)
+
+    text = metrics.render(registry.snapshot(), {'queue_depth': 3,
+                                                'name': 'ignored'})
+    samples = metrics.parse_text(text)
+    assert ('requests_total', {'host': 'b "quoted"'}, 2) in samples
+    assert ('latency_bucket', {'le': '2.0'}, 3) in samples
+    assert ('latency_bucket', {'le': '+Inf'}, 5) in samples
+    assert ('latency_sum', {}, 16.5) in samples
+    assert ('feedplatform_queue_depth', {}, 3) in samples
+    assert not 'ignored' in text
+
+    buckets = [(1, 1), (2, 3), (4, 4), (float('inf'), 5)]
+    assert metrics.quantile(0.5, buckets) == 1.75
+    assert metrics.quantile(0.99, buckets) == 4
+    assert metrics.quantile(0.5, []) is None
+
+    # the values of several processes can be added up
+    merged = metrics.merge([registry.snapshot(), registry.snapshot()])
+    samples = metrics.parse_text(metrics.render(merged))
+    assert ('requests_total', {'host': 'a'}, 2) in samples
+    assert ('latency_count', {}, 10) in samples
+
+
+def test_server():
+    tempdir = tempfile.mkdtemp()
+    try:
+        for address in (os.path.join(tempdir, 'stats'), ('localhost', 0)):
+            server = metrics.MetricsServer(address, lambda: 'foo 1\n')
+            server.start()
+            server.ready.wait()
+            if not isinstance(address, basestring):
+                address = server.server.server_address
+            try:
+                assert metrics.fetch(address) == 'foo 1\n'
+            finally:
+                server.stop()
+                server.join()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_update_metrics():
+    """Updating a feed is recorded in the metrics."""
+
+    def value(metric, **labels):
+        return metric.get(**labels)
+    counts = {}
+
+    class TestFeed(feedev.Feed):
+        content = """<rss><channel>
+            <item><guid>http://example.org/1</guid></item>
+            {% =2 %}<item><guid>http://example.org/2</guid></item>{% end %}
+        </channel></rss>"""
+
+        def pass1(feed):
+            counts['items'] = value(metrics.items_created)
+            counts['updates'] = value(metrics.updates, status=200)
+            counts['bytes'] = value(metrics.downloaded_bytes)
+            counts['stages'] = metrics.stage_seconds.snapshot()
+
+        def pass2(feed):
+            assert value(metrics.items_created) == counts['items'] + 1
+            assert value(metrics.updates, status=200) == \
+                counts['updates'] + 1
+            assert value(metrics.downloaded_bytes) > counts['bytes']
+            before = dict([(labels[0], sum(v[:-1])) for labels, v in
+                           counts['stages']['samples']])
+            for labels, v in metrics.stage_seconds.snapshot()['samples']:
+                assert sum(v[:-1]) == before[labels[0]] + 1
+
+    feedev.testcustom([TestFeed])
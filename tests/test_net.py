@@ -0,0 +1,353 @@
+"""Test the network layer, using a local HTTP server.
+"""
+
+import time
+import socket
+import threading
+import BaseHTTPServer
+from nose.tools import assert_raises
+
+from feedplatform import net
+from feedplatform import util
+from feedplatform.deps import feedparser
+from feedplatform.conf import config
+
+
+FEED = '<rss><channel><title>test</title></channel></rss>'
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.path in self.server.redirects:
+            status, location = self.server.redirects[self.path]
+            self.send_response(status)
+            if location:
+                self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(FEED)))
+        self.end_headers()
+        self.wfile.write(FEED)
+        # drop the connection without telling the client
+        if self.server.drop_connections:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(BaseHTTPServer.HTTPServer):
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           RequestHandler)
+        self.requests = self.connections = 0
+        self.drop_connections = False
+        self.redirects = {}
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        # handle each connection in a thread, so that the client may
+        # keep it open while opening another one
+        thread = threading.Thread(target=self.finish_connection,
+                                  args=(request, client_address))
+        thread.setDaemon(True)
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # clients closing connections early is expected
+        pass
+
+    def finish_connection(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def setup_module(module):
+    if not config.configured:
+        config.configure()
+    module.server = Server()
+    module.url = u'http://127.0.0.1:%d/feed' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.setDaemon(True)
+    thread.start()
+
+def teardown_module(module):
+    # closing our connections lets the server threads finish
+    net.reset()
+    server.shutdown()
+    server.server_close()
+
+
+def setup():
+    net.reset()
+    server.requests = server.connections = 0
+    server.drop_connections = False
+    server.redirects = {}
+
+
+def test_reuse():
+    for i in range(3):
+        assert util.urlopen(url).read() == FEED
+    # the feed parser uses the same pool
+    for i in range(2):
+        result = feedparser.parse(url, handlers=net.get_handlers())
+        assert result.feed.title == 'test'
+    assert server.requests == 5
+    assert server.connections == 1
+    stats = net.get_stats()
+    assert stats['connections_opened'] == 1
+    assert stats['connections_reused'] == 4
+test_reuse.setup = setup
+
+
+def test_unread_response():
+    """A connection is only reused once the response was read."""
+    response = util.urlopen(url)
+    assert util.urlopen(url).read() == FEED
+    assert server.connections == 2
+    response.close()
+    util.urlopen(url).read()
+    assert server.connections == 2
+test_unread_response.setup = setup
+
+
+def test_limited_download():
+    """The host limit covers downloading the response."""
+    limiter = net.get_limiter()
+    host = net.get_host(url)
+    responses = [util.urlopen(url) for i in range(config.HOST_MAX_CONCURRENT)]
+    assert limiter.wait_time(host) is None
+    # reading it completely is enough
+    assert responses[0].read() == FEED
+    assert limiter.wait_time(host) == 0
+    responses[1].close()
+    assert limiter._active.get(host) is None
+test_limited_download.setup = setup
+
+
+def test_stale_connection():
+    """Connections closed by the server are replaced transparently."""
+    server.drop_connections = True
+    for i in range(3):
+        assert util.urlopen(url).read() == FEED
+    assert server.requests == 3
+    assert server.connections == 3
+test_stale_connection.setup = setup
+
+
+def test_idle_timeout():
+    pool = net.ConnectionPool(max_idle_per_host=1, idle_timeout=0)
+    opener = util.urllib2.build_opener(net.KeepAliveHTTPHandler(pool))
+    for i in range(2):
+        opener.open(url).read()
+    assert server.connections == 2
+    assert pool.stats['connections_reused'] == 0
+    pool.clear()
+test_idle_timeout.setup = setup
+
+
+def test_disabled():
+    config.HTTP_KEEPALIVE = False
+    try:
+        for i in range(2):
+            util.urlopen(url).read()
+        assert server.connections == 2
+
+        # without the caches, we don't need any handlers at all
+        config.DNS_CACHE_TTL = config.REDIRECT_CACHE_TTL = None
+        assert net.get_handlers() == []
+        util.urlopen(url).read()
+        assert server.connections == 3
+    finally:
+        config.HTTP_KEEPALIVE = True
+        config.DNS_CACHE_TTL = 300
+        config.REDIRECT_CACHE_TTL = 3600
+test_disabled.setup = setup
+
+
+def test_limiter():
+    limiter = net.HostLimiter(2, 0, {'example.org': (1, 10)})
+    assert limiter.get_limits('feeds.example.org') == (1, 10)
+    assert limiter.get_limits('example.com') == (2, 0)
+
+    # concurrency
+    limiter.acquire('example.com')
+    assert limiter.wait_time('example.com') == 0
+    limiter.acquire('example.com')
+    assert limiter.wait_time('example.com') is None
+    limiter.release('example.com')
+    assert limiter.wait_time('example.com') == 0
+
+    # rate
+    limiter.acquire('example.org')
+    limiter.release('example.org')
+    assert 9 < limiter.wait_time('example.org') <= 10
+
+    # None means no limit
+    limiter = net.HostLimiter(None, 0)
+    for i in range(10):
+        limiter.acquire('example.com')
+    assert limiter.wait_time('example.com') == 0
+
+    # urls without a host are never limited
+    assert net.get_host(u'<rss></rss>') is None
+    limiter.acquire(None)
+    limiter.release(None)
+
+
+def test_dispatcher():
+    limiter = net.HostLimiter(1, 0, {'slow.org': (1, 10)})
+    dispatcher = net.HostDispatcher(limiter)
+    for i in range(3):
+        dispatcher.put('http://a.org/%d' % i, 'a%d' % i)
+    dispatcher.put('http://b.org/', 'b')
+
+    # hosts are interleaved, and held back while at their limit
+    assert dispatcher.get(timeout=0) == ('a.org', 'a0')
+    assert dispatcher.get(timeout=0) == ('b.org', 'b')
+    assert dispatcher.get(timeout=0) is None
+    dispatcher.task_done('a.org')
+    assert dispatcher.get(timeout=0) == ('a.org', 'a1')
+    dispatcher.task_done('a.org')
+    dispatcher.task_done('b.org')
+    assert dispatcher.join(timeout=0) is False
+    assert dispatcher.get(timeout=0) == ('a.org', 'a2')
+    dispatcher.task_done('a.org')
+    assert dispatcher.join(timeout=0) is True
+
+    # the request rate is respected as well
+    limiter.acquire('slow.org')
+    limiter.release('slow.org')
+    dispatcher.put('http://slow.org/', 'slow')
+    assert dispatcher.get(timeout=0.1) is None
+
+
+class StubResolver(object):
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.lookups = 0
+    def __call__(self, host, port, *args):
+        self.lookups += 1
+        if not host in self.hosts:
+            raise socket.gaierror(-2, 'Name or service not known')
+        return socket.getaddrinfo(self.hosts[host], port, *args)
+
+
+def test_dns_cache():
+    resolver = StubResolver({'feeds.test': '127.0.0.1'})
+    cache = net.DNSCache(ttl=60, negative_ttl=60, resolver=resolver)
+    cache.getaddrinfo('feeds.test', 80)
+    cache.getaddrinfo('feeds.test', 80)
+    assert resolver.lookups == 1
+
+    # failures are cached as well
+    assert_raises(socket.gaierror, cache.getaddrinfo, 'unknown.test', 80)
+    assert_raises(socket.gaierror, cache.getaddrinfo, 'unknown.test', 80)
+    assert resolver.lookups == 2
+    assert cache.stats == {'dns_hits': 2, 'dns_misses': 2}
+
+    # entries expire
+    cache.ttl = cache.negative_ttl = 0
+    cache.invalidate('feeds.test', 80)
+    cache.getaddrinfo('feeds.test', 80)
+    cache.getaddrinfo('feeds.test', 80)
+    assert resolver.lookups == 4
+
+
+def test_dns_cache_used():
+    """The handlers resolve host names through the cache."""
+    resolver = StubResolver({'feeds.test': '127.0.0.1'})
+    cache = net.DNSCache(resolver=resolver)
+    pool = net.ConnectionPool(max_idle_per_host=0)
+    opener = util.urllib2.build_opener(
+        net.KeepAliveHTTPHandler(pool, dns_cache=cache))
+    test_url = 'http://feeds.test:%d/feed' % server.server_address[1]
+    for i in range(3):
+        assert opener.open(test_url).read() == FEED
+    assert server.connections == 3
+    assert resolver.lookups == 1
+
+    # an address we can't connect to is dropped
+    for i in range(2):
+        assert_raises(util.urllib2.URLError,
+                      opener.open, 'http://feeds.test:1/')
+    assert resolver.lookups == 3
+test_dns_cache_used.setup = setup
+
+
+def test_redirect_cache():
+    cache = net.RedirectCache(ttl=60)
+    cache.add('http://a/', 'http://b/', 301)
+    cache.add('http://b/', 'http://c/', 302)
+    target, status, expires, hops = cache.lookup('http://a/')
+    assert (target, status, hops) == ('http://c/', 302, 2)
+    assert 59 < expires - time.time() <= 60
+    assert cache.resolve('http://x/') == ('http://x/', None)
+
+    # temporary redirects expire, permanent ones don't
+    cache.add('http://b/', 'http://c/', 307, expires=time.time() - 1)
+    assert cache.resolve('http://a/') == ('http://b/', 301)
+    assert cache.stats['redirect_hops_saved'] == 1
+
+    cache.forget('http://a/')
+    assert cache.resolve('http://a/') == ('http://a/', None)
+
+    # without a ttl, only permanent redirects are kept
+    cache = net.RedirectCache(ttl=0)
+    cache.add('http://a/', 'http://b/', 302)
+    assert cache.resolve('http://a/') == ('http://a/', None)
+
+
+def test_redirects_skipped():
+    server.redirects = {'/old': (301, '/temp'), '/temp': (302, '/feed')}
+    old_url = url.replace('/feed', '/old')
+    for i in range(2):
+        assert util.urlopen(old_url).read() == FEED
+    assert server.requests == 4
+    assert net.get_stats()['redirect_hops_saved'] == 2
+
+    # if the target fails, the redirects are followed again
+    server.redirects = {'/old': (301, '/moved'), '/feed': (404, None)}
+    assert_raises(util.UrlOpenError, util.urlopen, old_url)
+    assert util.urlopen(old_url).read() == FEED
+    assert server.requests == 7
+test_redirects_skipped.setup = setup
+
+
+def test_redirects_parse():
+    """For addins, skipped redirects look like they happened."""
+    from feedplatform import addins, db, parse
+
+    statuses = []
+    class recorder(addins.base):
+        def on_after_parse(self, feed, data_dict):
+            statuses.append((data_dict.status, data_dict.href))
+
+    old_settings = config.STORAGE_BACKEND, config.ADDINS
+    config.STORAGE_BACKEND, config.ADDINS = db.MemoryBackend, [recorder()]
+    addins.reinstall()
+    db.reconfigure()
+    try:
+        server.redirects = {'/old': (301, '/feed')}
+        feed = db.models.Feed()
+        feed.url = url.replace('/feed', '/old')
+        db.backend.add(feed)
+        db.backend.flush()
+        parse.update_feed(feed)
+        parse.update_feed(feed)
+        assert statuses == [(301, url), (301, url)]
+        assert server.requests == 3
+    finally:
+        config.STORAGE_BACKEND, config.ADDINS = old_settings
+        addins.reinstall()
+        db.reconfigure()
+test_redirects_parse.setup = setup
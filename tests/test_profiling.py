@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import pstats
+import shutil
+import tempfile
+import StringIO
+from nose.tools import assert_raises
+
+from feedplatform import profiling
+from feedplatform import management
+from feedplatform import addins
+from feedplatform import test as feedev
+
+
+class slow_addin(addins.base):
+    def on_after_parse(self, feed, data_dict):
+        time.sleep(0.01)
+
+
+def test_profiler():
+    """Profiles are limited to a number of calls, and can be taken
+    repeatedly."""
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, 'out.prof')
+        profiler = profiling.Profiler(filename, feeds=2)
+        for i in range(3):
+            assert profiler.runcall(lambda x: x * 2, i) == i * 2
+        assert profiler.written == [filename]
+        stats = pstats.Stats(filename)
+        assert stats.total_calls > 0
+        # nothing left to write
+        profiler.close()
+        assert profiler.written == [filename]
+
+        profiler = profiling.Profiler(filename, feeds=1, interval=0)
+        for i in range(2):
+            profiler.runcall(time.sleep, 0)
+        assert len(profiler.written) == 2
+        assert profiler.written[0].startswith(filename[:-5] + '-')
+        assert profiler.written[0].endswith('.prof')
+
+        # without a limit, everything until ``close`` is profiled
+        filename = os.path.join(tempdir, 'callgrind.out.test')
+        profiler = profiling.Profiler(filename)
+        profiler.runcall(time.sleep, 0)
+        assert not profiler.written
+        profiler.close()
+        assert profiler.written == [filename]
+        assert open(filename).read().startswith('version: 1\n')
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_update_cmd():
+    """The ``update`` command updates a single feed, and can profile
+    the update; the addin hooks are named after the addin."""
+
+    tempdir = tempfile.mkdtemp()
+    filename = os.path.join(tempdir, 'update.callgrind')
+
+    def call(*args, **options):
+        old_stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            management.call_command('update', *args, **options)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+
+    class TestFeed(feedev.Feed):
+        def pass1(feed):
+            output = call(str(feed.id), profile=filename)
+            assert output.startswith('Feed #%d: ' % feed.id)
+            assert ' after_parse=' in output
+            profile = open(filename).read()
+            assert 'fn=slow_addin.on_after_parse ' in profile
+            assert 'cfn=slow_addin.on_after_parse ' in profile
+
+            assert call(feed.url.encode('utf8')).startswith('Feed #%d: ' % feed.id)
+            assert_raises(management.CommandError,
+                          management.get_command('update').handle, '9999')
+
+    try:
+        feedev.testcustom([TestFeed], addins=[slow_addin])
+    finally:
+        shutil.rmtree(tempdir)
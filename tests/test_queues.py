@@ -0,0 +1,216 @@
+import os
+import time
+import Queue
+import shutil
+import tempfile
+import threading
+from nose.tools import assert_raises
+
+from feedplatform.queues import \
+    FeedQueue, PriorityFeedQueue, SQLiteFeedQueue
+from feedplatform.lib import provide_queue_daemon
+from feedplatform import addins
+from feedplatform import db
+from feedplatform.conf import config
+
+
+class FakeFeed(object):
+    def __init__(self, id):
+        self.id = id
+
+
+def test_feed_queue():
+    queue = FeedQueue(maxsize=2)
+    assert queue.add(FakeFeed(1))
+    assert not queue.add(1)
+    queue.put(1)
+    assert FakeFeed(1) in queue
+    assert queue.qsize() == 1
+
+    # even when full, duplicates are simply ignored
+    assert queue.add(2)
+    assert not queue.add(2, block=False)
+    assert_raises(Queue.Full, queue.add, 3, block=False)
+    assert_raises(Queue.Full, queue.add, 3, timeout=0.01)
+
+    # ids are returned, and can be added again afterwards
+    assert queue.get() == 1
+    assert not 1 in queue
+    assert queue.add(1)
+    assert [queue.get(), queue.get()] == [2, 1]
+
+
+def test_priority_queue():
+    queue = PriorityFeedQueue()
+    queue.add_many([1, 2, 3], priority='background')
+    queue.add(4)
+    queue.add(5, deadline=60)
+    queue.add(6, deadline=0)
+    queue.add(7, priority='interactive')
+    assert_raises(ValueError, queue.add, 8, priority='urgent')
+
+    # feeds can be moved up, but not down
+    assert queue.add(3, priority='interactive')
+    assert not queue.add(7, priority='background')
+    assert not queue.add(4)
+    assert queue.qsize() == 7
+    assert 3 in queue
+
+    stats = queue.get_stats()
+    assert stats['queue_depth_background'] == 2
+    assert stats['queue_depth_interactive'] == 2
+
+    # (a feed that was moved up keeps its place in line)
+    assert [queue.get() for i in range(7)] == [3, 7, 6, 5, 4, 1, 2]
+    stats = queue.get_stats()
+    assert stats['queue_depth'] == 0
+    assert stats['queue_deadlines_missed'] == 1
+    assert stats['queue_wait_max_background'] >= \
+        stats['queue_wait_avg_background'] >= 0
+
+
+def test_sqlite_queue():
+    tempdir = tempfile.mkdtemp()
+    filename = os.path.join(tempdir, 'queue.db')
+    try:
+        queue = SQLiteFeedQueue(filename, maxsize=2, visibility_timeout=0.1)
+        assert queue.add(FakeFeed(1))
+        assert not queue.add(1)
+        assert queue.add_many([1, 2, 2]) == 1
+        assert_raises(Queue.Full, queue.add, 3, timeout=0.01)
+        # duplicates are ignored even when full
+        assert not queue.add(2, block=False)
+        assert queue.full()
+
+        # feeds are not removed from the queue before they are done
+        assert queue.get() == 1
+        assert 1 in queue
+        assert queue.qsize() == 1
+        # if they are added again in the meantime, they are queued
+        # again afterwards
+        assert queue.add(1)
+        queue.ack(1)
+        assert queue.get_many(5) == [2, 1]
+        queue.ack(2)
+        assert not 2 in queue
+        assert_raises(Queue.Empty, queue.get_nowait)
+
+        # if we never get done, the feed is returned again
+        assert queue.get(timeout=2) == 1
+        queue.close()
+
+        # the queue survives a restart, including feeds in progress
+        queue = SQLiteFeedQueue(filename)
+        queue.add(3)
+        assert queue.get_many(5, block=False) == [1, 3]
+        queue.ack(1)
+        queue.ack(3)
+        assert queue.qsize() == 0
+        queue.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_sqlite_queue_shared():
+    """Another process may take the feeds we were waiting for."""
+    tempdir = tempfile.mkdtemp()
+    filename = os.path.join(tempdir, 'queue.db')
+    try:
+        queue = SQLiteFeedQueue(filename)
+        other = SQLiteFeedQueue(filename, release_leases=False)
+        take = queue._take
+        def take_after_other(count):
+            # the other queue gets there first
+            if other.qsize():
+                other.get()
+            return take(count)
+        queue._take = take_after_other
+
+        queue.add(1)
+        assert_raises(Queue.Empty, queue.get, timeout=0.1)
+        queue.add(2)
+        assert_raises(Queue.Empty, queue.get_nowait)
+        assert 1 in queue and 2 in queue
+        queue.close()
+        other.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_wakeup():
+    """Threads blocked in ``get`` can be made to give up."""
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        for queue in (FeedQueue(), PriorityFeedQueue(),
+                      SQLiteFeedQueue(os.path.join(tempdir, 'queue.db'))):
+            cancelled = threading.Event()
+            results = []
+            def get():
+                try:
+                    results.append(queue.get(cancel=cancelled.isSet))
+                except Queue.Empty:
+                    results.append(None)
+            threads = [threading.Thread(target=get) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            queue.add(1)
+            while not results:
+                time.sleep(0.01)
+            cancelled.set()
+            queue.wakeup()
+            for thread in threads:
+                thread.join(5)
+                assert not thread.isAlive()
+            assert results == [1, None]
+
+            # if it's cancelled already, we don't wait at all
+            assert_raises(Queue.Empty, queue.get, cancel=lambda: True)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_queue_daemon():
+    """The queue daemon looks up the queued feed ids, and lets the
+    queue know when it is done with them."""
+
+    updated = []
+    class record_updates(addins.base):
+        def on_before_parse(self, feed, parser_args):
+            updated.append(feed.id)
+            return True
+
+    old_settings = config.STORAGE_BACKEND, config.ADDINS
+    config.STORAGE_BACKEND, config.ADDINS = \
+        db.MemoryBackend, [record_updates()]
+    addins.reinstall()
+    db.reconfigure()
+    tempdir = tempfile.mkdtemp()
+    try:
+        feed = db.models.Feed()
+        feed.url = u'http://example.org/feed'
+        db.backend.add(feed)
+        db.backend.commit()
+
+        for queue in (FeedQueue(),
+                      SQLiteFeedQueue(os.path.join(tempdir, 'queue.db'))):
+            del updated[:]
+            daemon = provide_queue_daemon(queue)
+            queue.put(5)
+            queue.put(feed)
+            daemon.start(daemon=True)
+            try:
+                start = time.time()
+                while (not updated or 5 in queue or feed in queue) and \
+                      time.time() - start < 5:
+                    time.sleep(0.01)
+                assert updated == [feed.id]
+                assert not 5 in queue and not feed in queue
+            finally:
+                daemon.stop()
+                daemon.join()
+    finally:
+        shutil.rmtree(tempdir)
+        config.STORAGE_BACKEND, config.ADDINS = old_settings
+        addins.reinstall()
+        db.reconfigure()